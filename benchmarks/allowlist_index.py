@@ -0,0 +1,99 @@
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+from typing import Callable, List, Tuple
+
+from src import allowlist
+from src.allowlist import AllowlistIndex
+
+
+def synthetic_allowlist(size: int, seed: int = 1) -> List[str]:
+    rnd = random.Random(seed)
+    # Половина записей — @username, половина — числовые id
+    return [f"@user{i}" if i % 2 else str(rnd.randrange(10 ** 9, 10 ** 10)) for i in range(size)]
+
+
+def synthetic_members(count: int, seed: int = 2) -> Tuple[List[int], List[str]]:
+    rnd = random.Random(seed)
+    ids = [rnd.randrange(10 ** 9, 10 ** 10) for _ in range(count)]
+    names = [f"user{rnd.randrange(count * 4)}" for _ in range(count)]
+    return ids, names
+
+
+# Прежнее представление: множество строк, по две на имя, и набор строк на каждого участника
+class LegacySetIndex:
+    def __init__(self, identifiers):
+        keys = set()
+        for a in identifiers:
+            a = a.strip()
+            if a.startswith("@"):
+                keys.add(a.lower())
+                keys.add(a[1:].lower())
+            else:
+                keys.add(a.lower())
+        self.keys = frozenset(keys)
+
+    def allowed_mask(self, user_ids, usernames):
+        res = []
+        for uid, name in zip(user_ids, usernames):
+            idents = {str(uid)}
+            if name:
+                idents.add(f"@{name.lower()}")
+                idents.add(name.lower())
+            res.append(not self.keys.isdisjoint(idents))
+        return res
+
+
+# Время сборки меряем без tracemalloc, он заметно замедляет выделение памяти
+def measure_build(factory: Callable, identifiers) -> Tuple[object, int, float]:
+    gc.collect()
+    started = time.perf_counter()
+    factory(identifiers)
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    tracemalloc.start()
+    index = factory(identifiers)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return index, size, elapsed
+
+
+def measure_lookup(index, ids, names, batch: int) -> float:
+    started = time.perf_counter()
+    for i in range(0, len(ids), batch):
+        index.allowed_mask(ids[i:i + batch], names[i:i + batch])
+    return len(ids) / (time.perf_counter() - started)
+
+
+def run(size: int, lookups: int, batch: int) -> List[dict]:
+    identifiers = synthetic_allowlist(size)
+    ids, names = synthetic_members(lookups)
+    variants = [("legacy set", LegacySetIndex), ("compact", AllowlistIndex)]
+    results = []
+    for name, factory in variants:
+        index, mem, build = measure_build(factory, identifiers)
+        rate = measure_lookup(index, ids, names, batch)
+        results.append({"variant": name, "entries": size, "memory_mb": mem / 2 ** 20,
+                        "build_s": build, "lookups_per_s": rate})
+        del index
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Память и скорость проверки по белому списку")
+    parser.add_argument("--size", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=200_000)
+    parser.add_argument("--batch", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"numpy: {'yes' if allowlist.np is not None else 'no'}, batch={args.batch}")
+    print(f"{'variant':<12} {'entries':>10} {'memory, MB':>11} {'build, s':>9} {'lookups/s':>12}")
+    for r in run(args.size, args.lookups, args.batch):
+        print(f"{r['variant']:<12} {r['entries']:>10} {r['memory_mb']:>11.1f} {r['build_s']:>9.2f} "
+              f"{r['lookups_per_s']:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
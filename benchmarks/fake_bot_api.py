@@ -0,0 +1,297 @@
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import random
+import time
+from collections import Counter, deque
+from typing import Deque, Dict, Iterable, Optional, Tuple
+
+from aiohttp import web
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+# Методы, которые меняют состояние в Telegram: на них действуют задержка и искусственные 429
+WRITE_METHODS = ("banChatMember", "sendMessage", "editMessageText")
+
+
+# Гистограмма задержек с логарифмическими корзинами (шаг 2%): память не растёт с числом замеров
+class LatencyHistogram:
+    _STEP = math.log(1.02)
+
+    def __init__(self):
+        self.count = 0
+        self.max = 0.0
+        self._buckets: Counter = Counter()
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.max = max(self.max, seconds)
+        self._buckets[int(math.log(max(seconds, 1e-6) * 1e6) / self._STEP)] += 1
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                return min(self.max, math.exp((bucket + 1) * self._STEP) / 1e6)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "p50_ms": self.percentile(0.50) * 1000,
+            "p95_ms": self.percentile(0.95) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+
+def _chat(chat_id: int, chat_type: Optional[str] = None) -> dict:
+    return {"id": chat_id, "type": chat_type or ("supergroup" if chat_id < 0 else "private")}
+
+
+def _user(user_id: int, username: Optional[str] = None) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+    if username:
+        user["username"] = username
+    return user
+
+
+# Подделка Bot API для нагрузочных прогонов: отдаёт заготовленные апдейты через getUpdates
+# и записывает вызовы бота. Бот подключается к ней через TELEGRAM_API_URL
+class FakeBotApi:
+    def __init__(self, latency: float = 0.0, rate_limit: float = 0.0, retry_after: int = 1,
+                 method_latency: Optional[Dict[str, float]] = None, seed: int = 7):
+        self.latency = latency
+        self.method_latency = method_latency or {}
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.rate_limited: Counter = Counter()
+        self.latencies: Dict[str, LatencyHistogram] = {}
+        self.pushed = 0
+        self.acknowledged = 0
+        self.bans = 0
+        self.sent: Deque[Tuple[int, str]] = deque(maxlen=100)
+        self._updates: Deque[dict] = deque()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._files: Dict[str, bytes] = {}
+        # Ожидаемые действия бота: (chat_id, user_id) -> (метка, время события) и ответы по чатам
+        self._pending_bans: Dict[Tuple[int, int], Tuple[str, float]] = {}
+        self._pending_replies: Dict[int, Deque[Tuple[str, float]]] = {}
+        self._new_updates: Optional[asyncio.Event] = None
+        self._runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+
+    # --- сценарии: апдейты, которые бот получит через getUpdates ---
+
+    def push(self, update: dict) -> int:
+        update_id = next(self._update_ids)
+        self._updates.append({"update_id": update_id, **update})
+        self.pushed += 1
+        if self._new_updates is not None:
+            self._new_updates.set()
+        return update_id
+
+    def message(self, chat_id: int, user_id: int, username: Optional[str] = None, text: Optional[str] = None,
+                chat_type: Optional[str] = None, **fields) -> int:
+        msg = {"message_id": next(self._message_ids), "date": int(time.time()),
+               "chat": _chat(chat_id, chat_type), "from": _user(user_id, username), **fields}
+        if text is not None:
+            msg["text"] = text
+        return self.push({"message": msg})
+
+    def join(self, chat_id: int, users: Iterable[Tuple[int, Optional[str]]],
+             expect_ban: Iterable[int] = (), label: str = "join_to_ban") -> int:
+        users = list(users)
+        now = time.monotonic()
+        for user_id in expect_ban:
+            self.expect_ban(chat_id, user_id, label, now)
+        user_id, username = users[0]
+        return self.message(chat_id, user_id, username, new_chat_members=[_user(u, n) for u, n in users])
+
+    def document(self, chat_id: int, user_id: int, content: bytes, file_name: str = "allowlist.txt",
+                 caption: Optional[str] = None, label: str = "upload_to_reply") -> int:
+        file_id = f"file{len(self._files) + 1}"
+        self._files[file_id] = content
+        doc = {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_name": file_name,
+               "mime_type": "text/plain", "file_size": len(content)}
+        fields = {"document": doc}
+        if caption:
+            fields["caption"] = caption
+        self.expect_reply(chat_id, label)
+        return self.message(chat_id, user_id, **fields)
+
+    def expect_ban(self, chat_id: int, user_id: int, label: str, since: Optional[float] = None) -> None:
+        self._pending_bans[(chat_id, user_id)] = (label, since if since is not None else time.monotonic())
+
+    def expect_reply(self, chat_id: int, label: str) -> None:
+        self._pending_replies.setdefault(chat_id, deque()).append((label, time.monotonic()))
+
+    @property
+    def pending_bans(self) -> int:
+        return len(self._pending_bans)
+
+    @property
+    def pending_replies(self) -> int:
+        return sum(len(q) for q in self._pending_replies.values())
+
+    def _observe(self, label: str, since: float) -> None:
+        self.latencies.setdefault(label, LatencyHistogram()).add(time.monotonic() - since)
+
+    # --- методы Bot API ---
+
+    async def _get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        # Апдейты до offset бот подтвердил — больше их не отдаём
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+            self.acknowledged += 1
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, limit))
+
+    def _ban(self, params: dict):
+        self.bans += 1
+        pending = self._pending_bans.pop((int(params["chat_id"]), int(params["user_id"])), None)
+        if pending is not None:
+            self._observe(*pending)
+        return True
+
+    def _send(self, params: dict, method: str):
+        chat_id = int(params["chat_id"])
+        text = params.get("text", "")
+        if method == "sendMessage":
+            self.sent.append((chat_id, text))
+            replies = self._pending_replies.get(chat_id)
+            if replies:
+                self._observe(*replies.popleft())
+        message_id = int(params.get("message_id") or next(self._message_ids))
+        return {"message_id": message_id, "date": int(time.time()), "chat": _chat(chat_id),
+                "from": BOT_USER, "text": text}
+
+    def _get_file(self, params: dict):
+        file_id = params["file_id"]
+        return {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_size": len(self._files.get(file_id, b"")),
+                "file_path": f"documents/{file_id}"}
+
+    async def _call(self, method: str, params: dict):
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method == "getMe":
+            return BOT_USER
+        if method == "getFile":
+            return self._get_file(params)
+        if method == "banChatMember":
+            return self._ban(params)
+        if method in ("sendMessage", "editMessageText"):
+            return self._send(params, method)
+        return True
+
+    async def _handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if method in WRITE_METHODS:
+            delay = self.method_latency.get(method, self.latency)
+            if delay:
+                await asyncio.sleep(delay)
+            if self.rate_limit and self.rng.random() < self.rate_limit:
+                self.rate_limited[method] += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }, status=429)
+        return web.json_response({"ok": True, "result": await self._call(method, params)})
+
+    async def _handle_file(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["path"].rsplit("/", 1)[-1]
+        content = self._files.get(file_id)
+        if content is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=content)
+
+    # Апдейты от внешнего генератора, когда подделка запущена отдельным процессом
+    async def _handle_push(self, request: web.Request) -> web.Response:
+        ids = [self.push(update) for update in await request.json()]
+        return web.json_response({"ok": True, "result": ids})
+
+    async def _handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def stats(self) -> dict:
+        return {
+            "pushed": self.pushed,
+            "acknowledged": self.acknowledged,
+            "bans": self.bans,
+            "pending_bans": self.pending_bans,
+            "pending_replies": self.pending_replies,
+            "calls": dict(self.calls),
+            "rate_limited": dict(self.rate_limited),
+            "latency": {label: h.summary() for label, h in self.latencies.items()},
+        }
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._handle_file)
+        app.router.add_get("/_stats", self._handle_stats)
+        app.router.add_post("/_updates", self._handle_push)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._new_updates = asyncio.Event()
+        self._runner = web.AppRunner(self.build_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        # При port=0 порт выбирает ОС
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def _serve(args) -> None:
+    api = FakeBotApi(latency=args.latency_ms / 1000, rate_limit=args.rate_limit, retry_after=args.retry_after)
+    url = await api.start(args.host, args.port)
+    print(f"Fake Bot API on {url} (TELEGRAM_API_URL={url}); updates: POST {url}/_updates, stats: {url}/_stats")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.close()
+        print(json.dumps(api.stats(), indent=2))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Локальная подделка Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка ответа на запись (бан, сообщение)")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="доля ответов 429 на запись")
+    parser.add_argument("--retry-after", type=int, default=1)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from src import db
+from src.config import settings
+from src.handlers import router, universal_logger_and_handlers
+from src.models import Base
+from src.repository import MemberRepository, member_write_buffer
+from src.services import ModerationService
+from src.utils import parse_allowed_file_bytes
+
+from .allowlist_index import synthetic_allowlist
+
+SCALES = {"10k": 10_000, "100k": 100_000, "1M": 1_000_000}
+DEFAULT_BASELINE = Path(__file__).with_name("baseline.json")
+# Сколько вызовов делать на этапах, где отдельный вызов дорогой (запись в БД, обработчик)
+MAX_DB_OPS = 2_000
+MAX_HANDLER_OPS = 5_000
+CHECK_BATCH = 200
+
+
+# Подделки в духе tests/test_services.py: всё в памяти, Telegram не вызывается
+class FakeAllowedRepo:
+    def __init__(self, idents):
+        self._idents = list(idents)
+
+    async def list_identifiers(self, chat_id="*", resolved=False):
+        return list(self._idents) if chat_id == "*" else []
+
+    async def sync_users(self, identifiers, chat_id="*"):
+        self._idents = list(dict.fromkeys(identifiers))
+        return {"total": len(self._idents), "added": len(self._idents), "removed": 0, "unchanged": 0}
+
+    async def resolve_usernames(self, chat_id="*"):
+        return 0
+
+    async def resolved_identifiers(self, chat_id="*"):
+        return {}
+
+
+class FakeMemberRepo:
+    def __init__(self, members):
+        self._members = members
+
+    async def list_members_by_chat(self, chat_id: str):
+        return self._members
+
+    async def remove_member(self, chat_id: str, user_id: str):
+        pass
+
+    async def set_statuses(self, chat_id: str, updates):
+        pass
+
+
+class FakeLogRepo:
+    async def log(self, chat_id, user_identifier, action, reason=None):
+        pass
+
+
+class FakeOutbound:
+    async def submit(self, call, lane=None, chat_id=None, method=None):
+        return await call()
+
+
+class DummyBot:
+    async def ban_chat_member(self, chat_id, user_id):
+        return True
+
+    async def send_message(self, chat_id, text):
+        return True
+
+
+class DummyMessage:
+    def __init__(self, chat_id: int, user_id: int, username: Optional[str], new_members=None):
+        self.message_id = user_id
+        self.chat = SimpleNamespace(id=chat_id, type="supergroup")
+        self.from_user = SimpleNamespace(id=user_id, username=username)
+        self.text = None
+        self.document = None
+        self.new_chat_members = new_members
+        self.bot = DummyBot()
+
+    async def answer(self, text):
+        return None
+
+
+def synthetic_members(count: int, allowed_share: float = 0.9, seed: int = 3) -> List[dict]:
+    rnd = random.Random(seed)
+    members = []
+    for i in range(count):
+        # Разрешённые имена совпадают с synthetic_allowlist: @user1, @user3, ...
+        name = f"user{2 * rnd.randrange(count // 2 or 1) + 1}" if rnd.random() < allowed_share else f"guest{i}"
+        members.append({"id": i + 1, "user_id": str(10 ** 10 + i), "username": name})
+    return members
+
+
+def build_moderation(allowlist: List[str], members: List[dict]) -> ModerationService:
+    svc = ModerationService(DummyBot(), outbound=FakeOutbound())
+    svc.allowed_repo = FakeAllowedRepo(allowlist)
+    svc.member_repo = FakeMemberRepo(members)
+    svc.audit = FakeLogRepo()
+    return svc
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+# Прогоняет op count раз; items — сколько единиц работы (строк, участников) делает один вызов
+async def measure(op: Callable[[int], Awaitable[None]], count: int, items: int = 1) -> Dict[str, float]:
+    latencies = []
+    started = time.perf_counter()
+    for i in range(count):
+        t0 = time.perf_counter()
+        await op(i)
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "ops": count,
+        "throughput": count * items / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def bench_parse(size: int) -> Dict[str, float]:
+    content = "\n".join(synthetic_allowlist(size)).encode()
+
+    async def op(_):
+        parse_allowed_file_bytes(content)
+
+    return await measure(op, 5, items=size)
+
+
+async def bench_filter(size: int) -> Dict[str, float]:
+    svc = build_moderation(synthetic_allowlist(size), [])
+    members = synthetic_members(min(size, 100_000))
+    batches = [members[i:i + CHECK_BATCH] for i in range(0, len(members), CHECK_BATCH)]
+    await svc.get_allowed_index()
+
+    async def op(i):
+        await svc.filter_unauthorized(batches[i])
+
+    return await measure(op, len(batches), items=CHECK_BATCH)
+
+
+# clean_chat выбирает кандидатов в БД, поэтому здесь настоящие таблицы, а не подделки
+async def bench_clean(size: int) -> Dict[str, float]:
+    chat_id = f"-{size}"
+    svc = ModerationService(DummyBot(), outbound=FakeOutbound())
+    svc.audit = FakeLogRepo()
+    await svc.allowed_repo.sync_users(synthetic_allowlist(size))
+    members = synthetic_members(size)
+    for i in range(0, len(members), 5_000):
+        await svc.member_repo.upsert_members(chat_id, [(m["user_id"], m["username"]) for m in members[i:i + 5_000]])
+
+    # Статусы после банов не пишем, чтобы каждый прогон проверял один и тот же состав
+    async def set_statuses(chat_id, updates):
+        pass
+
+    svc.member_repo.set_statuses = set_statuses
+
+    async def op(_):
+        await svc.clean_chat(int(chat_id))
+
+    return await measure(op, 3, items=size)
+
+
+async def bench_upsert(size: int) -> Dict[str, float]:
+    repo = MemberRepository()
+    count = min(size, MAX_DB_OPS)
+
+    async def op(i):
+        # Половина вызовов обновляет уже известных участников
+        await repo.upsert_member(chat_id="-100", user_id=str(i % (count // 2 or 1)), username=f"user{i}")
+
+    return await measure(op, count)
+
+
+async def bench_handler(size: int) -> Dict[str, float]:
+    svc = build_moderation(synthetic_allowlist(size), [])
+    await svc.get_allowed_index()
+    count = min(size, MAX_HANDLER_OPS)
+    members = synthetic_members(count)
+    messages = []
+    for m in members:
+        user = SimpleNamespace(id=int(m["user_id"]), username=m["username"])
+        # Каждое пятое сообщение — вход нового участника, остальные — обычные сообщения в группе
+        new_members = [user] if m["id"] % 5 == 0 else None
+        messages.append(DummyMessage(-100, user.id, user.username, new_members))
+    saved = {name: getattr(router, name, None) for name in ("_moderation", "_joins")}
+    router._moderation, router._joins = svc, None
+    try:
+        async def op(i):
+            await universal_logger_and_handlers(messages[i])
+
+        return await measure(op, count)
+    finally:
+        for name, value in saved.items():
+            setattr(router, name, value)
+        await member_write_buffer.flush()
+
+
+STAGES = {
+    "parse_allowed_file_bytes": bench_parse,
+    "filter_unauthorized": bench_filter,
+    "clean_chat": bench_clean,
+    "upsert_member": bench_upsert,
+    "universal_logger_and_handlers": bench_handler,
+}
+
+
+async def run_suite(scales: Dict[str, int], db_url: Optional[str] = None,
+                    stages: Optional[List[str]] = None) -> Dict[str, Dict[str, Dict[str, float]]]:
+    tmpdir = None
+    if db_url is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        db_url = f"sqlite+aiosqlite:///{os.path.join(tmpdir.name, 'bench.sqlite3')}"
+    engine = await db.configure_engine(db_url)
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+        results = {}
+        for scale, size in scales.items():
+            results[scale] = {}
+            for name in stages or list(STAGES):
+                results[scale][name] = await STAGES[name](size)
+        return results
+    finally:
+        await db.configure_engine(settings.DATABASE_URL)
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+
+# Регрессия: пропускная способность упала или медиана задержки выросла больше чем на threshold
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    problems = []
+    for scale, stages in results.items():
+        for name, cur in stages.items():
+            base = baseline.get(scale, {}).get(name)
+            if not base:
+                continue
+            if cur["throughput"] < base["throughput"] * (1 - threshold):
+                problems.append(f"{scale} {name}: throughput {cur['throughput']:.0f}/s "
+                                f"vs baseline {base['throughput']:.0f}/s")
+            if cur["p50_ms"] > base["p50_ms"] * (1 + threshold):
+                problems.append(f"{scale} {name}: p50 {cur['p50_ms']:.3f} ms vs baseline {base['p50_ms']:.3f} ms")
+    return problems
+
+
+def format_results(results: dict) -> str:
+    lines = [f"{'scale':<6} {'stage':<30} {'ops':>6} {'throughput/s':>13} {'p50, ms':>9} {'p99, ms':>9}"]
+    for scale, stages in results.items():
+        for name, r in stages.items():
+            lines.append(f"{scale:<6} {name:<30} {r['ops']:>6} {r['throughput']:>13.0f} "
+                         f"{r['p50_ms']:>9.3f} {r['p99_ms']:>9.3f}")
+    return "\n".join(lines)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарки горячих путей модерации")
+    parser.add_argument("--scale", action="append", choices=list(SCALES),
+                        help="масштаб (можно несколько раз), по умолчанию 10k и 100k")
+    parser.add_argument("--stage", action="append", choices=list(STAGES))
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="записать результаты как новую базу")
+    parser.add_argument("--threshold", type=float, default=0.25, help="допустимое ухудшение, доля")
+    args = parser.parse_args()
+
+    scales = {name: SCALES[name] for name in (args.scale or ["10k", "100k"])}
+    results = asyncio.run(run_suite(scales, stages=args.stage))
+    print(format_results(results))
+
+    if args.save_baseline:
+        baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        for scale, stages in results.items():
+            baseline.setdefault(scale, {}).update(stages)
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True))
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if not args.baseline.exists():
+        print(f"No baseline at {args.baseline}, run with --save-baseline first")
+        return 0
+    problems = compare(results, json.loads(args.baseline.read_text()), args.threshold)
+    for p in problems:
+        print(f"REGRESSION {p}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+
+from src import db
+from src.config import settings
+from src.models import Base
+
+from .fake_bot_api import FakeBotApi
+
+ADMIN_ID = 1
+# Участники: чётные id — из белого списка (ok<id>), нечётные — незнакомцы (guest<id>)
+USER_BASE = 10 ** 9
+SCENARIOS = ("flood", "joins", "clean", "upload", "mixed")
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        # Без /proc — пиковый RSS (в Linux в КБ, в macOS в байтах)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+
+def username(user_id: int) -> str:
+    return f"ok{user_id}" if user_id % 2 == 0 else f"guest{user_id}"
+
+
+def allowlist_bytes(size: int) -> bytes:
+    return "\n".join(f"@ok{USER_BASE + 2 * i}" for i in range(size)).encode()
+
+
+# Считает апдейты, обработанные до конца (внутренняя прослойка — уже в воркере чата)
+class CompletedUpdates(BaseMiddleware):
+    def __init__(self):
+        self.count = 0
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any,
+                       data: Dict[str, Any]) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            now = time.monotonic()
+            self.count += 1
+            self.first = self.first or now
+            self.last = now
+
+
+class LoadContext:
+    def __init__(self, api: FakeBotApi, rate: float, chats: int, members: int, allowlist_size: int,
+                 deadline: float, settled: Callable[[], bool], seed: int = 11):
+        self.api = api
+        # Все поданные апдейты обработаны
+        self.settled = settled
+        self.rate = rate
+        self.chats = [-(10 ** 12) - i for i in range(chats)]
+        self.members = members
+        self.allowlist_size = allowlist_size
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+        self._next_user = USER_BASE + 2 * allowlist_size
+
+    def known_user(self) -> int:
+        return USER_BASE + self.rng.randrange(min(self.members, 2 * self.allowlist_size) or 1)
+
+    def new_user(self) -> int:
+        self._next_user += 1
+        return self._next_user
+
+
+# Равномерный темп: emit(i) вызывается rate раз в секунду до deadline
+async def paced(rate: float, deadline: float, emit: Callable[[int], None]) -> int:
+    started = time.monotonic()
+    i = 0
+    while time.monotonic() < deadline:
+        emit(i)
+        i += 1
+        delay = min(started + i / rate, deadline) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        elif i % 100 == 0:
+            await asyncio.sleep(0)
+    return i
+
+
+async def scenario_flood(ctx: LoadContext, rate: Optional[float] = None) -> None:
+    def emit(i):
+        user_id = ctx.known_user()
+        ctx.api.message(ctx.rng.choice(ctx.chats), user_id, username(user_id), text=f"message {i}")
+
+    await paced(rate or ctx.rate, ctx.deadline, emit)
+
+
+async def scenario_joins(ctx: LoadContext, rate: Optional[float] = None, batch: int = 3) -> None:
+    def emit(_):
+        users = [ctx.new_user() for _ in range(ctx.rng.randint(1, batch))]
+        # Новые чётные id в список не входят: банить надо всех, кроме уже известных из списка
+        ctx.api.join(ctx.rng.choice(ctx.chats), [(u, username(u)) for u in users], expect_ban=users)
+
+    await paced(rate or ctx.rate, ctx.deadline, emit)
+
+
+async def scenario_clean(ctx: LoadContext) -> None:
+    # Состав чатов набирается сообщениями, затем админ запускает /clean в каждом
+    def emit(i):
+        chat_id = ctx.chats[i % len(ctx.chats)]
+        user_id = USER_BASE + i // len(ctx.chats)
+        ctx.api.message(chat_id, user_id, username(user_id), text="hi")
+
+    total = ctx.members * len(ctx.chats)
+    started = time.monotonic()
+    await paced(ctx.rate, started + total / ctx.rate, emit)
+    # Ждём обработки всех сообщений и сброса буфера участников в БД, иначе /clean увидит не всех
+    await _wait_until(ctx.settled, max(60.0, total / ctx.rate))
+    await asyncio.sleep(settings.MEMBER_FLUSH_INTERVAL * 2)
+    for chat_id in ctx.chats:
+        since = time.monotonic()
+        for n in range(1, ctx.members, 2):
+            ctx.api.expect_ban(chat_id, USER_BASE + n, "clean_to_ban", since)
+        ctx.api.message(chat_id, ADMIN_ID, "admin", text="/clean")
+
+
+async def scenario_upload(ctx: LoadContext, rate: Optional[float] = None) -> None:
+    def emit(i):
+        # Каждый раз новый файл с другим составом, чтобы список действительно разбирался и сохранялся
+        content = allowlist_bytes(ctx.allowlist_size) + f"\n@extra{i}".encode()
+        ctx.api.document(ADMIN_ID, ADMIN_ID, content, file_name=f"list{i}.txt")
+
+    await paced(rate or ctx.rate, ctx.deadline, emit)
+
+
+async def scenario_mixed(ctx: LoadContext) -> None:
+    await asyncio.gather(
+        scenario_flood(ctx, rate=ctx.rate * 0.8),
+        scenario_joins(ctx, rate=ctx.rate * 0.2),
+        scenario_upload(ctx, rate=1 / 60),
+    )
+
+
+SCENARIO_RUNNERS = {
+    "flood": scenario_flood,
+    "joins": scenario_joins,
+    "clean": scenario_clean,
+    "upload": scenario_upload,
+    "mixed": scenario_mixed,
+}
+
+
+def _slope_per_hour(samples: List[List[float]]) -> float:
+    if len(samples) < 2:
+        return 0.0
+    n = len(samples)
+    mean_t = sum(t for t, _ in samples) / n
+    mean_m = sum(m for _, m in samples) / n
+    var = sum((t - mean_t) ** 2 for t, _ in samples)
+    if not var:
+        return 0.0
+    return sum((t - mean_t) * (m - mean_m) for t, m in samples) / var * 3600
+
+
+async def _wait_until(condition: Callable[[], bool], timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+async def run_load(scenario: str, duration: float = 60.0, rate: float = 100.0, chats: int = 10,
+                   members: int = 1000, allowlist_size: int = 1000, latency: float = 0.0,
+                   rate_limit: float = 0.0, retry_after: int = 1, db_url: Optional[str] = None,
+                   sample_interval: float = 5.0, drain_timeout: float = 60.0) -> dict:
+    from src.bot_app import BotApp
+
+    tmpdir = None
+    if db_url is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        db_url = f"sqlite+aiosqlite:///{os.path.join(tmpdir.name, 'load.sqlite3')}"
+    engine = await db.configure_engine(db_url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+    api = FakeBotApi(latency=latency, rate_limit=rate_limit, retry_after=retry_after)
+    url = await api.start()
+    saved = {name: getattr(settings, name) for name in
+             ("TELEGRAM_API_URL", "BOT_TOKEN", "BOT_MODE", "METRICS_PORT", "ADMIN_CHAT_ID")}
+    settings.TELEGRAM_API_URL = url
+    settings.BOT_TOKEN = "123456:loadtest"
+    settings.BOT_MODE = "polling"
+    settings.METRICS_PORT = 0
+    settings.ADMIN_CHAT_ID = ADMIN_ID
+
+    app = BotApp()
+    completed = CompletedUpdates()
+    app.dp.update.middleware(completed)
+    app_task = asyncio.create_task(app.start())
+    samples: List[List[float]] = []
+    try:
+        # Белый список до начала нагрузки: все чётные id из диапазона участников
+        api.document(ADMIN_ID, ADMIN_ID, allowlist_bytes(allowlist_size), label="initial_upload")
+        if not await _wait_until(lambda: api.pending_replies == 0, drain_timeout):
+            raise RuntimeError("Bot did not answer the initial allowlist upload")
+
+        baseline_pushed, baseline_done = api.pushed, completed.count
+
+        def settled() -> bool:
+            return completed.count - baseline_done >= api.pushed - baseline_pushed
+
+        ctx = LoadContext(api, rate, chats, members, allowlist_size, time.monotonic() + duration, settled)
+        started = time.monotonic()
+
+        async def sample_memory():
+            while True:
+                samples.append([round(time.monotonic() - started, 3), round(rss_mb(), 2)])
+                await asyncio.sleep(sample_interval)
+
+        sampler = asyncio.create_task(sample_memory())
+        try:
+            await SCENARIO_RUNNERS[scenario](ctx)
+            produced = time.monotonic()
+            drained = await _wait_until(
+                lambda: settled() and not api.pending_bans and not api.pending_replies, drain_timeout)
+        finally:
+            sampler.cancel()
+        samples.append([round(time.monotonic() - started, 3), round(rss_mb(), 2)])
+        elapsed = time.monotonic() - started
+        handled = completed.count - baseline_done
+        # Пропускная способность — до последнего обработанного апдейта, без хвоста ожидания банов
+        busy = (completed.last or started) - started
+        return {
+            "scenario": scenario,
+            "duration_s": round(elapsed, 3),
+            "produce_s": round(produced - started, 3),
+            "drained": drained,
+            "updates_pushed": api.pushed - baseline_pushed,
+            "updates_handled": handled,
+            "throughput": handled / busy if busy > 0 else 0.0,
+            "api": api.stats(),
+            "memory": {
+                "start_mb": samples[0][1],
+                "end_mb": samples[-1][1],
+                "growth_mb": round(samples[-1][1] - samples[0][1], 2),
+                "slope_mb_per_hour": round(_slope_per_hour(samples), 2),
+                "samples": samples,
+            },
+        }
+    finally:
+        try:
+            await app.dp.stop_polling()
+        except RuntimeError:
+            # Опрос так и не запустился; причину покажет app_task
+            pass
+        try:
+            await asyncio.wait_for(app_task, drain_timeout)
+        except Exception:
+            app_task.cancel()
+        # Роутер обработчиков — модульный объект; отцепляем, чтобы в процессе можно было собрать BotApp заново
+        if app.router in app.dp.sub_routers:
+            app.dp.sub_routers.remove(app.router)
+            app.router._parent_router = None
+        for name, value in saved.items():
+            setattr(settings, name, value)
+        await api.close()
+        await db.configure_engine(settings.DATABASE_URL)
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+
+def format_report(report: dict) -> str:
+    api, memory = report["api"], report["memory"]
+    lines = [
+        f"scenario {report['scenario']}: {report['updates_handled']}/{report['updates_pushed']} updates "
+        f"in {report['duration_s']:.1f}s, {report['throughput']:.0f} updates/s"
+        + ("" if report["drained"] else " (NOT DRAINED)"),
+        f"bans {api['bans']}, pending {api['pending_bans']}, rate limited {sum(api['rate_limited'].values())}",
+        f"memory {memory['start_mb']:.1f} -> {memory['end_mb']:.1f} MB "
+        f"({memory['growth_mb']:+.1f} MB, {memory['slope_mb_per_hour']:+.1f} MB/h)",
+    ]
+    for label, h in sorted(api["latency"].items()):
+        lines.append(f"{label:<16} n={h['count']:<7} p50 {h['p50_ms']:9.1f} ms  p95 {h['p95_ms']:9.1f} ms  "
+                     f"p99 {h['p99_ms']:9.1f} ms  max {h['max_ms']:9.1f} ms")
+    return "\n".join(lines)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Сквозная нагрузка на BotApp через подделку Bot API")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="mixed")
+    parser.add_argument("--duration", type=float, default=60.0, help="секунды подачи нагрузки (для soak — часы)")
+    parser.add_argument("--rate", type=float, default=100.0, help="апдейтов в секунду")
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--members", type=int, default=1000, help="участников в чате для сценария clean")
+    parser.add_argument("--allowlist", type=int, default=1000, help="записей в белом списке")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка ответа Bot API на запись")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="доля ответов 429 на запись")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--db-url", help="по умолчанию — временная SQLite")
+    parser.add_argument("--sample-interval", type=float, default=5.0, help="период замера памяти, с")
+    parser.add_argument("--drain-timeout", type=float, default=60.0)
+    parser.add_argument("--json", help="записать полный отчёт в файл")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load(
+        args.scenario, duration=args.duration, rate=args.rate, chats=args.chats, members=args.members,
+        allowlist_size=args.allowlist, latency=args.latency_ms / 1000, rate_limit=args.rate_limit,
+        retry_after=args.retry_after, db_url=args.db_url, sample_interval=args.sample_interval,
+        drain_timeout=args.drain_timeout,
+    ))
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0 if report["drained"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
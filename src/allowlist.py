@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy необязателен: без него пакетная проверка идёт через bisect
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# С какого размера пачки выгоднее векторный searchsorted
+_VECTOR_MIN = 64
+# Заглушка для участников без id в векторной проверке
+_NO_ID = -2 ** 63
+
+
+def username_key(username) -> Optional[str]:
+    if not username:
+        return None
+    key = str(username).strip().lstrip("@").lower()
+    return key or None
+
+
+# Нормализованные ключи строки белого списка: (id, имя). Те же ключи хранятся в allowed_users для выборки в SQL
+def identifier_keys(raw) -> Tuple[Optional[int], Optional[str]]:
+    value = str(raw or "").strip()
+    if value.lstrip("-").isdigit():
+        return int(value), None
+    key = value.lstrip("@").lower()
+    if not key:
+        return None, None
+    # "@123" раньше совпадал и с id 123
+    return (int(key) if key.isdigit() else None), key
+
+
+# 64-битный хэш имени. Индекс живёт только в памяти процесса, поэтому подходит встроенный hash():
+# он кэшируется в самой строке и со случайной солью (PYTHONHASHSEED), так что коллизию не подобрать заранее
+hash_username = hash
+
+
+# Независимая 32-битная контрольная сумма: считается только при совпадении хэша
+def _check(key: str) -> int:
+    return zlib.crc32(key.encode("utf-8"))
+
+
+# Собранный белый список: id в отсортированном array('q'), имена — отсортированными 64-битными хэшами
+class AllowlistIndex:
+    def __init__(self, identifiers: Iterable[str], version: int = 0):
+        ids = set()
+        keys = set()
+        for raw in identifiers:
+            user_id, key = identifier_keys(raw)
+            if user_id is not None:
+                ids.add(user_id)
+            if key is not None:
+                keys.add(key)
+        self.version = version
+        self._ids = array("q", sorted(ids))
+        ordered = sorted(keys, key=hash_username)
+        self._names = array("q", map(hash_username, ordered))
+        self._checks = array("I", map(_check, ordered))
+        self.collisions = len(ordered) - len(set(self._names))
+        if self.collisions:
+            logger.warning("Allowlist has %d username hash collisions", self.collisions)
+        self.nbytes = sum(sys.getsizeof(a) for a in (self._ids, self._names, self._checks))
+        self._views = None
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._names)
+
+    def contains_id(self, user_id: int) -> bool:
+        i = bisect_left(self._ids, user_id)
+        return i < len(self._ids) and self._ids[i] == user_id
+
+    def contains_username(self, username) -> bool:
+        key = username_key(username)
+        if key is None:
+            return False
+        return self._contains_key(key, bisect_left(self._names, hash_username(key)))
+
+    def _contains_key(self, key: str, i: int) -> bool:
+        names = self._names
+        h = hash_username(key)
+        if i >= len(names) or names[i] != h:
+            return False
+        check = _check(key)
+        while i < len(names) and names[i] == h:
+            if self._checks[i] == check:
+                return True
+            i += 1
+        return False
+
+    # Пакетная проверка: True, если участник есть в списке по id или по имени
+    def allowed_mask(self, user_ids: Sequence[Optional[int]], usernames: Sequence[Optional[str]]) -> List[bool]:
+        if np is not None and len(user_ids) >= _VECTOR_MIN:
+            return self._allowed_mask_vector(user_ids, usernames)
+        return [
+            (uid is not None and self.contains_id(uid)) or self.contains_username(name)
+            for uid, name in zip(user_ids, usernames)
+        ]
+
+    def _allowed_mask_vector(self, user_ids, usernames) -> List[bool]:
+        if self._views is None:
+            self._views = (np.frombuffer(self._ids, dtype=np.int64), np.frombuffer(self._names, dtype=np.int64),
+                           np.frombuffer(self._checks, dtype=np.uint32))
+        ids, names, checks = self._views
+        mask = np.zeros(len(user_ids), dtype=bool)
+
+        if len(ids):
+            query = np.array([_NO_ID if uid is None else uid for uid in user_ids], dtype=np.int64)
+            found = np.minimum(np.searchsorted(ids, query), len(ids) - 1)
+            mask |= (ids[found] == query) & (query != _NO_ID)
+
+        if len(names):
+            hash_ = hash_username
+            # Имена участников приходят от Telegram без пробелов, достаточно убрать "@" и регистр
+            keys = [name.lstrip("@").lower() if name else None for name in usernames]
+            query = np.array([hash_(key) for key in keys], dtype=np.int64)
+            found = np.searchsorted(names, query)
+            same_hash = names[np.minimum(found, len(names) - 1)] == query
+            # Совпадение хэша подтверждаем контрольной суммой
+            rows = [j for j in np.flatnonzero(same_hash & ~mask).tolist() if keys[j]]
+            if rows:
+                rows = np.asarray(rows)
+                sums = np.array([_check(keys[j]) for j in rows.tolist()], dtype=np.uint32)
+                ok = checks[found[rows]] == sums
+                mask[rows[ok]] = True
+                # Хэш совпал, сумма нет: возможна коллизия внутри списка, проверяем весь диапазон
+                for j in rows[~ok].tolist():
+                    mask[j] = self._contains_key(keys[j], int(found[j]))
+        return mask.tolist()
+
+
+# Список чата вместе с общим: участник разрешён, если найден хотя бы в одном
+class ScopedAllowlist:
+    def __init__(self, indexes: List[AllowlistIndex]):
+        self.indexes = [ix for ix in indexes if len(ix)]
+
+    def __len__(self) -> int:
+        return sum(len(ix) for ix in self.indexes)
+
+    def allowed_mask(self, user_ids: Sequence[Optional[int]], usernames: Sequence[Optional[str]]) -> List[bool]:
+        mask = [False] * len(user_ids)
+        for ix in self.indexes:
+            mask = [a or b for a, b in zip(mask, ix.allowed_mask(user_ids, usernames))]
+        return mask
+
+
+# Индексы по областям (чат или общий список): грузятся при первом обращении и вытесняются по LRU
+class AllowlistIndexCache:
+    def __init__(self, loader: Callable[[str], Awaitable[Iterable[str]]],
+                 build: Callable[[Iterable[str], int], AllowlistIndex],
+                 budget_bytes: int):
+        self.loader = loader
+        self.build = build
+        self.budget_bytes = budget_bytes
+        self._entries: "OrderedDict[str, AllowlistIndex]" = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._bytes = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, scope: str) -> bool:
+        return scope in self._entries
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    # Индекс без загрузки и без обновления порядка LRU
+    def peek(self, scope: str) -> Optional[AllowlistIndex]:
+        return self._entries.get(scope)
+
+    def version(self, scope: str) -> int:
+        return self._versions.get(scope, 0)
+
+    def invalidate(self, scope: Optional[str] = None) -> None:
+        scopes = [scope] if scope is not None else list(set(self._versions) | set(self._entries))
+        for s in scopes:
+            self._versions[s] = self._versions.get(s, 0) + 1
+            self._drop(s)
+
+    def replace(self, scope: str, identifiers: Iterable[str]) -> AllowlistIndex:
+        version = self._versions.get(scope, 0) + 1
+        self._versions[scope] = version
+        index = self.build(identifiers, version)
+        self._put(scope, index)
+        return index
+
+    async def get(self, scope: str) -> AllowlistIndex:
+        index = self._fresh(scope)
+        if index is not None:
+            return index
+        lock = self._locks.setdefault(scope, asyncio.Lock())
+        async with lock:
+            index = self._fresh(scope)
+            if index is not None:
+                return index
+            version = self.version(scope)
+            index = self.build(await self.loader(scope), version)
+            self.loads += 1
+            # Пока читали БД, список могли заменить — тогда устаревший индекс не сохраняем
+            if version == self.version(scope):
+                self._put(scope, index)
+            logger.info("Allowlist index built: scope=%s version=%d entries=%d", scope, version, len(index))
+            return index
+
+    def _fresh(self, scope: str) -> Optional[AllowlistIndex]:
+        index = self._entries.get(scope)
+        if index is None or index.version != self.version(scope):
+            return None
+        self._entries.move_to_end(scope)
+        return index
+
+    def _drop(self, scope: str) -> None:
+        old = self._entries.pop(scope, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+
+    def _put(self, scope: str, index: AllowlistIndex) -> None:
+        self._drop(scope)
+        self._entries[scope] = index
+        self._bytes += index.nbytes
+        # Самый свежий индекс не вытесняем, даже если он один больше бюджета
+        while self._bytes > self.budget_bytes and len(self._entries) > 1:
+            evicted, old = self._entries.popitem(last=False)
+            self._bytes -= old.nbytes
+            self.evictions += 1
+            logger.debug("Allowlist index evicted: scope=%s entries=%d", evicted, len(old))
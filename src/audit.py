@@ -0,0 +1,187 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+from .background import stop_tasks
+from .config import settings
+from .repository import ActionLogRepository
+
+logger = logging.getLogger(__name__)
+
+
+_PERIOD_TITLES = {1: "Сегодня", 7: "7 дней", 30: "30 дней"}
+
+
+def format_stats(totals: Dict[int, Dict[str, int]]) -> str:
+    lines = ["Статистика модерации (по UTC):"]
+    for days, counts in sorted(totals.items()):
+        title = _PERIOD_TITLES.get(days, f"{days} дн.")
+        lines.append(f"{title}: забанено {counts['banned']}, уже вышли {counts['already_left']}, "
+                     f"ошибок бана {counts['ban_failed']}.")
+    return "\n".join(lines)
+
+
+def _append_spill(path: str, rows: List[dict]) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps({**row, "timestamp": row["timestamp"].isoformat()}, ensure_ascii=False))
+            f.write("\n")
+
+
+def _read_spill(path: str) -> List[dict]:
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+                rows.append(row)
+    return rows
+
+
+# Асинхронный журнал действий: события копятся в ограниченной очереди и пишутся пачками
+class AuditSink:
+    def __init__(self, repo: Optional[ActionLogRepository] = None,
+                 max_queue: int = settings.AUDIT_QUEUE_SIZE,
+                 batch_size: int = settings.AUDIT_BATCH_SIZE,
+                 spill_path: str = settings.AUDIT_SPILL_PATH):
+        self.repo = repo if repo is not None else ActionLogRepository()
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.spill_path = spill_path
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._dropped = 0
+        self._spilled = 0
+        # Файл мог остаться от прошлого запуска, поэтому при первой успешной записи он проверяется
+        self._spill_pending = bool(spill_path)
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    @property
+    def spilled(self) -> int:
+        return self._spilled
+
+    async def log(self, chat_id: str, user_identifier: str, action: str, reason: Optional[str] = None) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        event = {
+            "chat_id": str(chat_id),
+            "user_identifier": user_identifier,
+            "action": action,
+            "reason": reason,
+            "timestamp": datetime.utcnow(),
+        }
+        # Если очередь заполнена, вызывающий ждёт, пока писатель её разгрузит
+        await self._queue.put(event)
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_loop())
+
+    async def _write_loop(self) -> None:
+        # Пишем всё, что накопилось, пока очередь не опустеет; новые события копятся во время записи
+        while not self._queue.empty():
+            batch = []
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                if await self._write(batch) and self._spill_pending:
+                    await self._replay_spill()
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _write(self, batch: List[dict]) -> bool:
+        try:
+            for attempt in (1, 2):
+                try:
+                    await self.repo.log_many(batch)
+                    return True
+                except Exception:
+                    logger.exception("Failed to write %d audit events (attempt %d)", len(batch), attempt)
+        except asyncio.CancelledError:
+            # Остановка не дождалась записи: пачку сохраняем на диск синхронно, цикл уже завершается
+            self._spill_sync(batch)
+            raise
+        await self._spill(batch)
+        return False
+
+    # БД недоступна: пачка дописывается в файл и вернётся в БД после следующей успешной записи
+    def _spill_sync(self, batch: List[dict]) -> None:
+        if self.spill_path:
+            try:
+                _append_spill(self.spill_path, batch)
+                self._spilled += len(batch)
+                self._spill_pending = True
+                logger.warning("Spilled %d audit events to %s", len(batch), self.spill_path)
+                return
+            except Exception:
+                logger.exception("Failed to spill %d audit events to %s", len(batch), self.spill_path)
+        self._dropped += len(batch)
+        logger.error("Dropped %d audit events", len(batch))
+
+    async def _spill(self, batch: List[dict]) -> None:
+        await asyncio.to_thread(self._spill_sync, batch)
+
+    async def _replay_spill(self) -> None:
+        self._spill_pending = False
+        # Новые сбросы во время переноса идут в свежий файл. .replay остаётся, если процесс упал посреди
+        # переноса: тогда часть событий попадёт в журнал дважды, но не пропадёт
+        replay = self.spill_path + ".replay"
+        try:
+            if not os.path.exists(replay):
+                if not os.path.exists(self.spill_path):
+                    return
+                await asyncio.to_thread(os.replace, self.spill_path, replay)
+            rows = await asyncio.to_thread(_read_spill, replay)
+        except Exception:
+            logger.exception("Failed to read spilled audit events from %s", replay)
+            return
+        for i in range(0, len(rows), self.batch_size):
+            try:
+                await self.repo.log_many(rows[i:i + self.batch_size])
+            except Exception:
+                logger.exception("Failed to replay spilled audit events, keeping %d on disk", len(rows) - i)
+                await self._spill(rows[i:])
+                break
+        else:
+            logger.info("Replayed %d spilled audit events", len(rows))
+        await asyncio.to_thread(os.remove, replay)
+
+    async def flush(self) -> None:
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def recent(self, chat_id: Optional[str] = None, user_identifier: Optional[str] = None,
+                     limit: int = 50) -> List[dict]:
+        await self.flush()
+        return await self.repo.recent(chat_id=chat_id, user_identifier=user_identifier, limit=limit)
+
+    async def stats(self, chat_id: str, periods: Sequence[int] = (1, 7, 30)) -> Dict[int, Dict[str, int]]:
+        await self.flush()
+        return await self.repo.stats(chat_id, periods=periods)
+
+    # Очередь дописывается не дольше timeout; что не успело, уходит в файл
+    async def close(self, timeout: float = settings.SHUTDOWN_TIMEOUT) -> None:
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+            return
+        except asyncio.TimeoutError:
+            logger.warning("Audit queue not flushed within %.1f s, spilling %d events", timeout, self.qsize())
+        await stop_tasks([self._writer], timeout=0, name="Audit writer")
+        rest = []
+        while not self._queue.empty():
+            rest.append(self._queue.get_nowait())
+            self._queue.task_done()
+        if rest:
+            self._spill_sync(rest)
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from .background import stop_tasks, wait_stopping
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Периодическая очистка всех известных чатов раз в CHECK_INTERVAL_SECONDS
+class AutoCleanScheduler:
+    def __init__(self, moderation, jobs=None,
+                 interval: float = settings.CHECK_INTERVAL_SECONDS,
+                 concurrency: int = settings.AUTO_CLEAN_CONCURRENCY,
+                 force: bool = settings.AUTO_CLEAN_FORCE,
+                 spread: bool = True):
+        self.moderation = moderation
+        self.jobs = jobs
+        self.interval = interval
+        self.concurrency = max(1, concurrency)
+        self.force = force
+        self.spread = spread
+        self._fingerprints: Dict[str, Tuple] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+
+    @property
+    def member_repo(self):
+        return self.moderation.member_repo
+
+    async def _fingerprint(self, chat_id: str) -> Tuple:
+        members = await self.member_repo.chat_fingerprint(chat_id)
+        return members, self.moderation.allowlist_version(chat_id)
+
+    async def _clean_if_changed(self, chat_id: str) -> str:
+        # Чат без изменений в составе и белом списке с прошлого прохода не трогаем
+        if not self.force and self._fingerprints.get(chat_id) == await self._fingerprint(chat_id):
+            return "skipped"
+        if self.jobs is not None and await self.jobs.active(chat_id) is not None:
+            return "busy"
+        res = await self.moderation.clean_chat(chat_id=int(chat_id))
+        self._fingerprints[chat_id] = await self._fingerprint(chat_id)
+        logger.info("Auto-clean chat %s: checked=%d to_ban=%d banned=%d",
+                    chat_id, res["checked"], res["to_ban"], res["banned"])
+        return "cleaned"
+
+    async def sweep(self) -> Dict[str, int]:
+        await self.member_repo.flush()
+        chats = await self.member_repo.list_known_chats()
+        stats = {"cleaned": 0, "skipped": 0, "busy": 0, "failed": 0}
+        if not chats:
+            return stats
+
+        # Старты чатов равномерно распределены по интервалу, чтобы не бить в Bot API пачкой
+        step = self.interval / len(chats) if self.spread else 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_one(i: int, chat_id: str) -> None:
+            # При остановке оставшиеся чаты не начинаем
+            if await wait_stopping(self._stopping, i * step):
+                return
+            async with semaphore:
+                if self._stopping.is_set():
+                    return
+                try:
+                    stats[await self._clean_if_changed(chat_id)] += 1
+                except Exception:
+                    stats["failed"] += 1
+                    logger.exception("Auto-clean failed for chat %s", chat_id)
+
+        await asyncio.gather(*(run_one(i, chat_id) for i, chat_id in enumerate(chats)))
+        logger.info("Auto-clean sweep over %d chats: %s", len(chats), stats)
+        return stats
+
+    async def _run(self) -> None:
+        while not self._stopping.is_set():
+            started = time.monotonic()
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Auto-clean sweep failed")
+            await wait_stopping(self._stopping, self.interval - (time.monotonic() - started))
+
+    def start(self) -> None:
+        if self.interval <= 0:
+            logger.info("Auto-clean disabled (CHECK_INTERVAL_SECONDS=%s)", self.interval)
+            return
+        if self._task is None or self._task.done():
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            await stop_tasks([self._task], self._stopping, name="Auto-clean")
+            self._task = None
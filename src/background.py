@@ -0,0 +1,38 @@
+import asyncio
+import logging
+from typing import Iterable, Optional
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Ждёт сигнала остановки не дольше seconds; True — пора завершаться
+async def wait_stopping(stopping: asyncio.Event, seconds: float) -> bool:
+    try:
+        await asyncio.wait_for(stopping.wait(), max(0.0, seconds))
+    except asyncio.TimeoutError:
+        pass
+    return stopping.is_set()
+
+
+# Общая остановка фоновых задач, работающих с БД: сигнал stopping, ожидание не дольше timeout,
+# и только потом отмена. Отменённый посреди запроса aiosqlite оставляет поток, из-за которого
+# процесс не завершается, поэтому задачи сначала получают шанс остановиться между запросами
+async def stop_tasks(tasks: Iterable[Optional[asyncio.Task]], stopping: Optional[asyncio.Event] = None,
+                     timeout: float = settings.SHUTDOWN_TIMEOUT, name: str = "background task") -> bool:
+    if stopping is not None:
+        stopping.set()
+    tasks = [t for t in tasks if t is not None]
+    if not tasks:
+        return True
+    done, pending = await asyncio.wait(tasks, timeout=max(0.0, timeout))
+    if pending:
+        logger.warning("%s: %d task(s) did not stop within %.1f s, cancelling", name, len(pending), timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    for task in done:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("%s failed", name, exc_info=task.exception())
+    return not pending
@@ -1,21 +1,31 @@
+import asyncio
 import logging
-import sys
+from typing import Optional
 
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import BotCommand
 
+from .autoclean import AutoCleanScheduler
+from .cache import presence_cache
+from .coalescer import JoinCoalescer
 from .config import settings
+from .instrumentation import BAN_RATE, BotApiMetricsMiddleware
+from .lease import InstanceLease
+from .metrics import REGISTRY, start_metrics_server
+from .outbound import OutboundMiddleware, OutboundScheduler
+from .profiling import LoopProfiler, configure_slow_callbacks
+from .retention import ActionLogArchiver
 from .services import ModerationService
 from .handlers import router as app_router
+from .jobs import CleanJobManager
+from .webhook import ConcurrencyLimitMiddleware, run_webhook
+from .workers import ChatShardDispatcher, shutdown_parse_pool
 from .db import init_db
+from .repository import member_write_buffer
 
 
-# Настройка логирования
-logging.basicConfig(
-    stream=sys.stdout,
-    level=logging.DEBUG,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
-)
 logger = logging.getLogger(__name__)
 
 
@@ -23,22 +33,111 @@ class BotApp:
     def __init__(self):
 
         # Инициализация основных объектов бота
-        self.bot = Bot(token=settings.BOT_TOKEN)
+        bot_kwargs = {}
+        if settings.TELEGRAM_API_URL:
+            bot_kwargs["session"] = AiohttpSession(api=TelegramAPIServer.from_base(settings.TELEGRAM_API_URL))
+        self.bot = Bot(token=settings.BOT_TOKEN, **bot_kwargs)
         self.dp = Dispatcher()
-        self.moderation = ModerationService(self.bot)
+
+        # Все запросы к Bot API идут через общий планировщик
+        self.outbound = OutboundScheduler()
+        self.bot.session.middleware(OutboundMiddleware(self.outbound))
+        # Подключается вторым, поэтому меряет сам запрос без ожидания в очереди планировщика
+        self.bot.session.middleware(BotApiMetricsMiddleware())
+        self.moderation = ModerationService(self.bot, outbound=self.outbound)
+        member_write_buffer.on_resolved = self.moderation.on_identities_resolved
+        self.jobs = CleanJobManager(self.bot, self.moderation)
+        self.joins = JoinCoalescer(self.moderation)
+        self.autoclean = AutoCleanScheduler(self.moderation, jobs=self.jobs)
+        self.retention = ActionLogArchiver()
+        self.profiler = LoopProfiler()
+        # Активен один экземпляр из нескольких за прокси: состояние модерации живёт в памяти процесса
+        self.lease = InstanceLease()
+        self._stop: Optional[asyncio.Event] = None
         self.router = app_router
         self.dp.include_router(self.router)
 
+        # Апдейты обрабатываются воркерами по chat_id; без них в режиме webhook ограничиваем число одновременных
+        self.updates = None
+        self.update_limiter = None
+        if settings.UPDATE_WORKERS > 0:
+            self.updates = ChatShardDispatcher()
+            self.dp.update.outer_middleware(self.updates)
+        elif settings.BOT_MODE == "webhook":
+            self.update_limiter = ConcurrencyLimitMiddleware(settings.WEBHOOK_WORKERS)
+            self.dp.update.outer_middleware(self.update_limiter)
+        self._register_gauges()
+        self._metrics_runner = None
+
+    def _register_gauges(self) -> None:
+        queues = REGISTRY.gauge("queue_depth", "Items waiting in an in-process queue")
+        queues.set_function(self.outbound.qsize, queue="outbound")
+        queues.set_function(lambda: self.moderation.audit.qsize(), queue="audit")
+        queues.set_function(lambda: len(member_write_buffer), queue="member_buffer")
+        queues.set_function(self.joins.pending_total, queue="joins")
+        if self.updates is not None:
+            queues.set_function(self.updates.qsize, queue="updates")
+        if self.update_limiter is not None:
+            REGISTRY.gauge("updates_in_flight", "Updates being handled right now").set_function(
+                lambda: self.update_limiter.in_flight)
+        REGISTRY.gauge("bans_per_second", "Bans per second over the last minute").set_function(BAN_RATE.rate)
+        REGISTRY.gauge("allowlist_size", "Entries in the global allowlist index").set_function(
+            self.moderation.allowlist_size)
+        REGISTRY.gauge("presence_cache_entries", "Members held in the presence cache").set_function(
+            lambda: len(presence_cache))
+        REGISTRY.gauge("presence_cache_bytes", "Estimated memory held by the presence cache").set_function(
+            lambda: presence_cache.nbytes)
+        REGISTRY.gauge("allowlist_cache_bytes", "Memory held by cached allowlist indexes").set_function(
+            lambda: self.moderation.allowlist_cache_bytes)
+
+    def health(self) -> dict:
+        return {
+            "status": "ok",
+            "mode": settings.BOT_MODE,
+            "instance": self.lease.owner,
+            "updates_in_flight": self.update_limiter.in_flight if self.update_limiter else None,
+            "update_queue": self.updates.qsize() if self.updates else None,
+            "outbound_queue": self.outbound.qsize(),
+            "audit_queue": self.moderation.audit.qsize(),
+            "audit_spilled": self.moderation.audit.spilled,
+            "member_buffer": len(member_write_buffer),
+        }
+
+    # Polling до остановки сигналом или до потери аренды
+    async def _poll(self) -> None:
+        # chat_member Telegram присылает, только если запросить его явно.
+        # С воркерами апдейты принимаются по одному: так очередь чата получает их в порядке Telegram
+        polling = asyncio.create_task(self.dp.start_polling(
+            self.bot, allowed_updates=self.dp.resolve_used_update_types(), handle_as_tasks=self.updates is None))
+        stopped = asyncio.create_task(self._stop.wait())
+        try:
+            await asyncio.wait({polling, stopped}, return_when=asyncio.FIRST_COMPLETED)
+            if not polling.done():
+                await self.dp.stop_polling()
+            await polling
+        finally:
+            for task in (polling, stopped):
+                task.cancel()
+
     async def start(self):
 
         # Подготовка окружения
+        configure_slow_callbacks(asyncio.get_running_loop())
         await init_db()
 
+        # Резервный экземпляр ждёт здесь, не принимая апдейтов, пока активный не остановится.
+        # Потерявший аренду экземпляр останавливается, и перезапуск возвращает его в резерв
+        self._stop = asyncio.Event()
+        await self.lease.acquire()
+        self.lease.start(on_lost=self._stop.set)
+
         # Регистрация команд бота
         try:
             await self.bot.set_my_commands([
                 BotCommand(command="start", description="Запустить бота"),
-                BotCommand(command="clean", description="Проверить и удалить незнакомцев"),
+                BotCommand(command="clean", description="Проверить и удалить незнакомцев (status, cancel)"),
+                BotCommand(command="stats", description="Статистика банов за день, неделю и месяц"),
+                BotCommand(command="profile", description="Профиль бота за N секунд (slow — медленные обработчики)"),
             ])
             logger.info("Bot commands set")
         except Exception:
@@ -46,13 +145,66 @@ class BotApp:
 
         # Передача сервисов в обработчики
         setattr(self.router, "_moderation", self.moderation)
+        setattr(self.router, "_jobs", self.jobs)
+        setattr(self.router, "_joins", self.joins)
+        setattr(self.router, "_profiler", self.profiler)
+
+        # Фоновый сброс буфера участников
+        member_write_buffer.start()
+        if self.updates is not None:
+            self.updates.start()
+
+        # Продолжение очисток, прерванных перезапуском
+        try:
+            resumed = await self.jobs.resume()
+            if resumed:
+                logger.info("Resumed %d clean jobs", resumed)
+        except Exception:
+            logger.exception("Failed to resume clean jobs")
+
+        # Периодическая автоочистка известных чатов
+        self.autoclean.start()
+        # Архивация и удаление старых записей журнала
+        self.retention.start()
+
+        # Профиль первых секунд работы, если задан PROFILE_ON_START_SECONDS
+        if settings.PROFILE_ON_START_SECONDS > 0:
+            self.profiler.start(self.bot, settings.ADMIN_CHAT_ID, settings.PROFILE_ON_START_SECONDS)
 
-        # Настройка логов aiogram
-        logging.getLogger("aiogram").setLevel(logging.DEBUG)
+        if settings.METRICS_PORT:
+            try:
+                self._metrics_runner = await start_metrics_server(settings.METRICS_HOST, settings.METRICS_PORT)
+            except Exception:
+                logger.exception("Failed to start metrics server")
 
         # Запуск бота
         try:
-            logger.info("Запуск бота (polling)...")
-            await self.dp.start_polling(self.bot)
+            if settings.BOT_MODE == "webhook":
+                logger.info("Запуск бота (webhook)...")
+                await run_webhook(self.bot, self.dp, health=self.health, stop=self._stop)
+            else:
+                logger.info("Запуск бота (polling)...")
+                await self._poll()
         finally:
-            await self.bot.session.close()
\ No newline at end of file
+            if self.updates is not None:
+                await self.updates.close()
+            shutdown_parse_pool()
+            await self.autoclean.stop()
+            await self.retention.stop()
+            await self.profiler.close()
+            await self.joins.close()
+            await self.jobs.close()
+            try:
+                await member_write_buffer.stop()
+            except Exception:
+                logger.exception("Failed to flush member updates on shutdown")
+            await self.outbound.close()
+            try:
+                await self.moderation.audit.close()
+            except Exception:
+                logger.exception("Failed to flush audit log on shutdown")
+            # Аренду отдаём, когда всё записано: резервный экземпляр начнёт с актуальной БД
+            await self.lease.release()
+            if self._metrics_runner is not None:
+                await self._metrics_runner.cleanup()
+            await self.bot.session.close()
@@ -0,0 +1,89 @@
+import sys
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from .config import settings
+from .metrics import REGISTRY
+
+PRESENCE_HITS = REGISTRY.counter("presence_cache_hits_total", "Member writes skipped by the presence cache")
+PRESENCE_MISSES = REGISTRY.counter("presence_cache_misses_total", "Member writes that went to the write buffer")
+
+Key = Tuple[str, str]
+
+# Примерная цена записи кэша сверх самих строк: узел OrderedDict, кортежи ключа и значения, float
+_ENTRY_OVERHEAD = 200
+
+
+# Кэш присутствия: последний записанный в БД username по (chat_id, user_id).
+# Повторная запись не нужна, пока username тот же и не истёк TTL (тогда обновляем last_seen)
+class PresenceCache:
+    def __init__(self, ttl: float = settings.PRESENCE_TTL_SECONDS,
+                 max_bytes: int = int(settings.PRESENCE_CACHE_MB * 1024 * 1024),
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._entries: "OrderedDict[Key, Tuple[Optional[str], float, int]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def is_fresh(self, chat_id, user_id, username: Optional[str]) -> bool:
+        key = (str(chat_id), str(user_id))
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != username or entry[1] <= self.clock():
+            self.misses += 1
+            PRESENCE_MISSES.inc()
+            return False
+        self._entries.move_to_end(key)
+        self.hits += 1
+        PRESENCE_HITS.inc()
+        return True
+
+    def put(self, chat_id, user_id, username: Optional[str]) -> None:
+        key = (str(chat_id), str(user_id))
+        self._drop(key)
+        size = _ENTRY_OVERHEAD + sys.getsizeof(key[0]) + sys.getsizeof(key[1]) + sys.getsizeof(username)
+        self._entries[key] = (username, self.clock() + self.ttl, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._entries:
+            _, (_, _, old_size) = self._entries.popitem(last=False)
+            self._bytes -= old_size
+            self.evictions += 1
+
+    def put_many(self, batch: Dict[Key, Optional[str]]) -> None:
+        for (chat_id, user_id), username in batch.items():
+            self.put(chat_id, user_id, username)
+
+    def invalidate(self, chat_id, user_id) -> None:
+        self._drop((str(chat_id), str(user_id)))
+
+    def invalidate_chat(self, chat_id) -> None:
+        chat_id = str(chat_id)
+        for key in [k for k in self._entries if k[0] == chat_id]:
+            self._drop(key)
+
+    def invalidate_many(self, keys: Iterable[Key]) -> None:
+        for key in keys:
+            self._drop(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def _drop(self, key: Key) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+
+presence_cache = PresenceCache()
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from .config import settings
+from .logging_setup import SAMPLED
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+JOIN_BATCH_SIZE = REGISTRY.histogram(
+    "join_batch_size", "Number of joined users checked in one coalesced batch",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500),
+)
+JOIN_TO_BAN_SECONDS = REGISTRY.histogram(
+    "join_to_ban_seconds", "Time from receiving a join to finishing the ban of an unauthorized user",
+)
+
+
+# Склеивает входы в чат за короткое окно и проверяет их одной пачкой. Сами участники
+# записываются сразу через буфер записи, иначе отложенная запись «в чате» перетёрла бы выход,
+# пришедший внутри окна
+class JoinCoalescer:
+    def __init__(self, moderation, window: float = settings.JOIN_COALESCE_WINDOW_MS / 1000,
+                 max_batch: int = settings.JOIN_COALESCE_MAX_BATCH):
+        self.moderation = moderation
+        self.window = window
+        self.max_batch = max_batch
+        # chat_id -> user_id -> (username, время получения)
+        self._pending: Dict[int, Dict[int, Tuple[Optional[str], float]]] = {}
+        self._timers: Dict[int, asyncio.Task] = {}
+        self._flushes: Set[asyncio.Task] = set()
+
+    def pending(self, chat_id: int) -> int:
+        return len(self._pending.get(chat_id, {}))
+
+    def pending_total(self) -> int:
+        return sum(len(batch) for batch in self._pending.values())
+
+    def submit(self, chat_id: int, users: Iterable[Tuple[int, Optional[str]]]) -> None:
+        now = time.monotonic()
+        batch = self._pending.setdefault(chat_id, {})
+        for user_id, username in users:
+            received = batch[user_id][1] if user_id in batch else now
+            batch[user_id] = (username, received)
+
+        if len(batch) >= self.max_batch:
+            timer = self._timers.pop(chat_id, None)
+            if timer is not None:
+                timer.cancel()
+            self._spawn(self._safe_flush(chat_id))
+        elif chat_id not in self._timers:
+            self._timers[chat_id] = asyncio.create_task(self._flush_later(chat_id))
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush_later(self, chat_id: int) -> None:
+        await asyncio.sleep(self.window)
+        self._timers.pop(chat_id, None)
+        await self._safe_flush(chat_id)
+
+    async def _safe_flush(self, chat_id: int) -> None:
+        try:
+            await self.flush(chat_id)
+        except Exception:
+            logger.exception("Failed to process joins for chat %s", chat_id)
+
+    async def flush(self, chat_id: int) -> None:
+        batch = self._pending.pop(chat_id, None)
+        if not batch:
+            return
+        JOIN_BATCH_SIZE.observe(len(batch))
+        members = [{"id": user_id, "username": username} for user_id, (username, _) in batch.items()]
+        unauthorized = await self.moderation.filter_unauthorized(members, chat_id=chat_id)
+        logger.info("Join batch for chat %s: joined=%d unauthorized=%d", chat_id, len(batch), len(unauthorized),
+                    extra=SAMPLED)
+        if not unauthorized:
+            return
+        await self.moderation.ban_users(chat_id=chat_id, users=unauthorized)
+        done = time.monotonic()
+        for u in unauthorized:
+            entry = batch.get(u["id"])
+            if entry is not None:
+                JOIN_TO_BAN_SECONDS.observe(done - entry[1])
+
+    async def close(self) -> None:
+        for timer in list(self._timers.values()):
+            timer.cancel()
+        self._timers.clear()
+        for chat_id in list(self._pending):
+            await self._safe_flush(chat_id)
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
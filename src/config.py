@@ -17,8 +17,106 @@ class Settings:
         except Exception:
             ADMIN_CHAT_ID = None
 
+    # Режим получения апдейтов: polling или webhook
+    BOT_MODE: str = os.getenv("BOT_MODE", "polling").strip().lower()
+    WEBHOOK_URL: str = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+    WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/webhook").strip()
+    WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "").strip()
+    WEBHOOK_HOST: str = os.getenv("WEBHOOK_HOST", "0.0.0.0").strip()
+    WEBHOOK_PORT: int = int(os.getenv("WEBHOOK_PORT", "8080"))
+    WEBHOOK_WORKERS: int = int(os.getenv("WEBHOOK_WORKERS", "16"))
+    # Апдейты раскладываются по UPDATE_WORKERS очередям по chat_id: внутри чата порядок сохраняется,
+    # разные чаты не ждут друг друга. 0 — обрабатывать как раньше
+    UPDATE_WORKERS: int = int(os.getenv("UPDATE_WORKERS", "8"))
+    UPDATE_QUEUE_SIZE: int = int(os.getenv("UPDATE_QUEUE_SIZE", "100"))
+    # Сколько секунд при остановке ждать фоновые задачи (очереди, автоочистка, /clean), прежде чем отменить
+    SHUTDOWN_TIMEOUT: float = float(os.getenv("SHUTDOWN_TIMEOUT", "10"))
+    # Разбор больших файлов белого списка идёт в отдельных процессах (0 — в основном)
+    PARSE_WORKERS: int = int(os.getenv("PARSE_WORKERS", "2"))
+    PARSE_OFFLOAD_BYTES: int = int(os.getenv("PARSE_OFFLOAD_BYTES", str(256 * 1024)))
+    # Загрузка файла списка: до UPLOAD_SPOOL_BYTES в памяти, больше — во временном файле на диске
+    UPLOAD_SPOOL_BYTES: int = int(os.getenv("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+    # Свой адрес Bot API: локальный telegram-bot-api или подделка из benchmarks/fake_bot_api.py (пусто — api.telegram.org)
+    TELEGRAM_API_URL: str = os.getenv("TELEGRAM_API_URL", "").strip().rstrip("/")
+    HEALTH_PATH: str = os.getenv("HEALTH_PATH", "/healthz").strip()
+    # Активен один экземпляр: он держит аренду в БД и продлевает её каждые INSTANCE_LEASE_TTL/3 секунд.
+    # Остальные ждут в резерве и подхватывают работу, когда аренда истечёт. 0 — без аренды (один процесс)
+    INSTANCE_LEASE_TTL: float = float(os.getenv("INSTANCE_LEASE_TTL", "30"))
+
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./data/db.sqlite3").strip()
+    # Пул соединений PostgreSQL (postgresql+asyncpg://...)
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    DB_POOL_TIMEOUT: float = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    # Профиль SQLite, применяется к каждому новому соединению
+    SQLITE_POOL_SIZE: int = int(os.getenv("SQLITE_POOL_SIZE", "5"))
+    SQLITE_JOURNAL_MODE: str = os.getenv("SQLITE_JOURNAL_MODE", "WAL").strip()
+    SQLITE_SYNCHRONOUS: str = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").strip()
+    SQLITE_BUSY_TIMEOUT_MS: int = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    SQLITE_CACHE_SIZE_KB: int = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+    SQLITE_MMAP_SIZE: int = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
     CHECK_INTERVAL_SECONDS: int = int(os.getenv("CHECK_INTERVAL_SECONDS", "3600"))
     AUTO_CLEAN_FORCE: bool = os.getenv("AUTO_CLEAN_FORCE", "false").lower() in ("1","true","yes")
+    # Склейка входов в чат: события копятся окно JOIN_COALESCE_WINDOW_MS и проверяются одной пачкой
+    JOIN_COALESCE_WINDOW_MS: int = int(os.getenv("JOIN_COALESCE_WINDOW_MS", "150"))
+    JOIN_COALESCE_MAX_BATCH: int = int(os.getenv("JOIN_COALESCE_MAX_BATCH", "200"))
+    # Белые списки по чатам: общий список ("*") дополняет список чата; кэш индексов ограничен по памяти
+    ALLOWLIST_GLOBAL_FALLBACK: bool = os.getenv("ALLOWLIST_GLOBAL_FALLBACK", "true").lower() in ("1","true","yes")
+    ALLOWLIST_CACHE_MB: float = float(os.getenv("ALLOWLIST_CACHE_MB", "64"))
+    # Логи: уровни, формат (json или text), доля записей по каждому сообщению и окно подавления повторов ошибок
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO").strip()
+    LOG_AIOGRAM_LEVEL: str = os.getenv("LOG_AIOGRAM_LEVEL", "WARNING").strip()
+    LOG_FORMAT: str = os.getenv("LOG_FORMAT", "json").strip().lower()
+    LOG_SAMPLE_RATE: float = float(os.getenv("LOG_SAMPLE_RATE", "0.05"))
+    LOG_REPEAT_WINDOW: float = float(os.getenv("LOG_REPEAT_WINDOW", "60"))
+    # Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (0 — выключено)
+    METRICS_HOST: str = os.getenv("METRICS_HOST", "127.0.0.1").strip()
+    METRICS_PORT: int = int(os.getenv("METRICS_PORT", "9108"))
+    # Сколько чатов автоочистка обрабатывает одновременно
+    AUTO_CLEAN_CONCURRENCY: int = int(os.getenv("AUTO_CLEAN_CONCURRENCY", "4"))
+
+    # Отложенная запись участников: сброс по размеру буфера или по таймеру
+    MEMBER_FLUSH_SIZE: int = int(os.getenv("MEMBER_FLUSH_SIZE", "500"))
+    MEMBER_FLUSH_INTERVAL: float = float(os.getenv("MEMBER_FLUSH_INTERVAL", "1.0"))
+
+    # Кэш присутствия: повторная запись участника с тем же username не раньше чем через PRESENCE_TTL_SECONDS
+    PRESENCE_TTL_SECONDS: float = float(os.getenv("PRESENCE_TTL_SECONDS", "600"))
+    PRESENCE_CACHE_MB: float = float(os.getenv("PRESENCE_CACHE_MB", "32"))
+
+    # Исходящие запросы к Bot API: лимиты Telegram (30 в секунду на бота, 20 в минуту на группу; личные чаты — только общий лимит)
+    OUTBOUND_CONCURRENCY: int = int(os.getenv("OUTBOUND_CONCURRENCY", "8"))
+    OUTBOUND_GLOBAL_RATE: float = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+    OUTBOUND_CHAT_RATE_PER_MINUTE: float = float(os.getenv("OUTBOUND_CHAT_RATE_PER_MINUTE", "20"))
+    OUTBOUND_MAX_RETRIES: int = int(os.getenv("OUTBOUND_MAX_RETRIES", "5"))
+
+    # Журнал действий пишется в фоне пачками; при переполнении очереди запись ждёт
+    AUDIT_QUEUE_SIZE: int = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+    AUDIT_BATCH_SIZE: int = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+    # Пачки, которые БД не приняла, дописываются в этот файл (JSONL) и возвращаются в БД, когда она оживёт.
+    # Пусто — такие пачки теряются
+    AUDIT_SPILL_PATH: str = os.getenv("AUDIT_SPILL_PATH", "./data/audit_spill.jsonl").strip()
+    # Хранение журнала: старше AUDIT_RETENTION_DAYS дней (0 — хранить всё) архивируется в AUDIT_ARCHIVE_DIR
+    # (.jsonl.gz; пусто — удалять без архива) порциями по AUDIT_ARCHIVE_BATCH раз в AUDIT_RETENTION_INTERVAL секунд
+    AUDIT_RETENTION_DAYS: int = int(os.getenv("AUDIT_RETENTION_DAYS", "90"))
+    AUDIT_ARCHIVE_DIR: str = os.getenv("AUDIT_ARCHIVE_DIR", "./data/archive").strip()
+    AUDIT_ARCHIVE_BATCH: int = int(os.getenv("AUDIT_ARCHIVE_BATCH", "5000"))
+    AUDIT_RETENTION_INTERVAL: float = float(os.getenv("AUDIT_RETENTION_INTERVAL", "3600"))
+
+    # Фоновые задачи /clean: размер порции между сохранениями курсора и частота обновления прогресса
+    CLEAN_CHUNK_SIZE: int = int(os.getenv("CLEAN_CHUNK_SIZE", "200"))
+    CLEAN_PROGRESS_INTERVAL: float = float(os.getenv("CLEAN_PROGRESS_INTERVAL", "5"))
+
+    # Профилирование: /profile N снимает cProfile цикла событий на N секунд (не больше PROFILE_MAX_SECONDS),
+    # PROFILE_ON_START_SECONDS > 0 — то же сразу после запуска. Отчёт сохраняется в PROFILE_DIR и уходит админу
+    PROFILE_MAX_SECONDS: int = int(os.getenv("PROFILE_MAX_SECONDS", "120"))
+    PROFILE_ON_START_SECONDS: int = int(os.getenv("PROFILE_ON_START_SECONDS", "0"))
+    PROFILE_DIR: str = os.getenv("PROFILE_DIR", "./data/profiles").strip()
+    PROFILE_TOP: int = int(os.getenv("PROFILE_TOP", "40"))
+    # Предупреждения asyncio о колбэках дольше ASYNCIO_SLOW_CALLBACK_MS (0 — выключено; включает debug-режим цикла)
+    ASYNCIO_SLOW_CALLBACK_MS: float = float(os.getenv("ASYNCIO_SLOW_CALLBACK_MS", "0"))
+    # Вызовы обработчиков дольше SLOW_HANDLER_MS — в кольцевом буфере из SLOW_HANDLER_BUFFER записей (/profile slow)
+    SLOW_HANDLER_MS: float = float(os.getenv("SLOW_HANDLER_MS", "200"))
+    SLOW_HANDLER_BUFFER: int = int(os.getenv("SLOW_HANDLER_BUFFER", "100"))
 
 settings = Settings()
\ No newline at end of file
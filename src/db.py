@@ -1,7 +1,20 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+import re
+import time
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from pathlib import Path
 from .config import settings
+from .metrics import REGISTRY
+
+DB_STATEMENT_SECONDS = REGISTRY.histogram(
+    "db_statement_seconds", "Time spent executing one SQL statement",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+DB_STATEMENT_ERRORS = REGISTRY.counter("db_statement_errors_total", "SQL statements that raised an error")
 
 def ensure_sqlite_dir(db_url: str):
     if db_url.startswith("sqlite"):
@@ -13,12 +26,136 @@ def ensure_sqlite_dir(db_url: str):
             if not parent.exists():
                 parent.mkdir(parents=True, exist_ok=True)
 
-ensure_sqlite_dir(settings.DATABASE_URL)
 
-engine = create_async_engine(settings.DATABASE_URL, echo=False, future=True)
-AsyncSessionLocal = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+def _is_memory_sqlite(db_url: str) -> bool:
+    return ":memory:" in db_url or db_url.rstrip("/").endswith("sqlite+aiosqlite:")
+
+
+# Профиль SQLite: WAL, мягкий fsync, ожидание блокировки вместо ошибки, большой кэш и mmap
+def _sqlite_pragmas() -> list:
+    return [
+        f"journal_mode={settings.SQLITE_JOURNAL_MODE}",
+        f"synchronous={settings.SQLITE_SYNCHRONOUS}",
+        f"busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}",
+        f"cache_size=-{settings.SQLITE_CACHE_SIZE_KB}",
+        f"mmap_size={settings.SQLITE_MMAP_SIZE}",
+        "temp_store=MEMORY",
+    ]
+
+
+def _on_sqlite_connect(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in _sqlite_pragmas():
+            cursor.execute(f"PRAGMA {pragma}")
+    finally:
+        cursor.close()
+
+
+_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+"?(\w+)', re.IGNORECASE)
+
+
+# Метка запроса — операция и таблица, а не весь текст, чтобы число рядов метрики оставалось ограниченным
+def statement_label(statement: str) -> str:
+    words = statement.split(None, 1)
+    if not words:
+        return "other"
+    op = words[0].upper()
+    m = _TABLE_RE.search(statement)
+    return f"{op} {m.group(1).lower()}" if m else op
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    DB_STATEMENT_SECONDS.observe(time.perf_counter() - started, statement=statement_label(statement))
+
+
+def _on_statement_error(context):
+    stack = context.connection.info.get("query_started") if context.connection is not None else None
+    if stack:
+        stack.pop()
+    DB_STATEMENT_ERRORS.inc(statement=statement_label(context.statement or ""))
+
+
+def _instrument(new_engine: AsyncEngine) -> AsyncEngine:
+    sync_engine = new_engine.sync_engine
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(sync_engine, "handle_error", _on_statement_error)
+    return new_engine
+
+
+def build_engine(db_url: str) -> AsyncEngine:
+    if db_url.startswith("sqlite"):
+        ensure_sqlite_dir(db_url)
+        kwargs = {}
+        if not _is_memory_sqlite(db_url):
+            # Держим соединения открытыми, чтобы не платить за открытие файла и PRAGMA на каждый запрос
+            kwargs.update(poolclass=AsyncAdaptedQueuePool, pool_size=settings.SQLITE_POOL_SIZE, max_overflow=0,
+                          pool_timeout=settings.DB_POOL_TIMEOUT)
+        new_engine = create_async_engine(db_url, echo=False, future=True, **kwargs)
+        event.listen(new_engine.sync_engine, "connect", _on_sqlite_connect)
+        return _instrument(new_engine)
+
+    return _instrument(create_async_engine(
+        db_url,
+        echo=False,
+        future=True,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    ))
+
+
+_engine: Optional[AsyncEngine] = None
+_sessionmaker: Optional[sessionmaker] = None
+
+
+# Движок создаётся при первом обращении, а не при импорте модуля
+def get_engine() -> AsyncEngine:
+    global _engine, _sessionmaker
+    if _engine is None:
+        _engine = build_engine(settings.DATABASE_URL)
+        _sessionmaker = sessionmaker(_engine, expire_on_commit=False, class_=AsyncSession)
+    return _engine
+
+
+async def configure_engine(db_url: str) -> AsyncEngine:
+    global _engine, _sessionmaker
+    old = _engine
+    _engine = build_engine(db_url)
+    _sessionmaker = sessionmaker(_engine, expire_on_commit=False, class_=AsyncSession)
+    if old is not None:
+        await old.dispose()
+    return _engine
+
+
+async def dispose_engine() -> None:
+    if _engine is not None:
+        await _engine.dispose()
+
+
+def AsyncSessionLocal(**kwargs) -> AsyncSession:
+    get_engine()
+    return _sessionmaker(**kwargs)
+
+
+def __getattr__(name: str):
+    # Совместимость со старым `from .db import engine`
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 async def init_db():
     from .models import Base
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+    from .migrations import run_migrations
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await run_migrations(conn)
@@ -1,16 +1,25 @@
 import logging
 from typing import List
-from io import BytesIO
 
 from aiogram import types
 from aiogram import Router
 from aiogram.filters import Command, CommandStart
 
+from .audit import format_stats
 from .config import settings
+from .ingest import UploadSpool
+from .instrumentation import HandlerLatencyMiddleware
+from .jobs import format_job
+from .logging_setup import SAMPLED
+from .models import MEMBER_KICKED, MEMBER_LEFT, MEMBER_PRESENT
+from .profiling import format_slow_handlers, slow_handlers
 from .repository import MemberRepository
 
 logger = logging.getLogger(__name__)
 router = Router()
+router.message.middleware(HandlerLatencyMiddleware())
+router.chat_member.middleware(HandlerLatencyMiddleware())
+router.my_chat_member.middleware(HandlerLatencyMiddleware())
 member_repo = MemberRepository()
 
 
@@ -19,70 +28,178 @@ member_repo = MemberRepository()
 async def cmd_start(message: types.Message):
     await message.answer(
         "Привет! В личке пришлите .txt со списком разрешённых (по одному в строке). "
-        "В группе используйте команду /clean."
+        "Чтобы задать список для конкретной группы, укажите её id в подписи к файлу "
+        "или пришлите файл прямо в группу. В группе используйте команду /clean."
     )
 
 
+# Состояние участника по ChatMember: restricted может быть как в чате, так и вне его
+def member_state(chat_member) -> str:
+    status = getattr(chat_member, "status", None)
+    if status in ("creator", "administrator", "member"):
+        return MEMBER_PRESENT
+    if status == "restricted":
+        return MEMBER_PRESENT if getattr(chat_member, "is_member", False) else MEMBER_LEFT
+    if status == "kicked":
+        return MEMBER_KICKED
+    return MEMBER_LEFT
+
+
+# Вход, выход и бан участников (приходит, только если бот — админ группы)
+@router.chat_member()
+async def on_chat_member(event: types.ChatMemberUpdated):
+    user = event.new_chat_member.user
+    state = member_state(event.new_chat_member)
+    logger.info("CHAT_MEMBER: chat=%s user=%s state=%s", event.chat.id, user.id, state, extra=SAMPLED)
+    await member_repo.set_status(chat_id=str(event.chat.id), user_id=str(user.id), status=state,
+                                 username=user.username if state == MEMBER_PRESENT else None)
+
+
+# Бота добавили в группу или удалили из неё
+@router.my_chat_member()
+async def on_my_chat_member(event: types.ChatMemberUpdated):
+    state = member_state(event.new_chat_member)
+    logger.info("Bot membership changed: chat=%s status=%s", event.chat.id, event.new_chat_member.status)
+    if state != MEMBER_PRESENT:
+        # Состав чата больше не виден; при возвращении он наполнится заново
+        marked = await member_repo.mark_chat_left(str(event.chat.id))
+        logger.info("Bot left chat %s: %d members marked as left", event.chat.id, marked)
+
+
+# Является ли пользователь админом чата по данным Telegram
+async def _is_chat_admin(bot, chat_id: str, user_id) -> bool:
+    try:
+        member = await bot.get_chat_member(int(chat_id), user_id)
+    except Exception as e:
+        logger.warning("Cannot check admin rights: chat=%s user=%s: %s", chat_id, user_id, e)
+        return False
+    return getattr(member, "status", None) in ("creator", "administrator")
+
+
+# Какой список меняет загруженный файл: в группе — список этой группы,
+# в личке — чата из подписи к файлу (id), без подписи — общий. False — нет прав.
+# Менять список чата может только его админ (и только ADMIN_CHAT_ID, если он задан);
+# в личке файл принимается только от ADMIN_CHAT_ID
+async def _allowlist_target(message: types.Message):
+    user_id = getattr(message.from_user, "id", None)
+    if message.chat and message.chat.type in ("group", "supergroup"):
+        if settings.ADMIN_CHAT_ID and user_id != settings.ADMIN_CHAT_ID:
+            return False
+        if not await _is_chat_admin(message.bot, message.chat.id, user_id):
+            return False
+        return str(message.chat.id)
+    if not settings.ADMIN_CHAT_ID or user_id != settings.ADMIN_CHAT_ID:
+        return False
+    caption = (message.caption or "").strip()
+    if caption and caption.split()[0].lstrip("-").isdigit():
+        chat_id = caption.split()[0]
+        if not await _is_chat_admin(message.bot, chat_id, user_id):
+            return False
+        return chat_id
+    return None
+
+
+_ALLOWLIST_MIME_TYPES = (
+    "text/plain", "application/octet-stream", "text/csv", "text/comma-separated-values",
+    "application/gzip", "application/x-gzip", "application/zip", "application/x-zip-compressed",
+)
+_ALLOWLIST_SUFFIXES = (".txt", ".csv", ".gz", ".zip")
+
+
+def _is_allowlist_document(doc: types.Document) -> bool:
+    return doc.mime_type in _ALLOWLIST_MIME_TYPES or (doc.file_name or "").lower().endswith(_ALLOWLIST_SUFFIXES)
+
+
 # Обработчик всех сообщений
 @router.message()
 async def universal_logger_and_handlers(message: types.Message):
-    # Логирование всех входящих сообщений и апдейтов
+    # Выборочное логирование входящих сообщений: без текста, только размеры
     logger.info(
-        "INCOMING: update_id=%s chat_id=%s chat_type=%s from=%s text=%s new_members=%s",
+        "INCOMING: message_id=%s chat_id=%s chat_type=%s from=%s text_len=%d new_members=%d",
         getattr(message, "message_id", None),
         message.chat.id if message.chat else None,
         message.chat.type if message.chat else None,
         getattr(message.from_user, "id", None),
-        getattr(message, "text", None),
-        [u.id for u in (message.new_chat_members or [])] if message.new_chat_members else None
+        len(message.text or ""),
+        len(message.new_chat_members or []),
+        extra=SAMPLED,
     )
 
     # Обработка документов
     if message.document:
         doc: types.Document = message.document
-        if doc.mime_type in ("text/plain", "application/octet-stream", "text/csv"):
-            try:
-                bot_client = message.bot
-                file_obj = await bot_client.get_file(doc.file_id)
-                bio = BytesIO()
-                await bot_client.download_file(file_obj.file_path, destination=bio)
-                bio.seek(0)
-                content = bio.read()
-
-                moderation = getattr(router, "_moderation", None)
-                if moderation is None:
-                    await message.answer("Сервис модерации не настроен.")
-                    return
+        if not _is_allowlist_document(doc):
+            # Обычные файлы в группах адресованы не боту
+            if message.chat.type == "private":
+                await message.answer("Пожалуйста, пришлите файл со списком разрешённых: .txt, .csv, .gz или .zip.")
+            return
+        scope = await _allowlist_target(message)
+        if scope is False:
+            await message.answer("Только админ может менять белый список.")
+            return
+        try:
+            moderation = getattr(router, "_moderation", None)
+            if moderation is None:
+                await message.answer("Сервис модерации не настроен.")
+                return
+
+            target = "общий" if scope is None else f"чата {scope}"
+            # Тот же файл, что и в прошлый раз, даже не скачиваем
+            if await moderation.is_last_import(scope, file_unique_id=doc.file_unique_id):
+                await message.answer(f"Этот файл уже загружен, список ({target}) не изменён.")
+                return
 
-                count = await moderation.load_allowed_from_bytes(content)
-                await message.answer(f"Список разрешенных пользователей обновлен: {count} записей.")
-                logger.info("Allowed list updated: %d records (by %s)", count, message.from_user.id)
-            except Exception as e:
-                logger.exception("Ошибка при обработке документа: %s", e)
-                await message.answer(f"Не удалось обработать файл: {e}")
-        else:
-            await message.answer("Пожалуйста, пришлите .txt файл со списком разрешённых.")
+            bot_client = message.bot
+            file_obj = await bot_client.get_file(doc.file_id)
+            with UploadSpool() as upload:
+                await bot_client.download_file(file_obj.file_path, destination=upload)
+                res = await moderation.load_allowed_from_upload(upload, chat_id=scope,
+                                                                file_unique_id=doc.file_unique_id,
+                                                                filename=doc.file_name)
+            if res.get("skipped"):
+                await message.answer(f"Содержимое совпадает с прошлой загрузкой, список ({target}) не изменён.")
+                return
+            await message.answer(
+                f"Список разрешенных пользователей ({target}) обновлен: {res['total']} записей "
+                f"(добавлено: {res['added']}, удалено: {res['removed']}, без изменений: {res['unchanged']})."
+            )
+            logger.info("Allowed list updated: scope=%s %d records (by %s)", scope or "*", res["total"],
+                        message.from_user.id)
+        except Exception as e:
+            logger.exception("Ошибка при обработке документа: %s", e)
+            await message.answer(f"Не удалось обработать файл: {e}")
         return
 
     # Обработка новых участников в чате
     new_members: List[types.User] = message.new_chat_members or []
     if new_members:
+        coalescer = getattr(router, "_joins", None)
         for u in new_members:
-            logger.info("NEW_MEMBER: id=%s username=%s chat=%s", u.id, u.username, message.chat.id)
-            await member_repo.upsert_member(chat_id=str(message.chat.id), user_id=str(u.id), username=u.username)
+            logger.info("NEW_MEMBER: id=%s chat=%s", u.id, message.chat.id, extra=SAMPLED)
+            # Вход пишется сразу, в общем порядке с выходами; склеиваются только проверка и бан
+            await member_repo.queue_upsert(chat_id=str(message.chat.id), user_id=str(u.id), username=u.username)
 
         moderation = getattr(router, "_moderation", None)
-        if moderation:
+        if coalescer is not None:
+            # Проверка и бан выполняются пачкой по чату после короткого окна
+            coalescer.submit(message.chat.id, [(u.id, u.username) for u in new_members])
+        elif moderation:
             members_for_check = [{"id": u.id, "username": u.username} for u in new_members]
-            unauthorized = await moderation.filter_unauthorized(members_for_check)
+            unauthorized = await moderation.filter_unauthorized(members_for_check, chat_id=message.chat.id)
             if unauthorized:
                 await moderation.ban_users(chat_id=message.chat.id, users=unauthorized)
 
+    # Служебное сообщение о выходе: автора (часто это сам ушедший) не записываем как присутствующего
+    left = getattr(message, "left_chat_member", None)
+    if left is not None:
+        await member_repo.set_status(chat_id=str(message.chat.id), user_id=str(left.id), status=MEMBER_LEFT)
+        return
+
     # Обновление базы участников при любом сообщении в группе
     if message.chat and message.chat.type in ("group", "supergroup"):
         user = message.from_user
         if user:
-            await member_repo.upsert_member(chat_id=str(message.chat.id), user_id=str(user.id), username=user.username)
+            await member_repo.queue_upsert(chat_id=str(message.chat.id), user_id=str(user.id), username=user.username)
 # Обработка команды /clean
     text = (message.text or "").strip()
     if text:
@@ -96,6 +213,30 @@ async def universal_logger_and_handlers(message: types.Message):
                 await message.answer("Только админ может запускать /clean.")
                 return
 
+            jobs = getattr(router, "_jobs", None)
+            args = text.split()[1:]
+            sub = args[0].lower() if args else ""
+            if sub in ("status", "cancel"):
+                if jobs is None:
+                    await message.answer("Фоновые очистки не настроены.")
+                    return
+                if sub == "status":
+                    job = await jobs.status(message.chat.id)
+                    await message.answer(format_job(job) if job else "В этом чате ещё не было очисток.")
+                else:
+                    job = await jobs.cancel(message.chat.id)
+                    await message.answer(f"Очистка #{job.id} отменена." if job else "Активной очистки нет.")
+                return
+
+            if jobs is not None:
+                active = await jobs.active(message.chat.id)
+                if active is not None:
+                    await message.answer(f"Очистка уже идёт.\n{format_job(active)}")
+                    return
+                progress = await message.answer("Запускаю очистку... (проверяю известных участников)")
+                await jobs.enqueue(message.chat.id, progress_message_id=getattr(progress, "message_id", None))
+                return
+
             await message.answer("Запускаю очистку... (проверяю известных участников)")
             moderation = getattr(router, "_moderation", None)
             if moderation is None:
@@ -106,4 +247,49 @@ async def universal_logger_and_handlers(message: types.Message):
             await message.answer(f"Проверено: {res['checked']}. Найдено: {res['to_ban']}. Забанено: {res['banned']}.")
             return
 
+        # Обработка команды /stats: готовые счётчики по дням, журнал не сканируется
+        if lower.startswith("/stats"):
+            if message.chat.type not in ("group", "supergroup"):
+                await message.answer("Команда /stats работает только в группе.")
+                return
+
+            if settings.ADMIN_CHAT_ID and message.from_user.id != settings.ADMIN_CHAT_ID:
+                await message.answer("Только админ может смотреть /stats.")
+                return
+
+            moderation = getattr(router, "_moderation", None)
+            if moderation is None:
+                await message.answer("Сервис модерации не доступен.")
+                return
+
+            totals = await moderation.audit.stats(str(message.chat.id))
+            await message.answer(format_stats(totals))
+            return
+
+        # Обработка команды /profile [секунды | slow]: только админ, работает и в личке
+        if lower.startswith("/profile"):
+            if not settings.ADMIN_CHAT_ID or message.from_user.id != settings.ADMIN_CHAT_ID:
+                await message.answer("Только админ может снимать профиль.")
+                return
+
+            args = text.split()[1:]
+            if args and args[0].lower() == "slow":
+                await message.answer(format_slow_handlers(slow_handlers.slowest()))
+                return
+
+            profiler = getattr(router, "_profiler", None)
+            if profiler is None:
+                await message.answer("Профилирование не настроено.")
+                return
+            try:
+                seconds = profiler.clamp(float(args[0]) if args else 10)
+            except ValueError:
+                await message.answer("Использование: /profile [секунды] или /profile slow")
+                return
+            if not profiler.start(message.bot, message.chat.id, seconds):
+                await message.answer("Профиль уже снимается, дождитесь результата.")
+                return
+            await message.answer(f"Снимаю профиль цикла событий {seconds:g} с, пришлю файл.")
+            return
+
     return
\ No newline at end of file
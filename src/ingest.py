@@ -0,0 +1,60 @@
+import hashlib
+import io
+import os
+import tempfile
+from typing import BinaryIO, Optional
+
+from .config import settings
+
+
+# Приёмник загрузки для bot.download_file: до max_size держит файл в памяти, дальше пишет во временный файл
+# на диске. Попутно считает sha256, чтобы повторную загрузку можно было узнать без разбора
+class UploadSpool:
+    def __init__(self, max_size: int = settings.UPLOAD_SPOOL_BYTES):
+        self.max_size = max_size
+        self.size = 0
+        self.path: Optional[str] = None
+        self._file: BinaryIO = io.BytesIO()
+        self._hash = hashlib.sha256()
+
+    @property
+    def file(self) -> BinaryIO:
+        return self._file
+
+    def write(self, chunk: bytes) -> int:
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        if self.path is None and self.size > self.max_size:
+            self._rollover()
+        return self._file.write(chunk)
+
+    def _rollover(self) -> None:
+        fd, path = tempfile.mkstemp(prefix="allowlist-")
+        disk = os.fdopen(fd, "w+b")
+        disk.write(self._file.getvalue())
+        self._file = disk
+        self.path = path
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._file.seek(offset, whence)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def close(self) -> None:
+        self._file.close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+    def __enter__(self) -> "UploadSpool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,66 @@
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+from .metrics import REGISTRY, RateMeter
+from .profiling import slow_handlers
+
+HANDLER_SECONDS = REGISTRY.histogram("handler_seconds", "Time spent in an aiogram handler")
+HANDLER_ERRORS = REGISTRY.counter("handler_errors_total", "Handler calls that raised an exception")
+BOT_API_SECONDS = REGISTRY.histogram("bot_api_seconds", "Bot API call latency, without time queued in the scheduler")
+BOT_API_ERRORS = REGISTRY.counter("bot_api_errors_total", "Bot API calls that failed, by method and error type")
+BANS_TOTAL = REGISTRY.counter("bans_total", "Users banned")
+
+# Скорость банов за последнюю минуту, отдаётся как gauge bans_per_second
+BAN_RATE = RateMeter(window=60.0)
+
+_CAMEL_RE = re.compile(r"(?<!^)(?=[A-Z])")
+
+
+def api_method_name(method: Any) -> str:
+    name = getattr(method, "__api_method__", None) or type(method).__name__
+    return _CAMEL_RE.sub("_", name).lower()
+
+
+def record_ban(n: int = 1) -> None:
+    BANS_TOTAL.inc(n)
+    BAN_RATE.mark(n)
+
+
+# Время работы обработчиков роутера; подключается как внутренний middleware, где известен сам обработчик
+class HandlerLatencyMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any,
+                       data: Dict[str, Any]) -> Any:
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(handler=name, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_SECONDS.observe(elapsed, handler=name)
+            if elapsed >= slow_handlers.threshold:
+                update = data.get("event_update")
+                chat = data.get("event_chat")
+                slow_handlers.record(elapsed, name, update_type=getattr(update, "event_type", None),
+                                     chat_id=getattr(chat, "id", None))
+
+
+# Задержка и ошибки вызовов Bot API. Подключается после OutboundMiddleware и поэтому меряет сам запрос
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = api_method_name(method)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            BOT_API_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - started, method=name)
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+
+from .background import stop_tasks
+from .config import settings
+from .models import CleanJob
+from .repository import CleanJobRepository
+
+logger = logging.getLogger(__name__)
+
+_STATUS_TITLES = {
+    "pending": "в очереди",
+    "running": "выполняется",
+    "done": "завершена",
+    "cancelled": "отменена",
+    "failed": "ошибка",
+}
+
+
+def _format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds} с"
+
+
+def format_job(job: CleanJob, rate: Optional[float] = None) -> str:
+    total = max(job.total or 0, job.checked or 0)
+    lines = [
+        f"Очистка #{job.id}: {_STATUS_TITLES.get(job.status, job.status)}.",
+        f"Проверено: {job.checked} из {total}. Найдено: {job.to_ban}. Забанено: {job.banned}.",
+    ]
+    if rate:
+        lines.append(f"Скорость: {rate:.1f} уч./с, осталось ~{_format_eta((total - job.checked) / rate)}.")
+    if job.error:
+        lines.append(f"Ошибка: {job.error}")
+    return "\n".join(lines)
+
+
+# Фоновые задачи /clean: идут порциями и сохраняют курсор после каждой, поэтому переживают перезапуск
+class CleanJobManager:
+    def __init__(self, bot: Bot, moderation, repo: Optional[CleanJobRepository] = None,
+                 chunk_size: int = settings.CLEAN_CHUNK_SIZE,
+                 progress_interval: float = settings.CLEAN_PROGRESS_INTERVAL):
+        self.bot = bot
+        self.moderation = moderation
+        self.repo = repo if repo is not None else CleanJobRepository()
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._cancelled: set = set()
+        self._stopping = asyncio.Event()
+
+    @property
+    def member_repo(self):
+        return self.moderation.member_repo
+
+    async def active(self, chat_id) -> Optional[CleanJob]:
+        return await self.repo.get_active(str(chat_id))
+
+    async def status(self, chat_id) -> Optional[CleanJob]:
+        return await self.repo.latest(str(chat_id))
+
+    async def enqueue(self, chat_id, progress_message_id: Optional[int] = None) -> Tuple[CleanJob, bool]:
+        active = await self.repo.get_active(str(chat_id))
+        if active is not None:
+            self._start(active)
+            return active, False
+        # Всё, что ещё лежит в буфере записи, должно попасть в выборку
+        await self.member_repo.flush()
+        total = await self.member_repo.count_members(str(chat_id))
+        job = await self.repo.create(str(chat_id), total)
+        if progress_message_id is not None:
+            job.progress_message_id = progress_message_id
+            await self.repo.update(job.id, progress_message_id=progress_message_id)
+        logger.info("Clean job #%d queued for chat %s: total=%d", job.id, chat_id, total)
+        self._start(job)
+        return job, True
+
+    async def cancel(self, chat_id) -> Optional[CleanJob]:
+        job = await self.repo.get_active(str(chat_id))
+        if job is None:
+            return None
+        # Задача могла завершиться между чтением и отменой: итог не перетираем
+        if not await self.repo.transition(job.id, "cancelled"):
+            return None
+        self._cancelled.add(job.id)
+        job.status = "cancelled"
+        logger.info("Clean job #%d cancelled for chat %s", job.id, chat_id)
+        return job
+
+    async def resume(self) -> int:
+        jobs = await self.repo.list_resumable()
+        for job in jobs:
+            logger.info("Resuming clean job #%d for chat %s from cursor %s", job.id, job.chat_id, job.cursor)
+            self._start(job)
+        return len(jobs)
+
+    def _start(self, job: CleanJob) -> None:
+        task = self._tasks.get(job.id)
+        if task is not None and not task.done():
+            return
+        task = asyncio.create_task(self._run(job))
+        self._tasks[job.id] = task
+        task.add_done_callback(lambda t, job_id=job.id: self._tasks.pop(job_id, None))
+
+    async def wait(self, job_id: int) -> None:
+        task = self._tasks.get(job_id)
+        if task is not None:
+            await task
+
+    async def _run(self, job: CleanJob) -> None:
+        if not await self.repo.transition(job.id, "running"):
+            # Задачу отменили раньше, чем она началась
+            self._cancelled.discard(job.id)
+            return
+        job.status = "running"
+        started = time.monotonic()
+        last_report = started
+        processed = 0
+        try:
+            while job.id not in self._cancelled:
+                if self._stopping.is_set():
+                    # Процесс останавливается: задача остаётся running и продолжится с курсора после перезапуска
+                    logger.info("Clean job #%d paused at cursor %s for shutdown", job.id, job.cursor)
+                    return
+                page = await self.member_repo.list_members_page(job.chat_id, after_id=job.cursor,
+                                                                limit=self.chunk_size)
+                if not page:
+                    job.status = "done"
+                    break
+                to_ban = await self.moderation.select_candidates(page, chat_id=job.chat_id)
+                banned = await self.moderation.ban_users(chat_id=int(job.chat_id), users=to_ban) if to_ban else 0
+                job.cursor = page[-1]["id"]
+                job.checked += len(page)
+                job.to_ban += len(to_ban)
+                job.banned += banned
+                job.total = max(job.total or 0, job.checked)
+                processed += len(page)
+                await self.repo.checkpoint(job)
+
+                now = time.monotonic()
+                if now - last_report >= self.progress_interval:
+                    last_report = now
+                    await self._report(job, processed / max(now - started, 1e-6))
+            else:
+                job.status = "cancelled"
+        except asyncio.CancelledError:
+            # Остановка не дождалась конца порции: курсор на последней сохранённой
+            raise
+        except Exception as e:
+            logger.exception("Clean job #%d failed", job.id)
+            job.status = "failed"
+            job.error = str(e)
+            await self.repo.transition(job.id, "failed", error=str(e))
+        else:
+            await self.repo.transition(job.id, job.status)
+        finally:
+            self._cancelled.discard(job.id)
+
+        logger.info("Clean job #%d finished with status=%s: checked=%d to_ban=%d banned=%d",
+                    job.id, job.status, job.checked, job.to_ban, job.banned)
+        await self._report(job)
+
+    async def _report(self, job: CleanJob, rate: Optional[float] = None) -> None:
+        if not job.progress_message_id:
+            return
+        try:
+            await self.bot.edit_message_text(text=format_job(job, rate), chat_id=int(job.chat_id),
+                                             message_id=job.progress_message_id)
+        except TelegramBadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.warning("Failed to update progress for clean job #%d: %s", job.id, e)
+        except Exception:
+            logger.exception("Failed to update progress for clean job #%d", job.id)
+
+    async def close(self) -> None:
+        await stop_tasks(list(self._tasks.values()), self._stopping, name="Clean jobs")
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Callable, Optional
+
+from .background import stop_tasks, wait_stopping
+from .config import settings
+from .repository import InstanceLeaseRepository
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = "bot"
+
+
+# Роль активного экземпляра. Кэши белых списков и участников, буферы записи, лимиты Bot API,
+# автоочистка и продолжение /clean живут в памяти процесса, поэтому работать с ними может только
+# один экземпляр. Остальные ждут в acquire(), не принимая апдейтов: прокси шлёт запросы активному
+class InstanceLease:
+    def __init__(self, repo: Optional[InstanceLeaseRepository] = None, name: str = LEASE_NAME,
+                 ttl: float = settings.INSTANCE_LEASE_TTL, owner: Optional[str] = None):
+        self.repo = repo if repo is not None else InstanceLeaseRepository()
+        self.name = name
+        self.ttl = ttl
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.renew_interval = ttl / 3
+        # До какого момента (monotonic) аренда точно наша, даже если продлить её не удалось
+        self._held_until = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    @property
+    def active(self) -> bool:
+        return not self.enabled or time.monotonic() < self._held_until
+
+    async def _try_acquire(self) -> Optional[bool]:
+        started = time.monotonic()
+        try:
+            held = await self.repo.acquire(self.name, self.owner, self.ttl)
+        except Exception:
+            logger.exception("Failed to renew instance lease %s", self.name)
+            return None
+        if held:
+            # Запас в один интервал продления: успеваем остановиться раньше, чем аренду перехватят
+            self._held_until = started + self.ttl - self.renew_interval
+        return held
+
+    # Ждёт, пока аренда не станет нашей; False — если раньше попросили остановиться
+    async def acquire(self, stopping: Optional[asyncio.Event] = None) -> bool:
+        if not self.enabled:
+            return True
+        stopping = stopping or asyncio.Event()
+        waiting = False
+        while not stopping.is_set():
+            if await self._try_acquire():
+                logger.info("Instance %s is active (lease %s)", self.owner, self.name)
+                return True
+            if not waiting:
+                waiting = True
+                holder = await self._holder()
+                logger.info("Instance %s is on standby: lease %s is held by %s", self.owner, self.name, holder)
+            await wait_stopping(stopping, self.renew_interval)
+        return False
+
+    async def _holder(self) -> Optional[str]:
+        try:
+            lease = await self.repo.holder(self.name)
+        except Exception:
+            return None
+        return lease.owner if lease is not None else None
+
+    async def _renew(self, on_lost: Callable[[], None]) -> None:
+        while not await wait_stopping(self._stopping, self.renew_interval):
+            held = await self._try_acquire()
+            if held:
+                continue
+            # Аренду перехватили или БД недоступна дольше запаса: данные в памяти могут устареть
+            if held is False or time.monotonic() >= self._held_until:
+                self._held_until = 0.0
+                logger.error("Instance %s lost lease %s, stopping", self.owner, self.name)
+                on_lost()
+                return
+
+    # Продление в фоне; on_lost вызывается один раз, когда аренда потеряна
+    def start(self, on_lost: Callable[[], None]) -> None:
+        if not self.enabled:
+            return
+        if self._task is None or self._task.done():
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._renew(on_lost))
+
+    async def release(self) -> None:
+        if self._task is not None:
+            await stop_tasks([self._task], self._stopping, name="Instance lease")
+            self._task = None
+            self._stopping = None
+        if self.enabled and self._held_until:
+            self._held_until = 0.0
+            try:
+                await self.repo.release(self.name, self.owner)
+            except Exception:
+                logger.exception("Failed to release instance lease %s", self.name)
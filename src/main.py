@@ -1,9 +1,14 @@
 import asyncio
 from .bot_app import BotApp
+from .logging_setup import setup_logging, stop_logging
 
 async def main():
     app = BotApp()
     await app.start()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    setup_logging()
+    try:
+        asyncio.run(main())
+    finally:
+        stop_logging()
\ No newline at end of file
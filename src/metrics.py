@@ -0,0 +1,236 @@
+import bisect
+import collections
+import logging
+import math
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_key(labels), 0)
+
+
+# Значение задаётся явно или вычисляется функцией в момент сбора (глубина очереди, размер списка)
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[LabelKey, float] = {}
+        self._functions: Dict[LabelKey, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[_key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn: Callable[[], float], **labels) -> None:
+        with self._lock:
+            self._functions[_key(labels)] = fn
+
+    def value(self, **labels) -> float:
+        key = _key(labels)
+        fn = self._functions.get(key)
+        return fn() if fn is not None else self._values.get(key, 0)
+
+    def samples(self) -> List[Tuple[LabelKey, float]]:
+        with self._lock:
+            res = list(self._values.items())
+            functions = list(self._functions.items())
+        for key, fn in functions:
+            try:
+                res.append((key, float(fn())))
+            except Exception:
+                logger.exception("Gauge %s callback failed", self.name)
+        return res
+
+
+# Число событий в секунду за скользящее окно
+class RateMeter:
+    def __init__(self, window: float = 60.0):
+        self.window = window
+        self._events = collections.deque()
+        self._lock = threading.Lock()
+
+    def mark(self, n: int = 1) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._events.append((now, n))
+            self._trim(now)
+
+    def rate(self) -> float:
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            return sum(n for _, n in self._events) / self.window
+
+    def _trim(self, now: float) -> None:
+        while self._events and self._events[0][0] < now - self.window:
+            self._events.popleft()
+
+
+class _HistogramValue:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[LabelKey, _HistogramValue] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _key(labels)
+        with self._lock:
+            hv = self._values.get(key)
+            if hv is None:
+                hv = self._values[key] = _HistogramValue(len(self.buckets) + 1)
+            hv.counts[bisect.bisect_left(self.buckets, value)] += 1
+            hv.sum += value
+            hv.count += 1
+
+    def count(self, **labels) -> int:
+        hv = self._values.get(_key(labels))
+        return hv.count if hv else 0
+
+    def sum(self, **labels) -> float:
+        hv = self._values.get(_key(labels))
+        return hv.sum if hv else 0.0
+
+
+# Реестр метрик процесса
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} already registered as {metric.kind}")
+            return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get_or_create(Counter, name, help)
+
+    def histogram(self, name: str, help: str, buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, buckets)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get_or_create(Gauge, name, help)
+
+    def get(self, name: str) -> Optional[object]:
+        return self._metrics.get(name)
+
+    def collect(self) -> List[object]:
+        with self._lock:
+            return list(self._metrics.values())
+
+
+REGISTRY = MetricsRegistry()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+# Текстовый формат Prometheus (exposition format 0.0.4)
+def render_prometheus(registry: MetricsRegistry = REGISTRY) -> str:
+    lines = []
+    for metric in sorted(registry.collect(), key=lambda m: m.name):
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        if isinstance(metric, Histogram):
+            with metric._lock:
+                values = [(k, list(v.counts), v.sum, v.count) for k, v in metric._values.items()]
+            for key, counts, total, count in values:
+                cumulative = 0
+                for bound, n in zip(metric.buckets + (math.inf,), counts):
+                    cumulative += n
+                    lines.append(f"{metric.name}_bucket{_labels(key, (('le', _number(bound)),))} {cumulative}")
+                lines.append(f"{metric.name}_sum{_labels(key)} {_number(total)}")
+                lines.append(f"{metric.name}_count{_labels(key)} {count}")
+        elif isinstance(metric, Gauge):
+            for key, value in metric.samples():
+                lines.append(f"{metric.name}{_labels(key)} {_number(value)}")
+        else:
+            with metric._lock:
+                values = list(metric._values.items())
+            for key, value in values:
+                lines.append(f"{metric.name}{_labels(key)} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# Отдельный HTTP-сервер для сборщика метрик; по умолчанию слушает только localhost
+async def start_metrics_server(host: str, port: int, registry: MetricsRegistry = REGISTRY):
+    from aiohttp import web
+
+    async def metrics_handler(request: web.Request) -> web.Response:
+        return web.Response(text=render_prometheus(registry), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics server listening on %s:%s/metrics", host, port)
+    return runner
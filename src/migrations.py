@@ -0,0 +1,184 @@
+import logging
+
+from sqlalchemy import inspect, text
+
+from .allowlist import identifier_keys, username_key
+
+logger = logging.getLogger(__name__)
+
+
+# Миграции идемпотентны: каждая сама проверяет, нужна ли она текущей схеме
+def _has_index(conn, table: str, name: str) -> bool:
+    return any(ix["name"] == name for ix in inspect(conn).get_indexes(table))
+
+
+def _members_unique_key(conn) -> None:
+    if not inspect(conn).has_table("members") or _has_index(conn, "members", "uq_members_chat_user"):
+        return
+    # Оставляем по одной (самой свежей) записи на пару (chat_id, user_id)
+    res = conn.execute(text(
+        "DELETE FROM members WHERE id NOT IN "
+        "(SELECT MAX(id) FROM members GROUP BY chat_id, user_id)"
+    ))
+    logger.info("Removed %s duplicate member rows", res.rowcount)
+    conn.execute(text("CREATE UNIQUE INDEX uq_members_chat_user ON members (chat_id, user_id)"))
+
+
+def _allowed_users_scope(conn) -> None:
+    insp = inspect(conn)
+    if not insp.has_table("allowed_users"):
+        return
+    if not any(c["name"] == "chat_id" for c in insp.get_columns("allowed_users")):
+        # Все существующие записи становятся общим списком
+        conn.execute(text("ALTER TABLE allowed_users ADD COLUMN chat_id VARCHAR NOT NULL DEFAULT '*'"))
+    if _has_index(conn, "allowed_users", "uq_allowed_users_scope_ident"):
+        return
+    # Уникальность теперь в пределах чата, а не по всей таблице
+    unique_ident = [ix["name"] for ix in inspect(conn).get_indexes("allowed_users")
+                    if ix["unique"] and ix["column_names"] == ["user_identifier"]]
+    for name in unique_ident:
+        conn.execute(text(f"DROP INDEX {name}"))
+        conn.execute(text(f"CREATE INDEX {name} ON allowed_users (user_identifier)"))
+    conn.execute(text("CREATE UNIQUE INDEX uq_allowed_users_scope_ident ON allowed_users (chat_id, user_identifier)"))
+
+
+def _members_status(conn) -> None:
+    insp = inspect(conn)
+    if not insp.has_table("members") or any(c["name"] == "status" for c in insp.get_columns("members")):
+        return
+    # Кого нет в чате, раньше узнавали только при попытке бана; все известные считаются присутствующими
+    conn.execute(text("ALTER TABLE members ADD COLUMN status VARCHAR NOT NULL DEFAULT 'member'"))
+
+
+def _members_changed_at(conn) -> None:
+    insp = inspect(conn)
+    if not insp.has_table("members") or any(c["name"] == "changed_at" for c in insp.get_columns("members")):
+        return
+    # Пустое значение у старых строк: следующий проход автоочистки всё равно проверит чат заново
+    conn.execute(text("ALTER TABLE members ADD COLUMN changed_at TIMESTAMP"))
+
+
+def _add_missing_columns(conn, table: str, columns) -> None:
+    existing = {c["name"] for c in inspect(conn).get_columns(table)}
+    for name in columns:
+        if name not in existing:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} VARCHAR"))
+
+
+_BACKFILL_CHUNK = 1000
+
+
+# Нормализация в Python, а не lower() в SQL: в SQLite lower() понимает только ASCII
+def _normalized_keys(conn) -> None:
+    insp = inspect(conn)
+    if insp.has_table("members"):
+        _add_missing_columns(conn, "members", ["username_key"])
+        rows = conn.execute(text(
+            "SELECT id, username FROM members WHERE username IS NOT NULL AND username_key IS NULL"
+        )).all()
+        updates = [{"id": r[0], "key": username_key(r[1])} for r in rows]
+        for i in range(0, len(updates), _BACKFILL_CHUNK):
+            conn.execute(text("UPDATE members SET username_key = :key WHERE id = :id"),
+                         updates[i:i + _BACKFILL_CHUNK])
+        if updates:
+            logger.info("Backfilled username_key for %d members", len(updates))
+
+    if insp.has_table("allowed_users"):
+        _add_missing_columns(conn, "allowed_users", ["user_id_key", "username_key"])
+        rows = conn.execute(text(
+            "SELECT id, user_identifier FROM allowed_users WHERE user_id_key IS NULL AND username_key IS NULL"
+        )).all()
+        updates = []
+        for row_id, ident in rows:
+            user_id, key = identifier_keys(ident)
+            if user_id is not None or key is not None:
+                updates.append({"id": row_id, "uid": None if user_id is None else str(user_id), "key": key})
+        for i in range(0, len(updates), _BACKFILL_CHUNK):
+            conn.execute(text("UPDATE allowed_users SET user_id_key = :uid, username_key = :key WHERE id = :id"),
+                         updates[i:i + _BACKFILL_CHUNK])
+        if updates:
+            logger.info("Backfilled keys for %d allowed_users rows", len(updates))
+        for name, column in (("ix_allowed_users_scope_user_id", "user_id_key"),
+                             ("ix_allowed_users_scope_username", "username_key")):
+            if not _has_index(conn, "allowed_users", name):
+                conn.execute(text(f"CREATE INDEX {name} ON allowed_users (chat_id, {column})"))
+
+
+def _identities(conn) -> None:
+    insp = inspect(conn)
+    if not insp.has_table("allowed_users"):
+        return
+    _add_missing_columns(conn, "allowed_users", ["resolved_user_id"])
+    for name, columns in (("ix_allowed_users_scope_resolved", "chat_id, resolved_user_id"),
+                          ("ix_allowed_users_username_key", "username_key")):
+        if not _has_index(conn, "allowed_users", name):
+            conn.execute(text(f"CREATE INDEX {name} ON allowed_users ({columns})"))
+    if not insp.has_table("identities") or not insp.has_table("members"):
+        return
+    if conn.execute(text("SELECT 1 FROM identities LIMIT 1")).first() is not None:
+        return
+    # Первое заполнение — из уже известных участников: для каждого id берём самое свежее имя
+    latest = {}
+    for user_id, username, key in conn.execute(text(
+        "SELECT user_id, username, username_key FROM members WHERE username_key IS NOT NULL ORDER BY last_seen, id"
+    )):
+        latest[user_id] = {"user_id": user_id, "username": username, "key": key}
+    rows = list(latest.values())
+    for i in range(0, len(rows), _BACKFILL_CHUNK):
+        conn.execute(text("INSERT INTO identities (user_id, username, username_key) VALUES (:user_id, :username, :key)"),
+                     rows[i:i + _BACKFILL_CHUNK])
+    res = conn.execute(text(
+        "UPDATE allowed_users SET resolved_user_id = "
+        "(SELECT i.user_id FROM identities i WHERE i.username_key = allowed_users.username_key "
+        "ORDER BY i.updated_at DESC LIMIT 1) "
+        "WHERE resolved_user_id IS NULL AND username_key IS NOT NULL AND EXISTS "
+        "(SELECT 1 FROM identities i WHERE i.username_key = allowed_users.username_key)"
+    ))
+    logger.info("Backfilled %d identities, resolved %s allowlist usernames", len(rows), res.rowcount)
+
+
+def _action_log_stats(conn) -> None:
+    insp = inspect(conn)
+    if not insp.has_table("action_logs"):
+        return
+    for name, columns in (("ix_action_logs_chat_ts", "chat_id, timestamp"),
+                          ("ix_action_logs_ident_ts", "user_identifier, timestamp"),
+                          ("ix_action_logs_ts", "timestamp")):
+        if not _has_index(conn, "action_logs", name):
+            conn.execute(text(f"CREATE INDEX {name} ON action_logs ({columns})"))
+    if not insp.has_table("chat_daily_stats"):
+        return
+    if conn.execute(text("SELECT 1 FROM chat_daily_stats LIMIT 1")).first() is not None:
+        return
+    # Счётчики за всю историю, накопленную до их появления, считаются один раз
+    day = "CAST(timestamp AS DATE)" if conn.dialect.name == "postgresql" else "date(timestamp)"
+    res = conn.execute(text(
+        f"INSERT INTO chat_daily_stats (chat_id, day, banned, already_left, ban_failed) "
+        f"SELECT chat_id, {day}, "
+        "SUM(CASE WHEN action = 'banned' THEN 1 ELSE 0 END), "
+        "SUM(CASE WHEN action = 'already_left' THEN 1 ELSE 0 END), "
+        "SUM(CASE WHEN action = 'ban_failed' THEN 1 ELSE 0 END) "
+        f"FROM action_logs WHERE chat_id IS NOT NULL AND timestamp IS NOT NULL "
+        f"AND action IN ('banned', 'already_left', 'ban_failed') GROUP BY chat_id, {day}"
+    ))
+    logger.info("Backfilled %s daily stats rows from the action log", res.rowcount)
+
+
+MIGRATIONS = [
+    _members_unique_key,
+    _allowed_users_scope,
+    _members_status,
+    _members_changed_at,
+    _normalized_keys,
+    _identities,
+    _action_log_stats,
+]
+
+
+def _apply_all(conn) -> None:
+    for migration in MIGRATIONS:
+        migration(conn)
+
+
+async def run_migrations(conn) -> None:
+    await conn.run_sync(_apply_all)
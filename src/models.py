@@ -1,16 +1,61 @@
-from sqlalchemy import Column, Integer, String, DateTime, func
+from sqlalchemy import Column, Date, Integer, String, DateTime, Index, func
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
 
+# chat_id белого списка, общего для всех чатов
+GLOBAL_SCOPE = "*"
+
+# Состояние участника: в чате, вышел сам, удалён (забанен)
+MEMBER_PRESENT = "member"
+MEMBER_LEFT = "left"
+MEMBER_KICKED = "kicked"
+
 class AllowedUser(Base):
     __tablename__ = "allowed_users"
+    __table_args__ = (
+        Index("uq_allowed_users_scope_ident", "chat_id", "user_identifier", unique=True),
+        Index("ix_allowed_users_scope_user_id", "chat_id", "user_id_key"),
+        Index("ix_allowed_users_scope_username", "chat_id", "username_key"),
+        Index("ix_allowed_users_scope_resolved", "chat_id", "resolved_user_id"),
+        Index("ix_allowed_users_username_key", "username_key"),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(String, nullable=False, default=GLOBAL_SCOPE, server_default=GLOBAL_SCOPE)
+    user_identifier = Column(String, index=True)
+    # Нормализованные ключи (allowlist.identifier_keys) для выборки кандидатов на бан в SQL
+    user_id_key = Column(String, nullable=True)
+    username_key = Column(String, nullable=True)
+    # id пользователя, которому принадлежало имя из списка, когда бот его увидел (таблица identities).
+    # Найденная запись сверяется только по id, поэтому смена username не делает участника чужим
+    resolved_user_id = Column(String, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+
+# Последний виденный username каждого пользователя; пополняется из всех апдейтов, где он встречается
+class Identity(Base):
+    __tablename__ = "identities"
+    user_id = Column(String, primary_key=True)
+    username = Column(String, nullable=True)
+    username_key = Column(String, nullable=True, index=True)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+# Загрузки белых списков: по последней загрузке узнаём повтор того же файла
+class AllowlistImport(Base):
+    __tablename__ = "allowlist_imports"
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_identifier = Column(String, index=True, unique=True)
+    chat_id = Column(String, nullable=False, index=True)
+    file_unique_id = Column(String, nullable=True)
+    content_hash = Column(String, nullable=False)
+    total = Column(Integer, default=0)
     created_at = Column(DateTime, server_default=func.now())
 
 class ActionLog(Base):
     __tablename__ = "action_logs"
+    __table_args__ = (
+        Index("ix_action_logs_chat_ts", "chat_id", "timestamp"),
+        Index("ix_action_logs_ident_ts", "user_identifier", "timestamp"),
+        Index("ix_action_logs_ts", "timestamp"),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     chat_id = Column(String)
     user_identifier = Column(String)
@@ -18,10 +63,55 @@ class ActionLog(Base):
     timestamp = Column(DateTime, server_default=func.now())
     reason = Column(String, nullable=True)
 
+# Счётчики действий по чату и дню (UTC); растут вместе с записью журнала и переживают его очистку
+class ChatDailyStats(Base):
+    __tablename__ = "chat_daily_stats"
+    __table_args__ = (
+        Index("uq_chat_daily_stats_chat_day", "chat_id", "day", unique=True),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(String, nullable=False)
+    day = Column(Date, nullable=False)
+    banned = Column(Integer, nullable=False, default=0, server_default="0")
+    already_left = Column(Integer, nullable=False, default=0, server_default="0")
+    ban_failed = Column(Integer, nullable=False, default=0, server_default="0")
+
 class Member(Base):
     __tablename__ = "members"
+    __table_args__ = (
+        Index("uq_members_chat_user", "chat_id", "user_id", unique=True),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     chat_id = Column(String, index=True)
     user_id = Column(String, index=True)
     username = Column(String, nullable=True)
-    last_seen = Column(DateTime, server_default=func.now(), onupdate=func.now())
\ No newline at end of file
+    # username в нижнем регистре без "@", сравнивается с allowed_users.username_key
+    username_key = Column(String, nullable=True)
+    status = Column(String, nullable=False, default=MEMBER_PRESENT, server_default=MEMBER_PRESENT)
+    last_seen = Column(DateTime, server_default=func.now(), onupdate=func.now())
+    # Когда участник появился или сменил username либо статус; обновления last_seen его не трогают.
+    # По max(changed_at) автоочистка видит, что состав чата изменился
+    changed_at = Column(DateTime, nullable=True)
+
+class CleanJob(Base):
+    __tablename__ = "clean_jobs"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(String, index=True)
+    status = Column(String, default="pending")
+    # Курсор: id последней обработанной записи в members
+    cursor = Column(Integer, default=0)
+    total = Column(Integer, default=0)
+    checked = Column(Integer, default=0)
+    to_ban = Column(Integer, default=0)
+    banned = Column(Integer, default=0)
+    progress_message_id = Column(Integer, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+# Аренда роли активного экземпляра: держит её один процесс, остальные ждут в резерве
+class InstanceLease(Base):
+    __tablename__ = "instance_leases"
+    name = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
@@ -0,0 +1,252 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import time
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import BanChatMember, DeleteWebhook, GetUpdates, RestrictChatMember, SetWebhook, UnbanChatMember
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Признак того, что запрос уже выполняется воркером планировщика
+_scheduled = contextvars.ContextVar("outbound_scheduled", default=False)
+
+_BAN_METHODS = (BanChatMember, UnbanChatMember, RestrictChatMember)
+_UNSCHEDULED_METHODS = (GetUpdates, SetWebhook, DeleteWebhook)
+
+
+# Полосы приоритета: меньше — важнее
+class Lane(IntEnum):
+    BAN = 0
+    NOTICE = 1
+    CHATTER = 2
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def is_full(self) -> bool:
+        return self._tokens + (time.monotonic() - self._updated) * self.rate >= self.capacity
+
+    async def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class _Job:
+    __slots__ = ("call", "lane", "chat_id", "method", "future", "attempt")
+
+    def __init__(self, call: Callable[[], Awaitable[Any]], lane: Lane, chat_id: Any, method: Optional[str],
+                 future: asyncio.Future):
+        self.call = call
+        self.lane = lane
+        self.chat_id = chat_id
+        self.method = method
+        self.future = future
+        self.attempt = 0
+
+
+# Лимит 20 сообщений в минуту Telegram применяет к группам и каналам; у личных чатов (id > 0) его нет
+def _is_group_chat(chat_id: Any) -> bool:
+    if isinstance(chat_id, str):
+        if chat_id.startswith("@"):
+            return True
+        try:
+            chat_id = int(chat_id)
+        except ValueError:
+            return False
+    return isinstance(chat_id, int) and chat_id < 0
+
+
+# Единая очередь исходящих запросов к Bot API с лимитами, приоритетами и учётом RetryAfter
+class OutboundScheduler:
+    _MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, concurrency: int = settings.OUTBOUND_CONCURRENCY,
+                 global_rate: float = settings.OUTBOUND_GLOBAL_RATE,
+                 chat_rate_per_minute: float = settings.OUTBOUND_CHAT_RATE_PER_MINUTE,
+                 max_retries: int = settings.OUTBOUND_MAX_RETRIES):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate_per_minute / 60.0
+        self._chat_buckets: Dict[Any, TokenBucket] = {}
+        # RetryAfter приостанавливает только тот метод и чат, на который пришёл ответ 429
+        self._paused: Dict[Tuple[Optional[str], Any], float] = {}
+        self._deferred: Dict[_Job, asyncio.TimerHandle] = {}
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: Set[asyncio.Task] = set()
+        self._seq = itertools.count()
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, call: Callable[[], Awaitable[Any]], *, lane: Lane = Lane.CHATTER, chat_id: Any = None,
+                     method: Optional[str] = None):
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(_Job(call, lane, chat_id, method, future))
+        return await future
+
+    def _enqueue(self, job: _Job) -> None:
+        self._ensure_workers()
+        self._queue.put_nowait((int(job.lane), next(self._seq), job))
+
+    def _ensure_workers(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        # Воркеры живут, пока в очереди есть работа, и запускаются заново по мере надобности.
+        # Завершившийся воркер убирается из набора колбэком позже, поэтому считаем только живые
+        self._workers.difference_update([w for w in self._workers if w.done()])
+        while len(self._workers) < self.concurrency:
+            worker = asyncio.create_task(self._worker())
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self._MAX_CHAT_BUCKETS:
+                # Забываем чаты, которые давно ничего не отправляли
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.is_full()}
+            bucket = TokenBucket(self._chat_rate, 3)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _pause_left(self, key: Tuple[Optional[str], Any]) -> float:
+        until = self._paused.get(key)
+        if until is None:
+            return 0.0
+        left = until - time.monotonic()
+        if left <= 0:
+            del self._paused[key]
+        return left
+
+    def _pause(self, key: Tuple[Optional[str], Any], seconds: float) -> None:
+        now = time.monotonic()
+        if len(self._paused) >= self._MAX_CHAT_BUCKETS:
+            self._paused = {k: until for k, until in self._paused.items() if until > now}
+        self._paused[key] = max(self._paused.get(key, 0.0), now + seconds)
+
+    # Запрос на паузе возвращается в очередь по таймеру, не занимая воркер
+    def _defer(self, job: _Job, delay: float) -> None:
+        self._deferred[job] = asyncio.get_running_loop().call_later(delay, self._resume, job)
+
+    def _resume(self, job: _Job) -> None:
+        self._deferred.pop(job, None)
+        if not job.future.done():
+            self._enqueue(job)
+
+    async def _worker(self) -> None:
+        while not self._queue.empty():
+            _, _, job = self._queue.get_nowait()
+            try:
+                if not job.future.done():
+                    await self._run(job)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception:
+                logger.exception("Outbound worker failed")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: _Job) -> None:
+        key = (job.method, job.chat_id)
+        while True:
+            pause = self._pause_left(key)
+            if pause > 0:
+                self._defer(job, pause)
+                return
+            await self._global.acquire()
+            # Лимит на чат относится к сообщениям в группы; баны ограничены только общим лимитом
+            if job.lane != Lane.BAN and _is_group_chat(job.chat_id):
+                await self._chat_bucket(job.chat_id).acquire()
+            if job.future.done():
+                return
+
+            token = _scheduled.set(True)
+            try:
+                result = await job.call()
+            except TelegramRetryAfter as e:
+                job.attempt += 1
+                self._pause(key, e.retry_after)
+                logger.warning("Flood control: pausing %s to chat %s for %ss (attempt %d)",
+                               job.method or "requests", job.chat_id, e.retry_after, job.attempt)
+                if job.attempt > self.max_retries:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                    return
+                continue
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+                return
+            finally:
+                _scheduled.reset(token)
+
+            if not job.future.done():
+                job.future.set_result(result)
+            return
+
+    async def close(self) -> None:
+        for job, handle in list(self._deferred.items()):
+            handle.cancel()
+            if not job.future.done():
+                job.future.cancel()
+        self._deferred.clear()
+        workers = list(self._workers)
+        for w in workers:
+            w.cancel()
+        for w in workers:
+            try:
+                await w
+            except asyncio.CancelledError:
+                pass
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, _, job = self._queue.get_nowait()
+                if not job.future.done():
+                    job.future.cancel()
+
+
+def lane_for_method(method: Any) -> Lane:
+    if isinstance(method, _BAN_METHODS):
+        return Lane.BAN
+    chat_id = getattr(method, "chat_id", None)
+    if settings.ADMIN_CHAT_ID and chat_id == settings.ADMIN_CHAT_ID:
+        return Lane.NOTICE
+    return Lane.CHATTER
+
+
+# Пропускает через планировщик все запросы бота, кроме уже запланированных и служебных
+class OutboundMiddleware(BaseRequestMiddleware):
+    def __init__(self, scheduler: OutboundScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        if _scheduled.get() or isinstance(method, _UNSCHEDULED_METHODS):
+            return await make_request(bot, method)
+        return await self.scheduler.submit(
+            lambda: make_request(bot, method),
+            lane=lane_for_method(method),
+            chat_id=getattr(method, "chat_id", None),
+            method=getattr(method, "__api_method__", type(method).__name__),
+        )
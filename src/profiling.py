@@ -0,0 +1,142 @@
+import asyncio
+import cProfile
+import io
+import logging
+import marshal
+import os
+import pstats
+from collections import deque
+from datetime import datetime
+from typing import Deque, List, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.types import BufferedInputFile
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Кольцевой буфер медленных вызовов обработчиков: тип апдейта и чат помогают найти, кто тормозит
+class SlowHandlerLog:
+    def __init__(self, threshold: float = settings.SLOW_HANDLER_MS / 1000,
+                 size: int = settings.SLOW_HANDLER_BUFFER):
+        self.threshold = threshold
+        self._entries: Deque[dict] = deque(maxlen=max(1, size))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def record(self, seconds: float, handler: str, update_type: Optional[str] = None, chat_id=None) -> None:
+        if seconds < self.threshold:
+            return
+        self._entries.append({"seconds": seconds, "handler": handler, "update_type": update_type,
+                              "chat_id": chat_id, "at": datetime.utcnow()})
+
+    def slowest(self, n: int = 10) -> List[dict]:
+        return sorted(self._entries, key=lambda e: e["seconds"], reverse=True)[:n]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+slow_handlers = SlowHandlerLog()
+
+
+def format_slow_handlers(entries: List[dict]) -> str:
+    if not entries:
+        return "Медленных обработчиков не было."
+    lines = ["Самые медленные обработчики:"]
+    for e in entries:
+        lines.append(f"{e['seconds'] * 1000:.0f} мс — {e['handler']} ({e['update_type'] or '?'}, "
+                     f"чат {e['chat_id'] if e['chat_id'] is not None else '-'}, {e['at']:%H:%M:%S} UTC)")
+    return "\n".join(lines)
+
+
+# Предупреждения asyncio о колбэках дольше порога; работают только в debug-режиме цикла
+def configure_slow_callbacks(loop: asyncio.AbstractEventLoop,
+                             threshold_ms: float = settings.ASYNCIO_SLOW_CALLBACK_MS) -> bool:
+    if threshold_ms <= 0:
+        return False
+    loop.set_debug(True)
+    loop.slow_callback_duration = threshold_ms / 1000
+    logger.info("asyncio slow callback warnings enabled: > %s ms", threshold_ms)
+    return True
+
+
+# cProfile цикла событий: профилируется весь поток цикла, то есть все задачи, пока идёт замер
+class LoopProfiler:
+    def __init__(self, max_seconds: int = settings.PROFILE_MAX_SECONDS, top: int = settings.PROFILE_TOP,
+                 out_dir: str = settings.PROFILE_DIR, slow: SlowHandlerLog = slow_handlers):
+        self.max_seconds = max_seconds
+        self.top = top
+        self.out_dir = out_dir
+        self.slow = slow
+        self._busy = False
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def busy(self) -> bool:
+        return self._busy
+
+    def clamp(self, seconds: float) -> float:
+        return min(max(1.0, seconds), float(self.max_seconds))
+
+    async def capture(self, seconds: float) -> Tuple[str, bytes]:
+        if self._busy:
+            raise RuntimeError("profile capture already running")
+        self._busy = True
+        profile = cProfile.Profile()
+        started = datetime.utcnow()
+        try:
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+        finally:
+            self._busy = False
+        out = io.StringIO()
+        out.write(f"Event loop profile: {started:%Y-%m-%d %H:%M:%S} UTC, {seconds:g} s\n\n")
+        out.write(format_slow_handlers(self.slow.slowest()) + "\n\n")
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(self.top)
+        stats.sort_stats("tottime").print_stats(self.top)
+        # Сырые данные в формате pstats.dump_stats: открываются snakeviz и pstats
+        return out.getvalue(), marshal.dumps(stats.stats)
+
+    def _save(self, name: str, report: str, raw: bytes) -> None:
+        os.makedirs(self.out_dir, exist_ok=True)
+        with open(os.path.join(self.out_dir, f"{name}.txt"), "w", encoding="utf-8") as f:
+            f.write(report)
+        with open(os.path.join(self.out_dir, f"{name}.prof"), "wb") as f:
+            f.write(raw)
+
+    async def capture_and_send(self, bot: Bot, chat_id: Optional[int], seconds: float) -> None:
+        try:
+            report, raw = await self.capture(seconds)
+            name = f"profile-{datetime.utcnow():%Y%m%dT%H%M%S}"
+            if self.out_dir:
+                await asyncio.to_thread(self._save, name, report, raw)
+            if chat_id:
+                await bot.send_document(chat_id, BufferedInputFile(report.encode(), filename=f"{name}.txt"),
+                                        caption=f"Профиль цикла событий за {seconds:g} с")
+                await bot.send_document(chat_id, BufferedInputFile(raw, filename=f"{name}.prof"))
+            logger.info("Event loop profile captured: %s (%g s)", name, seconds)
+        except Exception:
+            logger.exception("Failed to capture event loop profile")
+
+    # Замер идёт в фоне, чтобы не держать воркер чата, из которого пришла команда
+    def start(self, bot: Bot, chat_id: Optional[int], seconds: float) -> bool:
+        if self._busy or self._tasks:
+            return False
+        task = asyncio.create_task(self.capture_and_send(bot, chat_id, self.clamp(seconds)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -1,55 +1,672 @@
-from typing import List, Optional
-from sqlalchemy import select, delete, distinct
-from .models import AllowedUser, ActionLog, Member
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from sqlalchemy import case, select, delete, distinct, func, insert, or_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from .allowlist import identifier_keys, username_key
+from .background import stop_tasks, wait_stopping
+from .cache import PresenceCache, presence_cache
+from .config import settings
+from .models import (GLOBAL_SCOPE, MEMBER_LEFT, MEMBER_PRESENT, AllowedUser, AllowlistImport, ActionLog,
+                     ChatDailyStats, CleanJob, Identity, InstanceLease, Member)
 from .db import AsyncSessionLocal
 from sqlalchemy.ext.asyncio import AsyncSession
 
+logger = logging.getLogger(__name__)
+
+# SQLite ограничивает число параметров в одном запросе
+_UPSERT_CHUNK = 300
+_SYNC_CHUNK = 500
+
+
+def _upsert_members_stmt(session: AsyncSession, rows: List[dict], update_username: bool = True):
+    insert = postgresql.insert if session.bind.dialect.name == "postgresql" else sqlite.insert
+    stmt = insert(Member).values(rows)
+    set_ = {"status": stmt.excluded.status, "last_seen": func.now()}
+    changed = Member.status.is_distinct_from(stmt.excluded.status)
+    if update_username:
+        set_["username"] = stmt.excluded.username
+        set_["username_key"] = stmt.excluded.username_key
+        changed = or_(changed, Member.username_key.is_distinct_from(stmt.excluded.username_key))
+    set_["changed_at"] = case((changed, stmt.excluded.changed_at), else_=Member.changed_at)
+    return stmt.on_conflict_do_update(index_elements=[Member.chat_id, Member.user_id], set_=set_)
+
+
+# changed_at из Python, а не now() в SQL: в SQLite CURRENT_TIMESTAMP с точностью до секунды,
+# и смена имени в ту же секунду, что и прошлый проход автоочистки, осталась бы незамеченной
+def _member_row(chat_id, user_id, username: Optional[str], status: str = MEMBER_PRESENT) -> dict:
+    return {"chat_id": str(chat_id), "user_id": str(user_id), "username": username,
+            "username_key": username_key(username), "status": status, "changed_at": datetime.utcnow()}
+
+
+def _upsert_identities_stmt(session: AsyncSession, rows: List[dict]):
+    insert = postgresql.insert if session.bind.dialect.name == "postgresql" else sqlite.insert
+    stmt = insert(Identity).values(rows)
+    # Строку трогаем, только если имя действительно сменилось
+    return stmt.on_conflict_do_update(
+        index_elements=[Identity.user_id],
+        set_={"username": stmt.excluded.username, "username_key": stmt.excluded.username_key, "updated_at": func.now()},
+        where=Identity.username_key.is_distinct_from(stmt.excluded.username_key),
+    )
+
+
+# id последнего пользователя, носившего имя записи белого списка
+def _resolved_user_id():
+    return (
+        select(Identity.user_id).where(Identity.username_key == AllowedUser.username_key)
+        .order_by(Identity.updated_at.desc()).limit(1).scalar_subquery()
+    )
+
+
+def _has_identity():
+    return select(Identity.user_id).where(Identity.username_key == AllowedUser.username_key).exists()
+
+
+# Запоминает увиденные пары (user_id, username) и привязывает к id имена из белых списков.
+# Имя в Telegram в каждый момент принадлежит одному пользователю: у тех, кто носил его раньше, оно устарело,
+# а запись, привязанная к прежнему владельцу, перепривязывается к нынешнему.
+# Возвращает списки (chat_id), в которых привязки изменились
+async def _observe_identities(session: AsyncSession, rows: List[dict]) -> List[str]:
+    latest = {r["user_id"]: r for r in rows if r.get("username_key")}
+    if not latest:
+        return []
+    idents = [{"user_id": uid, "username": r["username"], "username_key": r["username_key"]}
+              for uid, r in latest.items()]
+    for i in range(0, len(idents), _UPSERT_CHUNK):
+        chunk = idents[i:i + _UPSERT_CHUNK]
+        await session.execute(_upsert_identities_stmt(session, chunk))
+        await session.execute(
+            update(Identity)
+            .where(Identity.username_key.in_({r["username_key"] for r in chunk}),
+                   Identity.user_id.notin_([r["user_id"] for r in chunk]))
+            .values(username=None, username_key=None)
+        )
+    keys = list({r["username_key"] for r in idents})
+    scopes = set()
+    for i in range(0, len(keys), _SYNC_CHUNK):
+        stale = (AllowedUser.username_key.in_(keys[i:i + _SYNC_CHUNK]),
+                 AllowedUser.resolved_user_id.is_distinct_from(_resolved_user_id()))
+        found = (await session.execute(select(distinct(AllowedUser.chat_id)).where(*stale))).scalars().all()
+        if found:
+            await session.execute(update(AllowedUser).where(*stale).values(resolved_user_id=_resolved_user_id())
+                                  .execution_options(synchronize_session=False))
+            scopes.update(found)
+    return sorted(scopes)
+
+
+def _allowed_row(chat_id: str, ident: str) -> dict:
+    user_id, key = identifier_keys(ident)
+    return {"chat_id": chat_id, "user_identifier": ident,
+            "user_id_key": None if user_id is None else str(user_id), "username_key": key}
+
+
 class AllowedUserRepository:
-    async def set_users(self, identifiers: List[str]) -> None:
+    async def set_users(self, identifiers: List[str], chat_id: str = GLOBAL_SCOPE) -> Dict[str, int]:
+        return await self.sync_users(identifiers, chat_id=chat_id)
+
+    # Применяет к списку чата только разницу между сохранённым и новым списком
+    async def sync_users(self, identifiers: List[str], chat_id: str = GLOBAL_SCOPE) -> Dict[str, int]:
+        chat_id = str(chat_id)
+        wanted = list(dict.fromkeys(identifiers))
+        wanted_set = set(wanted)
+        async with AsyncSessionLocal() as session:
+            q = await session.execute(select(AllowedUser.user_identifier).where(AllowedUser.chat_id == chat_id))
+            existing = set(q.scalars().all())
+            added = [ident for ident in wanted if ident not in existing]
+            removed = [ident for ident in existing if ident not in wanted_set]
+            for i in range(0, len(removed), _SYNC_CHUNK):
+                chunk = removed[i:i + _SYNC_CHUNK]
+                await session.execute(delete(AllowedUser).where(
+                    AllowedUser.chat_id == chat_id, AllowedUser.user_identifier.in_(chunk)))
+            for i in range(0, len(added), _SYNC_CHUNK):
+                chunk = added[i:i + _SYNC_CHUNK]
+                await session.execute(insert(AllowedUser), [_allowed_row(chat_id, ident) for ident in chunk])
+            await session.commit()
+        return {
+            "total": len(wanted),
+            "added": len(added),
+            "removed": len(removed),
+            "unchanged": len(wanted) - len(added),
+        }
+
+    # Пакетная привязка имён списка к id по таблице identities; возвращает число новых привязок
+    async def resolve_usernames(self, chat_id: str = GLOBAL_SCOPE) -> int:
         async with AsyncSessionLocal() as session:
-            await session.execute(delete(AllowedUser))
-            objs = [AllowedUser(user_identifier=ident) for ident in identifiers]
-            session.add_all(objs)
+            res = await session.execute(
+                update(AllowedUser)
+                .where(AllowedUser.chat_id == str(chat_id), AllowedUser.username_key.isnot(None), _has_identity(),
+                       AllowedUser.resolved_user_id.is_distinct_from(_resolved_user_id()))
+                .values(resolved_user_id=_resolved_user_id())
+                .execution_options(synchronize_session=False)
+            )
             await session.commit()
+            return res.rowcount
+
+    async def resolved_identifiers(self, chat_id: str = GLOBAL_SCOPE) -> Dict[str, str]:
+        async with AsyncSessionLocal() as session:
+            q = await session.execute(
+                select(AllowedUser.user_identifier, AllowedUser.resolved_user_id)
+                .where(AllowedUser.chat_id == str(chat_id), AllowedUser.resolved_user_id.isnot(None))
+            )
+            return {ident: user_id for ident, user_id in q.all()}
 
-    async def list_identifiers(self) -> List[str]:
+    async def has_scope(self, chat_id: str) -> bool:
         async with AsyncSessionLocal() as session:
-            q = await session.execute(select(AllowedUser.user_identifier))
+            q = await session.execute(select(AllowedUser.id).where(AllowedUser.chat_id == str(chat_id)).limit(1))
+            return q.first() is not None
+
+    # resolved=True: вместо найденных имён отдаются их id — так индекс в памяти сверяет их только по id
+    async def list_identifiers(self, chat_id: str = GLOBAL_SCOPE, resolved: bool = False) -> List[str]:
+        column = func.coalesce(AllowedUser.resolved_user_id, AllowedUser.user_identifier) if resolved \
+            else AllowedUser.user_identifier
+        async with AsyncSessionLocal() as session:
+            q = await session.execute(select(column).where(AllowedUser.chat_id == str(chat_id)))
             rows = q.scalars().all()
             return list(rows)
 
+class AllowlistImportRepository:
+    async def last(self, chat_id: str) -> Optional[dict]:
+        async with AsyncSessionLocal() as session:
+            q = await session.execute(
+                select(AllowlistImport).where(AllowlistImport.chat_id == str(chat_id))
+                .order_by(AllowlistImport.id.desc()).limit(1)
+            )
+            row = q.scalars().first()
+            if row is None:
+                return None
+            return {"file_unique_id": row.file_unique_id, "content_hash": row.content_hash, "total": row.total}
+
+    async def record(self, chat_id: str, content_hash: str, total: int, file_unique_id: Optional[str] = None) -> None:
+        async with AsyncSessionLocal() as session:
+            session.add(AllowlistImport(chat_id=str(chat_id), file_unique_id=file_unique_id,
+                                        content_hash=content_hash, total=total))
+            await session.commit()
+
+
+# Действия, для которых ведутся счётчики по дням (колонки ChatDailyStats)
+STAT_ACTIONS = ("banned", "already_left", "ban_failed")
+
+
+def _daily_stats_rows(rows: List[dict]) -> List[dict]:
+    counts: Dict[Tuple[str, date], dict] = {}
+    for row in rows:
+        if row["action"] not in STAT_ACTIONS:
+            continue
+        key = (row["chat_id"], row["timestamp"].date())
+        entry = counts.get(key)
+        if entry is None:
+            entry = counts[key] = {"chat_id": key[0], "day": key[1], **{a: 0 for a in STAT_ACTIONS}}
+        entry[row["action"]] += 1
+    return list(counts.values())
+
+
+def _upsert_daily_stats_stmt(session: AsyncSession, rows: List[dict]):
+    insert = postgresql.insert if session.bind.dialect.name == "postgresql" else sqlite.insert
+    stmt = insert(ChatDailyStats).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[ChatDailyStats.chat_id, ChatDailyStats.day],
+        set_={a: getattr(ChatDailyStats, a) + getattr(stmt.excluded, a) for a in STAT_ACTIONS},
+    )
+
+
 class ActionLogRepository:
     async def log(self, chat_id: str, user_identifier: str, action: str, reason: Optional[str] = None):
+        await self.log_many([{"chat_id": str(chat_id), "user_identifier": user_identifier, "action": action,
+                              "reason": reason}])
+
+    async def log_many(self, rows: List[dict]) -> None:
+        if not rows:
+            return
+        rows = [{**r, "chat_id": str(r["chat_id"]), "timestamp": r.get("timestamp") or datetime.utcnow()}
+                for r in rows]
+        # Счётчики обновляются в той же транзакции, что и журнал, поэтому не расходятся с ним
+        stats = _daily_stats_rows(rows)
         async with AsyncSessionLocal() as session:
-            log = ActionLog(chat_id=str(chat_id), user_identifier=user_identifier, action=action, reason=reason)
-            session.add(log)
+            await session.execute(insert(ActionLog), rows)
+            for i in range(0, len(stats), _UPSERT_CHUNK):
+                await session.execute(_upsert_daily_stats_stmt(session, stats[i:i + _UPSERT_CHUNK]))
             await session.commit()
 
+    # Суммы счётчиков за последние N дней для каждого N из periods; читается не больше max(periods) строк
+    async def stats(self, chat_id: str, periods: Sequence[int] = (1, 7, 30),
+                    today: Optional[date] = None) -> Dict[int, Dict[str, int]]:
+        today = today or datetime.utcnow().date()
+        since = today - timedelta(days=max(periods) - 1)
+        async with AsyncSessionLocal() as session:
+            q = await session.execute(
+                select(ChatDailyStats).where(ChatDailyStats.chat_id == str(chat_id), ChatDailyStats.day >= since)
+            )
+            rows = q.scalars().all()
+        totals = {n: {a: 0 for a in STAT_ACTIONS} for n in periods}
+        for row in rows:
+            age = (today - row.day).days
+            for n in periods:
+                if age < n:
+                    for a in STAT_ACTIONS:
+                        totals[n][a] += getattr(row, a)
+        return totals
+
+    # Порция самых старых записей до cutoff для архивации
+    async def older_than(self, cutoff: datetime, limit: int) -> List[dict]:
+        async with AsyncSessionLocal() as session:
+            q = await session.execute(
+                select(ActionLog).where(ActionLog.timestamp < cutoff)
+                .order_by(ActionLog.timestamp, ActionLog.id).limit(limit)
+            )
+            return [
+                {"id": r.id, "chat_id": r.chat_id, "user_identifier": r.user_identifier, "action": r.action,
+                 "reason": r.reason, "timestamp": r.timestamp}
+                for r in q.scalars().all()
+            ]
+
+    async def delete_ids(self, ids: Iterable[int]) -> int:
+        ids = list(ids)
+        deleted = 0
+        async with AsyncSessionLocal() as session:
+            for i in range(0, len(ids), _SYNC_CHUNK):
+                res = await session.execute(delete(ActionLog).where(ActionLog.id.in_(ids[i:i + _SYNC_CHUNK])))
+                deleted += res.rowcount
+            await session.commit()
+        return deleted
+
+    async def recent(self, chat_id: Optional[str] = None, user_identifier: Optional[str] = None,
+                     limit: int = 50) -> List[dict]:
+        q = select(ActionLog)
+        if chat_id is not None:
+            q = q.where(ActionLog.chat_id == str(chat_id))
+        if user_identifier is not None:
+            q = q.where(ActionLog.user_identifier == user_identifier)
+        q = q.order_by(ActionLog.timestamp.desc(), ActionLog.id.desc()).limit(limit)
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(q)).scalars().all()
+            return [
+                {"chat_id": r.chat_id, "user_identifier": r.user_identifier, "action": r.action,
+                 "reason": r.reason, "timestamp": r.timestamp}
+                for r in rows
+            ]
+
+
+async def _write_members(batch: Dict[Tuple[str, str], Optional[str]]) -> List[str]:
+    rows = [_member_row(chat_id, user_id, username) for (chat_id, user_id), username in batch.items()]
+    async with AsyncSessionLocal() as session:
+        for i in range(0, len(rows), _UPSERT_CHUNK):
+            await session.execute(_upsert_members_stmt(session, rows[i:i + _UPSERT_CHUNK]))
+        scopes = await _observe_identities(session, rows)
+        await session.commit()
+    return scopes
+
+
+# Буфер отложенной записи: склеивает обновления по (chat_id, user_id) и пишет их одной транзакцией
+class MemberWriteBuffer:
+    def __init__(self, max_size: int = settings.MEMBER_FLUSH_SIZE,
+                 flush_interval: float = settings.MEMBER_FLUSH_INTERVAL, cache: Optional[PresenceCache] = None):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.cache = cache
+        # Вызывается со списками, где имена привязались к id (индексы этих списков надо перестроить)
+        self.on_resolved: Optional[Callable[[List[str]], None]] = None
+        self._pending: Dict[Tuple[str, str], Optional[str]] = {}
+        self._inflight: Dict[Tuple[str, str], Optional[str]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def add(self, chat_id: str, user_id: str, username: Optional[str]) -> None:
+        # Тот же участник с тем же username недавно записан — писать нечего
+        if self.cache is not None and self.cache.is_fresh(chat_id, user_id, username):
+            return
+        self._pending[(str(chat_id), str(user_id))] = username
+        if len(self._pending) >= self.max_size:
+            await self.flush()
+
+    # Прямая запись участника в обход буфера (удаление, выход, бан): ждёт уже начатый сброс, иначе его
+    # upsert закоммитится после неё и вернёт участника, и не даёт начать новый, пока запись не закончена
+    @asynccontextmanager
+    async def exclusive(self) -> AsyncIterator[None]:
+        async with self._flush_lock:
+            yield
+
+    def discard(self, chat_id: str, user_id: str) -> None:
+        key = (str(chat_id), str(user_id))
+        self._pending.pop(key, None)
+        self._inflight.pop(key, None)
+        if self.cache is not None:
+            self.cache.invalidate(chat_id, user_id)
+
+    def pending_for_chat(self, chat_id: str) -> Dict[str, Optional[str]]:
+        chat_id = str(chat_id)
+        res = {}
+        for source in (self._inflight, self._pending):
+            for (c, user_id), username in source.items():
+                if c == chat_id:
+                    res[user_id] = username
+        return res
+
+    def discard_chat(self, chat_id: str) -> None:
+        chat_id = str(chat_id)
+        for source in (self._pending, self._inflight):
+            for key in [k for k in source if k[0] == chat_id]:
+                source.pop(key, None)
+        if self.cache is not None:
+            self.cache.invalidate_chat(chat_id)
+
+    def notify_resolved(self, scopes: List[str]) -> None:
+        if scopes and self.on_resolved is not None:
+            self.on_resolved(scopes)
+
+    def pending_chats(self) -> set:
+        return {c for c, _ in self._inflight} | {c for c, _ in self._pending}
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            # Тот же словарь: discard во время записи убирает ключ и из batch, в кэш он не попадёт
+            self._inflight = batch
+            try:
+                scopes = await _write_members(batch)
+            except Exception:
+                # Возвращаем записи в буфер, не затирая более свежие
+                for key, username in batch.items():
+                    self._pending.setdefault(key, username)
+                if self.cache is not None:
+                    self.cache.invalidate_many(batch)
+                raise
+            finally:
+                self._inflight = {}
+            if self.cache is not None:
+                self.cache.put_many(batch)
+            self.notify_resolved(scopes)
+            logger.debug("Flushed %d member updates", len(batch))
+            return len(batch)
+
+    async def _run(self) -> None:
+        while not await wait_stopping(self._stopping, self.flush_interval):
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush member updates")
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            # Буфер живёт дольше одного цикла событий (тесты), поэтому событие создаётся при запуске
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            await stop_tasks([self._task], self._stopping, name="Member write buffer")
+            self._task = None
+            self._stopping = None
+        await self.flush()
+
+
+member_write_buffer = MemberWriteBuffer(cache=presence_cache)
+
+
 class MemberRepository:
+    def __init__(self, buffer: Optional[MemberWriteBuffer] = None):
+        self.buffer = buffer if buffer is not None else member_write_buffer
+
     async def upsert_member(self, chat_id: str, user_id: str, username: Optional[str]):
+        row = _member_row(chat_id, user_id, username)
+        async with AsyncSessionLocal() as session:
+            await session.execute(_upsert_members_stmt(session, [row]))
+            scopes = await _observe_identities(session, [row])
+            await session.commit()
+        if self.buffer.cache is not None:
+            self.buffer.cache.put(chat_id, user_id, username)
+        self.buffer.notify_resolved(scopes)
+
+    async def upsert_members(self, chat_id: str, users: List[Tuple[str, Optional[str]]]) -> None:
+        rows = [_member_row(chat_id, user_id, username) for user_id, username in users]
+        if not rows:
+            return
+        async with AsyncSessionLocal() as session:
+            for i in range(0, len(rows), _UPSERT_CHUNK):
+                await session.execute(_upsert_members_stmt(session, rows[i:i + _UPSERT_CHUNK]))
+            scopes = await _observe_identities(session, rows)
+            await session.commit()
+        if self.buffer.cache is not None:
+            for row in rows:
+                self.buffer.cache.put(row["chat_id"], row["user_id"], row["username"])
+        self.buffer.notify_resolved(scopes)
+
+    async def queue_upsert(self, chat_id: str, user_id: str, username: Optional[str]):
+        await self.buffer.add(chat_id, user_id, username)
+
+    async def flush(self) -> int:
+        return await self.buffer.flush()
+
+    # Меняет состояние участника по событиям chat_member. username=None оставляет сохранённое имя
+    async def set_status(self, chat_id: str, user_id: str, status: str, username: Optional[str] = None) -> None:
+        if status == MEMBER_PRESENT:
+            scopes = await self._write_status(chat_id, user_id, status, username)
+        else:
+            # Отложенная запись «в чате» не должна перетереть выход
+            async with self.buffer.exclusive():
+                self.buffer.discard(chat_id, user_id)
+                scopes = await self._write_status(chat_id, user_id, status, username)
+        self.buffer.notify_resolved(scopes)
+
+    async def _write_status(self, chat_id: str, user_id: str, status: str, username: Optional[str]) -> List[str]:
+        row = _member_row(chat_id, user_id, username, status)
         async with AsyncSessionLocal() as session:
-            q = await session.execute(select(Member).where(Member.chat_id == str(chat_id), Member.user_id == str(user_id)))
-            obj = q.scalars().first()
-            if obj:
-                obj.username = username
-            else:
-                obj = Member(chat_id=str(chat_id), user_id=str(user_id), username=username)
-                session.add(obj)
+            await session.execute(_upsert_members_stmt(session, [row], update_username=username is not None))
+            scopes = await _observe_identities(session, [row])
             await session.commit()
+        return scopes
+
+    # Пакетная смена состояния по итогам банов; имена не трогаем
+    async def set_statuses(self, chat_id: str, updates: List[Tuple[str, str]]) -> None:
+        rows = [_member_row(chat_id, user_id, None, status) for user_id, status in updates]
+        async with self.buffer.exclusive():
+            for user_id, status in updates:
+                if status != MEMBER_PRESENT:
+                    self.buffer.discard(chat_id, user_id)
+            async with AsyncSessionLocal() as session:
+                for i in range(0, len(rows), _UPSERT_CHUNK):
+                    await session.execute(_upsert_members_stmt(session, rows[i:i + _UPSERT_CHUNK],
+                                                               update_username=False))
+                await session.commit()
+
+    # Бот удалён из чата: состав больше не отслеживается, никого из чата не считаем присутствующим
+    async def mark_chat_left(self, chat_id: str) -> int:
+        async with self.buffer.exclusive():
+            self.buffer.discard_chat(chat_id)
+            async with AsyncSessionLocal() as session:
+                res = await session.execute(
+                    update(Member)
+                    .where(Member.chat_id == str(chat_id), Member.status == MEMBER_PRESENT)
+                    .values(status=MEMBER_LEFT, changed_at=datetime.utcnow())
+                )
+                await session.commit()
+                return res.rowcount
 
     async def list_members_by_chat(self, chat_id: str) -> List[dict]:
         async with AsyncSessionLocal() as session:
-            q = await session.execute(select(Member).where(Member.chat_id == str(chat_id)))
+            q = await session.execute(
+                select(Member).where(Member.chat_id == str(chat_id), Member.status == MEMBER_PRESENT)
+            )
             rows = q.scalars().all()
-            return [{"user_id": r.user_id, "username": r.username} for r in rows]
+            members = {r.user_id: r.username for r in rows}
+        # Учитываем ещё не записанные обновления из буфера
+        members.update(self.buffer.pending_for_chat(chat_id))
+        return [{"user_id": user_id, "username": username} for user_id, username in members.items()]
 
-    async def remove_member(self, chat_id: str, user_id: str):
+    async def list_members_page(self, chat_id: str, after_id: int, limit: int) -> List[dict]:
         async with AsyncSessionLocal() as session:
-            await session.execute(delete(Member).where(Member.chat_id == str(chat_id), Member.user_id == str(user_id)))
-            await session.commit()
+            q = await session.execute(
+                select(Member.id, Member.user_id, Member.username)
+                .where(Member.chat_id == str(chat_id), Member.status == MEMBER_PRESENT, Member.id > after_id)
+                .order_by(Member.id)
+                .limit(limit)
+            )
+            return [{"id": r.id, "user_id": r.user_id, "username": r.username} for r in q.all()]
+
+    async def count_members(self, chat_id: str) -> int:
+        async with AsyncSessionLocal() as session:
+            q = await session.execute(
+                select(func.count()).select_from(Member)
+                .where(Member.chat_id == str(chat_id), Member.status == MEMBER_PRESENT)
+            )
+            return q.scalar_one()
+
+    # Отпечаток состава чата: число присутствующих, последний добавленный и последнее изменение
+    # (смена имени у того, кто проходил по имени, тоже повод проверить чат заново)
+    async def chat_fingerprint(self, chat_id: str) -> Tuple[int, int, Optional[datetime]]:
+        async with AsyncSessionLocal() as session:
+            q = await session.execute(
+                select(func.count(), func.coalesce(func.max(Member.id), 0), func.max(Member.changed_at))
+                .where(Member.chat_id == str(chat_id), Member.status == MEMBER_PRESENT)
+            )
+            count, max_id, changed_at = q.one()
+            return int(count), int(max_id), changed_at
+
+    async def remove_member(self, chat_id: str, user_id: str):
+        async with self.buffer.exclusive():
+            self.buffer.discard(chat_id, user_id)
+            async with AsyncSessionLocal() as session:
+                await session.execute(delete(Member).where(Member.chat_id == str(chat_id),
+                                                           Member.user_id == str(user_id)))
+                await session.commit()
+
+    # Кандидаты на бан: присутствующие участники, которых нет ни в одном из списков scopes.
+    # Анти-join по нормализованным ключам; отдаётся порциями по chunk_size
+    async def stream_candidates(self, chat_id: str, scopes: List[str], chunk_size: int = settings.CLEAN_CHUNK_SIZE
+                                ) -> AsyncIterator[List[Tuple[str, Optional[str]]]]:
+        by_id = select(AllowedUser.id).where(AllowedUser.chat_id.in_(scopes), AllowedUser.user_id_key == Member.user_id)
+        by_resolved = select(AllowedUser.id).where(AllowedUser.chat_id.in_(scopes),
+                                                   AllowedUser.resolved_user_id == Member.user_id)
+        # Имя, уже привязанное к id, по имени не сверяется: его мог занять другой пользователь
+        by_name = select(AllowedUser.id).where(AllowedUser.chat_id.in_(scopes), AllowedUser.resolved_user_id.is_(None),
+                                               AllowedUser.username_key == Member.username_key)
+        stmt = (
+            select(Member.id, Member.user_id, Member.username_key)
+            .where(Member.chat_id == str(chat_id), Member.status == MEMBER_PRESENT,
+                   ~by_id.exists(), ~by_resolved.exists(), ~by_name.exists())
+            .order_by(Member.id)
+            .limit(chunk_size)
+        )
+        # Порции по ключу (id > последнего), каждая в своей короткой сессии: пока вызывающий банит порцию
+        # с ограничением скорости, соединение свободно, снимок не держится, а следующая порция видит
+        # свежие белые списки и статусы
+        after_id = 0
+        while True:
+            async with AsyncSessionLocal() as session:
+                rows = (await session.execute(stmt.where(Member.id > after_id))).all()
+            if not rows:
+                return
+            after_id = rows[-1][0]
+            yield [(r[1], r[2]) for r in rows]
+            if len(rows) < chunk_size:
+                return
 
     async def list_known_chats(self) -> List[str]:
         async with AsyncSessionLocal() as session:
-            q = await session.execute(select(distinct(Member.chat_id)))
+            q = await session.execute(select(distinct(Member.chat_id)).where(Member.status == MEMBER_PRESENT))
             rows = q.scalars().all()
-            return [str(r) for r in rows]
\ No newline at end of file
+            chats = [str(r) for r in rows]
+        for chat_id in self.buffer.pending_chats():
+            if chat_id not in chats:
+                chats.append(chat_id)
+        return chats
+
+
+ACTIVE_JOB_STATUSES = ("pending", "running")
+
+
+class CleanJobRepository:
+    async def create(self, chat_id: str, total: int) -> CleanJob:
+        async with AsyncSessionLocal() as session:
+            job = CleanJob(chat_id=str(chat_id), status="pending", cursor=0, total=total,
+                           checked=0, to_ban=0, banned=0)
+            session.add(job)
+            await session.commit()
+            return job
+
+    async def get(self, job_id: int) -> Optional[CleanJob]:
+        async with AsyncSessionLocal() as session:
+            return await session.get(CleanJob, job_id)
+
+    async def latest(self, chat_id: str) -> Optional[CleanJob]:
+        async with AsyncSessionLocal() as session:
+            q = await session.execute(
+                select(CleanJob).where(CleanJob.chat_id == str(chat_id)).order_by(CleanJob.id.desc()).limit(1)
+            )
+            return q.scalars().first()
+
+    async def get_active(self, chat_id: str) -> Optional[CleanJob]:
+        async with AsyncSessionLocal() as session:
+            q = await session.execute(
+                select(CleanJob)
+                .where(CleanJob.chat_id == str(chat_id), CleanJob.status.in_(ACTIVE_JOB_STATUSES))
+                .order_by(CleanJob.id.desc())
+                .limit(1)
+            )
+            return q.scalars().first()
+
+    async def list_resumable(self) -> List[CleanJob]:
+        async with AsyncSessionLocal() as session:
+            q = await session.execute(
+                select(CleanJob).where(CleanJob.status.in_(ACTIVE_JOB_STATUSES)).order_by(CleanJob.id)
+            )
+            return list(q.scalars().all())
+
+    async def update(self, job_id: int, **values) -> None:
+        async with AsyncSessionLocal() as session:
+            await session.execute(update(CleanJob).where(CleanJob.id == job_id).values(**values))
+            await session.commit()
+
+    # Смена статуса только у ещё активной задачи: отменённую или завершённую воркер не перезапишет
+    async def transition(self, job_id: int, status: str, **values) -> bool:
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(
+                update(CleanJob)
+                .where(CleanJob.id == job_id, CleanJob.status.in_(ACTIVE_JOB_STATUSES))
+                .values(status=status, **values)
+            )
+            await session.commit()
+            return bool(res.rowcount)
+
+    # Только прогресс: статус меняет transition
+    async def checkpoint(self, job: CleanJob) -> None:
+        await self.update(job.id, cursor=job.cursor, total=job.total, checked=job.checked,
+                          to_ban=job.to_ban, banned=job.banned)
+
+
+# Аренда роли активного экземпляра. Продление и перехват истёкшей аренды — один условный UPDATE,
+# поэтому два процесса не могут одновременно считать её своей. Время — часы экземпляров (нужен NTP)
+class InstanceLeaseRepository:
+    async def acquire(self, name: str, owner: str, ttl: float, now: Optional[datetime] = None) -> bool:
+        now = now or datetime.utcnow()
+        expires_at = now + timedelta(seconds=ttl)
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(
+                update(InstanceLease)
+                .where(InstanceLease.name == name, or_(InstanceLease.owner == owner, InstanceLease.expires_at < now))
+                .values(owner=owner, expires_at=expires_at)
+            )
+            if not res.rowcount:
+                insert_ = postgresql.insert if session.bind.dialect.name == "postgresql" else sqlite.insert
+                res = await session.execute(
+                    insert_(InstanceLease).values(name=name, owner=owner, expires_at=expires_at)
+                    .on_conflict_do_nothing(index_elements=[InstanceLease.name])
+                )
+            await session.commit()
+            return bool(res.rowcount)
+
+    async def release(self, name: str, owner: str) -> None:
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(InstanceLease).where(InstanceLease.name == name, InstanceLease.owner == owner))
+            await session.commit()
+
+    async def holder(self, name: str) -> Optional[InstanceLease]:
+        async with AsyncSessionLocal() as session:
+            return await session.get(InstanceLease, name)
@@ -0,0 +1,86 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional
+
+from .background import stop_tasks, wait_stopping
+from .config import settings
+from .repository import ActionLogRepository
+
+logger = logging.getLogger(__name__)
+
+
+def _append_archive(path: str, rows: List[dict]) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Каждая порция дописывается отдельным gzip-членом: файл остаётся читаемым, даже если проход прервался
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps({**row, "timestamp": row["timestamp"].isoformat() if row["timestamp"] else None},
+                               ensure_ascii=False))
+            f.write("\n")
+
+
+# Хранение журнала действий: записи старше AUDIT_RETENTION_DAYS порциями уходят в сжатый архив и удаляются.
+# Счётчики для /stats лежат в отдельной таблице и очисткой не затрагиваются
+class ActionLogArchiver:
+    def __init__(self, repo: Optional[ActionLogRepository] = None,
+                 retention_days: int = settings.AUDIT_RETENTION_DAYS,
+                 archive_dir: str = settings.AUDIT_ARCHIVE_DIR,
+                 batch_size: int = settings.AUDIT_ARCHIVE_BATCH,
+                 interval: float = settings.AUDIT_RETENTION_INTERVAL,
+                 clock: Callable[[], datetime] = datetime.utcnow):
+        self.repo = repo if repo is not None else ActionLogRepository()
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.clock = clock
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    async def run_once(self) -> int:
+        now = self.clock()
+        cutoff = now - timedelta(days=self.retention_days)
+        path = os.path.join(self.archive_dir, f"action_logs-{now:%Y%m%dT%H%M%S}.jsonl.gz") if self.archive_dir else None
+        total = 0
+        while self._stopping is None or not self._stopping.is_set():
+            rows = await self.repo.older_than(cutoff, self.batch_size)
+            if not rows:
+                break
+            # Сначала архив, потом удаление: при сбое между ними записи попадут в архив повторно, но не пропадут
+            if path is not None:
+                await asyncio.to_thread(_append_archive, path, rows)
+            total += await self.repo.delete_ids(r["id"] for r in rows)
+            if len(rows) < self.batch_size:
+                break
+        if total:
+            logger.info("Archived and pruned %d action log rows older than %s", total, cutoff.date())
+        return total
+
+    async def _run(self) -> None:
+        while not self._stopping.is_set():
+            started = time.monotonic()
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Action log retention pass failed")
+            await wait_stopping(self._stopping, self.interval - (time.monotonic() - started))
+
+    def start(self) -> None:
+        if self.retention_days <= 0 or self.interval <= 0:
+            logger.info("Action log retention disabled (AUDIT_RETENTION_DAYS=%s)", self.retention_days)
+            return
+        if self._task is None or self._task.done():
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    # Проход останавливается между порциями
+    async def stop(self) -> None:
+        if self._task is not None:
+            await stop_tasks([self._task], self._stopping, name="Action log retention")
+            self._task = None
+            self._stopping = None
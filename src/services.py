@@ -1,78 +1,174 @@
+import hashlib
 import logging
-from typing import List, Dict, Any, Iterable
+from typing import List, Dict, Any, Iterable, Optional, Tuple
 import asyncio
 
 from aiogram import Bot
 from aiogram.exceptions import TelegramBadRequest
 
-from .repository import AllowedUserRepository, ActionLogRepository, MemberRepository
-from .utils import parse_allowed_file_bytes
+from .allowlist import AllowlistIndex, AllowlistIndexCache, ScopedAllowlist
+from .audit import AuditSink
+from .instrumentation import record_ban
+from .logging_setup import SAMPLED
+from .outbound import Lane, OutboundScheduler
+from .models import GLOBAL_SCOPE, MEMBER_KICKED, MEMBER_LEFT
+from .ingest import UploadSpool
+from .repository import AllowedUserRepository, AllowlistImportRepository, MemberRepository
+from .workers import parse_allowed_off_loop, parse_allowed_upload
 from .config import settings
 
 logger = logging.getLogger(__name__)
 
 
+def _as_int(value) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
 class ModerationService:
-    def __init__(self, bot: Bot):
+    def __init__(self, bot: Bot, outbound: Optional[OutboundScheduler] = None):
         self.bot = bot
+        self.outbound = outbound if outbound is not None else OutboundScheduler()
         self.allowed_repo = AllowedUserRepository()
-        self.log_repo = ActionLogRepository()
+        # Журнал действий: пишется в фоне пачками
+        self.audit = AuditSink()
         self.member_repo = MemberRepository()
+        self.import_repo = AllowlistImportRepository()
+        # Последняя загрузка каждого списка: (file_unique_id, sha256); подгружается из БД при первом обращении
+        self._last_imports: Dict[str, Optional[Tuple[Optional[str], str]]] = {}
 
-    async def load_allowed_from_bytes(self, content: bytes) -> int:
-        identifiers = parse_allowed_file_bytes(content)
-        await self.allowed_repo.set_users(identifiers)
-        logger.info("Allowed users set: %d entries", len(identifiers))
-        return len(identifiers)
+        # Белые списки держим в памяти по чатам: индекс строится при первом обращении и вытесняется по LRU
+        self._allowed_cache = AllowlistIndexCache(
+            loader=self._load_allowed_scope,
+            build=AllowlistIndex,
+            budget_bytes=int(settings.ALLOWLIST_CACHE_MB * 1024 * 1024),
+        )
 
-    async def get_allowed_identifiers(self) -> List[str]:
-        return await self.allowed_repo.list_identifiers()
+    @staticmethod
+    def _scope(chat_id) -> str:
+        return GLOBAL_SCOPE if chat_id is None else str(chat_id)
 
-    def _normalize_allowed_set(self, allowed_list: Iterable[str]) -> set:
-        s = set()
-        for a in allowed_list:
-            if not a:
-                continue
-            a_str = a.strip()
-            if a_str.startswith("@"):
-                s.add(a_str.lower())
-                s.add(a_str[1:].lower())
-            elif a_str.isdigit():
-                s.add(a_str)
-            else:
-                s.add(a_str.lower())
-        return s
-
-    def _make_idents_for_member_record(self, member: Dict[str, Any]) -> set:
-        idents = set()
-        uname = member.get("username")
-        uid_val = member.get("user_id") if member.get("user_id") is not None else member.get("id")
-        if uname:
-            try:
-                uname_l = uname.lower()
-            except Exception:
-                uname_l = str(uname)
-            idents.add(f"@{uname_l}")
-            idents.add(uname_l)
-        if uid_val is not None:
-            idents.add(str(uid_val))
-        return idents
-
-    async def filter_unauthorized(self, members: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        allowed = await self.get_allowed_identifiers()
-        allowed_set = self._normalize_allowed_set(allowed)
+    async def _load_allowed_scope(self, scope: str) -> List[str]:
+        return await self.allowed_repo.list_identifiers(scope, resolved=True)
+
+    async def load_allowed_from_bytes(self, content: bytes, chat_id=None) -> Dict[str, int]:
+        scope = self._scope(chat_id)
+        identifiers = await parse_allowed_off_loop(content)
+        result = await self._sync_allowed(scope, identifiers)
+        if result["added"] or result["removed"]:
+            await self._remember_import(scope, hashlib.sha256(content).hexdigest(), result["total"])
+        return result
+
+    # Загрузка файла из Telegram. Повтор последней загрузки этого списка (тот же file_unique_id или
+    # то же содержимое) не разбирается и в БД не пишется: возвращается {"skipped": True}
+    async def load_allowed_from_upload(self, upload: UploadSpool, chat_id=None, file_unique_id: Optional[str] = None,
+                                       filename: Optional[str] = None) -> Dict[str, Any]:
+        scope = self._scope(chat_id)
+        content_hash = upload.hexdigest()
+        if await self.is_last_import(chat_id, file_unique_id=file_unique_id, content_hash=content_hash):
+            logger.info("Allowlist upload for scope=%s matches the last import, skipped", scope)
+            return {"skipped": True}
+        identifiers = await parse_allowed_upload(upload, filename)
+        result = await self._sync_allowed(scope, identifiers)
+        await self._remember_import(scope, content_hash, result["total"], file_unique_id)
+        return result
+
+    async def is_last_import(self, chat_id=None, file_unique_id: Optional[str] = None,
+                             content_hash: Optional[str] = None) -> bool:
+        scope = self._scope(chat_id)
+        if scope not in self._last_imports:
+            last = await self.import_repo.last(scope)
+            self._last_imports[scope] = (last["file_unique_id"], last["content_hash"]) if last else None
+        last = self._last_imports[scope]
+        if last is None:
+            return False
+        return (file_unique_id is not None and file_unique_id == last[0]) or \
+            (content_hash is not None and content_hash == last[1])
+
+    async def _remember_import(self, scope: str, content_hash: str, total: int,
+                               file_unique_id: Optional[str] = None) -> None:
+        await self.import_repo.record(scope, content_hash, total, file_unique_id=file_unique_id)
+        self._last_imports[scope] = (file_unique_id, content_hash)
+
+    async def _sync_allowed(self, scope: str, identifiers: List[str]) -> Dict[str, int]:
+        result = await self.allowed_repo.sync_users(identifiers, chat_id=scope)
+        # Новые имена сразу привязываем к id тех, кого бот уже видел
+        resolved = await self.allowed_repo.resolve_usernames(scope)
+        if result["added"] or result["removed"] or resolved:
+            ids = await self.allowed_repo.resolved_identifiers(scope)
+            self._allowed_cache.replace(scope, [ids.get(ident, ident) for ident in identifiers])
+        logger.info("Allowed users synced: scope=%s total=%d added=%d removed=%d unchanged=%d",
+                    scope, result["total"], result["added"], result["removed"], result["unchanged"])
+        return result
+
+    async def get_allowed_identifiers(self, chat_id=None) -> List[str]:
+        return await self.allowed_repo.list_identifiers(self._scope(chat_id))
+
+    @property
+    def allowed_version(self) -> int:
+        return self._allowed_cache.version(GLOBAL_SCOPE)
+
+    # Версия списка, действующего в чате: меняется при замене как списка чата, так и общего
+    def allowlist_version(self, chat_id=None) -> Tuple[int, int]:
+        return self._allowed_cache.version(GLOBAL_SCOPE), self._allowed_cache.version(self._scope(chat_id))
+
+    def allowlist_size(self, chat_id=None) -> int:
+        index = self._allowed_cache.peek(self._scope(chat_id))
+        return len(index) if index is not None else 0
+
+    @property
+    def allowlist_cache_bytes(self) -> int:
+        return self._allowed_cache.nbytes
+
+    def invalidate_allowed_index(self, chat_id=None) -> None:
+        self._allowed_cache.invalidate(None if chat_id is None else str(chat_id))
+
+    # Имена из этих списков привязались к id: индексы перестроятся при следующей проверке
+    def on_identities_resolved(self, scopes: List[str]) -> None:
+        for scope in scopes:
+            self._allowed_cache.invalidate(scope)
+        logger.info("Allowlist usernames resolved to ids in %d lists", len(scopes))
+
+    async def get_allowed_index(self, chat_id=None):
+        global_index = await self._allowed_cache.get(GLOBAL_SCOPE)
+        if chat_id is None:
+            return global_index
+        chat_index = await self._allowed_cache.get(str(chat_id))
+        if settings.ALLOWLIST_GLOBAL_FALLBACK:
+            return ScopedAllowlist([chat_index, global_index])
+        # Без общего списка чат без собственного списка проверяется по общему
+        return chat_index if len(chat_index) else global_index
+
+    # Какие списки действуют в чате — те же правила, что в get_allowed_index, но без загрузки индекса
+    async def allowed_scopes(self, chat_id=None) -> List[str]:
+        if chat_id is None:
+            return [GLOBAL_SCOPE]
+        if settings.ALLOWLIST_GLOBAL_FALLBACK:
+            return [str(chat_id), GLOBAL_SCOPE]
+        return [str(chat_id)] if await self.allowed_repo.has_scope(str(chat_id)) else [GLOBAL_SCOPE]
+
+    @staticmethod
+    def _member_uid(member: Dict[str, Any]):
+        return member.get("user_id") if member.get("user_id") is not None else member.get("id")
+
+    async def filter_unauthorized(self, members: Iterable[Dict[str, Any]], chat_id=None) -> List[Dict[str, Any]]:
+        members = list(members)
+        index = await self.get_allowed_index(chat_id)
+        uids = [self._member_uid(mem) for mem in members]
+        allowed = index.allowed_mask([_as_int(uid) for uid in uids], [mem.get("username") for mem in members])
         unauthorized: List[Dict[str, Any]] = []
-        for mem in members:
-            idents = self._make_idents_for_member_record(mem)
-            if idents & allowed_set:
+        for mem, uid, ok in zip(members, uids, allowed):
+            if ok:
                 continue
-            uid = mem.get("id") if mem.get("id") is not None else mem.get("user_id")
             if uid is None:
                 logger.warning("Member record has no id: %r", mem)
                 continue
-            try:
-                uid_int = int(uid)
-            except Exception:
+            uid_int = _as_int(uid)
+            if uid_int is None:
                 logger.warning("Member id not int, skip: %r", uid)
                 continue
             identifier = f"@{mem['username']}" if mem.get("username") else str(uid_int)
@@ -80,72 +176,100 @@ class ModerationService:
         return unauthorized
 
     async def ban_users(self, chat_id: int, users: List[Dict[str, Any]]) -> int:
-        banned = 0
-        for u in users:
-            uid = u.get("id")
-            identifier = u.get("identifier", str(uid))
+        # Вся пачка уходит в планировщик сразу, он сам соблюдает лимиты Telegram
+        results = await asyncio.gather(*(self._ban_one(chat_id, u) for u in users))
+        # Итог банов записываем в состав чата одним запросом: забаненные и уже ушедшие больше не проверяются
+        changed = [(str(u.get("id")), status) for u, status in zip(users, results) if status]
+        if changed:
             try:
-                logger.info("Attempting ban: chat=%s user=%s identifier=%s", chat_id, uid, identifier)
-                await self.bot.ban_chat_member(chat_id=chat_id, user_id=int(uid))
-                await self.log_repo.log(chat_id=str(chat_id), user_identifier=str(identifier), action="banned")
-                banned += 1
-                logger.info("Banned user %s in chat %s", identifier, chat_id)
-                await asyncio.sleep(0.2)
-            except TelegramBadRequest as e:
-                text = str(e).lower()
-
-                if "user_not_participant" in text or "user not participant" in text or "user not found" in text:
-                    logger.info("User %s is not participant in chat %s — removing from members DB.", identifier,
-                                chat_id)
-                    try:
-                        await self.member_repo.remove_member(chat_id=str(chat_id), user_id=str(uid))
-                        await self.log_repo.log(chat_id=str(chat_id), user_identifier=str(identifier),
-                                                action="already_left")
-                    except Exception:
-                        logger.exception("Failed removing member record for %s in chat %s", identifier, chat_id)
-                    continue
+                await self.member_repo.set_statuses(chat_id=str(chat_id), updates=changed)
+            except Exception:
+                logger.exception("Failed to update status of %d members in chat %s", len(changed), chat_id)
+        return sum(1 for status in results if status == MEMBER_KICKED)
 
-                logger.exception("Failed to ban %s in chat %s: %s", identifier, chat_id, e)
-                await self.log_repo.log(chat_id=str(chat_id), user_identifier=str(identifier), action="ban_failed",
-                                        reason=str(e))
-                if settings.ADMIN_CHAT_ID:
-                    try:
-                        await self.bot.send_message(settings.ADMIN_CHAT_ID,
-                                                    f"Ошибка при бане {identifier} в чате {chat_id}: {e}")
-                    except Exception:
-                        logger.exception("Failed to notify admin")
-            except Exception as e:
-                logger.exception("Failed to ban %s in chat %s: %s", identifier, chat_id, e)
-                await self.log_repo.log(chat_id=str(chat_id), user_identifier=str(identifier), action="ban_failed",
-                                        reason=str(e))
-                if settings.ADMIN_CHAT_ID:
-                    try:
-                        await self.bot.send_message(settings.ADMIN_CHAT_ID,
-                                                    f"Ошибка при бане {identifier} в чате {chat_id}: {e}")
-                    except Exception:
-                        logger.exception("Failed to notify admin")
-        return banned
+    # Возвращает новое состояние участника или None, если бан не удался
+    async def _ban_one(self, chat_id: int, u: Dict[str, Any]) -> Optional[str]:
+        uid = u.get("id")
+        identifier = u.get("identifier", str(uid))
+        try:
+            logger.info("Attempting ban: chat=%s user=%s", chat_id, uid, extra=SAMPLED)
+            await self.outbound.submit(
+                lambda: self.bot.ban_chat_member(chat_id=chat_id, user_id=int(uid)),
+                lane=Lane.BAN,
+                chat_id=chat_id,
+                method="banChatMember",
+            )
+            record_ban()
+            await self.audit.log(chat_id=str(chat_id), user_identifier=str(identifier), action="banned")
+            logger.info("Banned user %s in chat %s", uid, chat_id, extra=SAMPLED)
+            return MEMBER_KICKED
+        except TelegramBadRequest as e:
+            text = str(e).lower()
 
-    async def clean_chat(self, chat_id: int) -> Dict[str, int]:
-        logger.info("Starting clean_chat for chat=%s", chat_id)
-        members = await self.member_repo.list_members_by_chat(str(chat_id))
-        logger.debug("Known members for chat %s: %s", chat_id, members)
-        allowed = await self.get_allowed_identifiers()
-        allowed_set = self._normalize_allowed_set(allowed)
-        to_ban: List[Dict[str, Any]] = []
-        for m in members:
-            idents = self._make_idents_for_member_record({"username": m.get("username"), "user_id": m.get("user_id")})
-            if idents & allowed_set:
-                continue
+            if "user_not_participant" in text or "user not participant" in text or "user not found" in text:
+                logger.info("User %s is not participant in chat %s — marking as left.", uid, chat_id, extra=SAMPLED)
+                try:
+                    await self.audit.log(chat_id=str(chat_id), user_identifier=str(identifier),
+                                         action="already_left")
+                except Exception:
+                    logger.exception("Failed logging already_left for %s in chat %s", identifier, chat_id)
+                return MEMBER_LEFT
+
+            await self._ban_failed(chat_id, identifier, e)
+        except Exception as e:
+            await self._ban_failed(chat_id, identifier, e)
+        return None
+
+    async def _ban_failed(self, chat_id: int, identifier: str, e: Exception) -> None:
+        logger.exception("Failed to ban %s in chat %s: %s", identifier, chat_id, e)
+        await self.audit.log(chat_id=str(chat_id), user_identifier=str(identifier), action="ban_failed",
+                             reason=str(e))
+        if settings.ADMIN_CHAT_ID:
             try:
-                uid_int = int(m["user_id"])
+                await self.outbound.submit(
+                    lambda: self.bot.send_message(settings.ADMIN_CHAT_ID,
+                                                  f"Ошибка при бане {identifier} в чате {chat_id}: {e}"),
+                    lane=Lane.NOTICE,
+                    chat_id=settings.ADMIN_CHAT_ID,
+                    method="sendMessage",
+                )
             except Exception:
+                logger.exception("Failed to notify admin")
+
+    async def select_candidates(self, members: Iterable[Dict[str, Any]], chat_id=None) -> List[Dict[str, Any]]:
+        members = list(members)
+        index = await self.get_allowed_index(chat_id)
+        uids = [_as_int(m.get("user_id")) for m in members]
+        allowed = index.allowed_mask(uids, [m.get("username") for m in members])
+        to_ban: List[Dict[str, Any]] = []
+        for m, uid_int, ok in zip(members, uids, allowed):
+            if ok:
+                continue
+            if uid_int is None:
                 logger.warning("Skip member with invalid user_id: %r", m.get("user_id"))
                 continue
-            identifier = next(iter(idents)) if idents else str(uid_int)
+            identifier = f"@{m['username'].lower()}" if m.get("username") else str(uid_int)
             to_ban.append({"id": uid_int, "identifier": identifier})
-        logger.info("Clean candidate list for chat %s: to_ban=%d checked=%d", chat_id, len(to_ban), len(members))
-        banned = await self.ban_users(chat_id=chat_id, users=to_ban)
-        logger.info("Clean finished for chat %s: checked=%d to_ban=%d banned=%d", chat_id, len(members), len(to_ban),
-                    banned)
-        return {"checked": len(members), "to_ban": len(to_ban), "banned": banned}
\ No newline at end of file
+        return to_ban
+
+    # Кандидатов выбирает БД; в память попадает только текущая порция, и она сразу уходит на бан
+    async def clean_chat(self, chat_id: int) -> Dict[str, int]:
+        logger.info("Starting clean_chat for chat=%s", chat_id)
+        # Всё, что ещё лежит в буфере записи, должно попасть в выборку
+        await self.member_repo.flush()
+        checked = await self.member_repo.count_members(str(chat_id))
+        scopes = await self.allowed_scopes(chat_id)
+        to_ban = banned = 0
+        async for rows in self.member_repo.stream_candidates(str(chat_id), scopes):
+            users = []
+            for user_id, name_key in rows:
+                uid_int = _as_int(user_id)
+                if uid_int is None:
+                    logger.warning("Skip member with invalid user_id: %r", user_id)
+                    continue
+                users.append({"id": uid_int, "identifier": f"@{name_key}" if name_key else str(uid_int)})
+            to_ban += len(users)
+            if users:
+                banned += await self.ban_users(chat_id=chat_id, users=users)
+        logger.info("Clean finished for chat %s: checked=%d to_ban=%d banned=%d", chat_id, checked, to_ban, banned)
+        return {"checked": checked, "to_ban": to_ban, "banned": banned}
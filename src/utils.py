@@ -1,19 +1,100 @@
-from typing import List
+import csv
+import gzip
+import io
+import itertools
+import zipfile
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+# Колонки CSV, из которых берётся идентификатор, в порядке предпочтения
+_ID_COLUMNS = ("user_identifier", "identifier", "username", "user", "login", "telegram", "user_id", "id")
+_CSV_DELIMITERS = ",;\t"
+
+
+# Одна строка списка: ссылку превращаем в имя пользователя, пустые строки отбрасываем
+def clean_identifier(line: str) -> Optional[str]:
+    ln = line.strip()
+    if ln.startswith("http://") or ln.startswith("https://"):
+        ln = ln.rstrip("/").split("/")[-1].strip()
+    return ln or None
+
+
+def _strip_suffix(name: Optional[str], suffix: str) -> Optional[str]:
+    if name and name.lower().endswith(suffix):
+        return name[:-len(suffix)]
+    return name
+
+
+# Распаковка по сигнатуре, а не по имени файла: gzip и первый файл из zip-архива читаются потоком
+def _open_binary(binary: BinaryIO, name: Optional[str]) -> Tuple[BinaryIO, Optional[str]]:
+    head = binary.read(4)
+    binary.seek(0)
+    if head[:2] == b"\x1f\x8b":
+        return gzip.GzipFile(fileobj=binary, mode="rb"), _strip_suffix(name, ".gz")
+    if head == b"PK\x03\x04":
+        archive = zipfile.ZipFile(binary)
+        member = next((m for m in archive.infolist() if not m.is_dir()), None)
+        if member is None:
+            return io.BytesIO(), name
+        return archive.open(member), member.filename
+    return binary, name
+
+
+def _csv_delimiter(first_line: str, name: Optional[str]) -> Optional[str]:
+    counts = {d: first_line.count(d) for d in _CSV_DELIMITERS}
+    best = max(counts, key=counts.get)
+    if counts[best]:
+        return best
+    return "," if name and name.lower().endswith(".csv") else None
+
+
+def _id_column(header: List[str]) -> Optional[int]:
+    cells = [c.strip().lower() for c in header]
+    for column in _ID_COLUMNS:
+        if column in cells:
+            return cells.index(column)
+    return None
+
+
+def _iter_rows(lines: Iterator[str], name: Optional[str]) -> Iterator[Tuple[List[str], int]]:
+    first = next((ln for ln in lines if ln.strip()), None)
+    if first is None:
+        return
+    delimiter = _csv_delimiter(first, name)
+    if delimiter is None:
+        for ln in itertools.chain([first], lines):
+            yield [ln], 0
+        return
+    reader = csv.reader(itertools.chain([first], lines), delimiter=delimiter)
+    header = next(reader)
+    column = _id_column(header)
+    # Без узнаваемого заголовка первая строка — уже данные, идентификатор в первой колонке
+    rows: Iterable[List[str]] = reader if column is not None else itertools.chain([header], reader)
+    for row in rows:
+        yield row, column or 0
+
+
+# Идентификаторы из файла белого списка по одному: текст, CSV (колонка с идентификатором), gzip, zip.
+# Файл читается построчно, целиком в памяти не держится
+def iter_allowed_file(binary: BinaryIO, name: Optional[str] = None) -> Iterator[str]:
+    stream, name = _open_binary(binary, name)
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="ignore", newline="")
+    try:
+        for row, column in _iter_rows(iter(text), name):
+            if len(row) > column:
+                ident = clean_identifier(row[column])
+                if ident:
+                    yield ident
+    finally:
+        # Иначе TextIOWrapper при сборке мусора закроет файл вызывающего
+        text.detach()
+
 
 # Функция для разбора .txt файла с разрешёнными пользователями
-def parse_allowed_file_bytes(content: bytes) -> List[str]:
-    text = content.decode(errors="ignore")
-    lines = [line.strip() for line in text.splitlines()]
-    cleaned = []
-    for ln in lines:
-        if not ln:
-            continue
-        # Если строка — ссылка, достаём только имя пользователя
-        if ln.startswith("http://") or ln.startswith("https://"):
-            parts = ln.rstrip("/").split("/")
-            ln = parts[-1]
-        ln = ln.strip()
-        if not ln:
-            continue
-        cleaned.append(ln)
-    return cleaned
\ No newline at end of file
+def parse_allowed_file_bytes(content: bytes, name: Optional[str] = None) -> List[str]:
+    return list(iter_allowed_file(io.BytesIO(content), name))
+
+
+# Разбор файла с диска; вызывается и в пуле процессов
+def parse_allowed_path(path: str, name: Optional[str] = None) -> List[str]:
+    with open(path, "rb") as f:
+        return list(iter_allowed_file(f, name))
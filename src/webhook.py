@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import signal
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Ограничивает число апдейтов, которые обрабатываются одновременно
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any,
+                       data: Dict[str, Any]) -> Any:
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                return await handler(event, data)
+            finally:
+                self.in_flight -= 1
+
+
+def build_webhook_app(bot: Bot, dp: Dispatcher, health: Callable[[], Dict[str, Any]]) -> web.Application:
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=settings.WEBHOOK_SECRET or None,
+        handle_in_background=True,
+    ).register(app, path=settings.WEBHOOK_PATH)
+
+    async def health_handler(request: web.Request) -> web.Response:
+        return web.json_response(health())
+
+    app.router.add_get(settings.HEALTH_PATH, health_handler)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+# Работает до SIGINT/SIGTERM или до события stop (экземпляр потерял аренду)
+async def run_webhook(bot: Bot, dp: Dispatcher, health: Callable[[], Dict[str, Any]],
+                      stop: Optional[asyncio.Event] = None) -> None:
+    app = build_webhook_app(bot, dp, health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, settings.WEBHOOK_HOST, settings.WEBHOOK_PORT)
+    await site.start()
+    logger.info("Webhook server listening on %s:%s%s", settings.WEBHOOK_HOST, settings.WEBHOOK_PORT,
+                settings.WEBHOOK_PATH)
+
+    # Публичный адрес регистрируем, только если он задан: за прокси это может делать один из экземпляров
+    if settings.WEBHOOK_URL:
+        await bot.set_webhook(
+            url=settings.WEBHOOK_URL + settings.WEBHOOK_PATH,
+            secret_token=settings.WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info("Webhook registered: %s%s", settings.WEBHOOK_URL, settings.WEBHOOK_PATH)
+
+    stop = stop or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+
+from .config import settings
+from .utils import iter_allowed_file, parse_allowed_file_bytes, parse_allowed_path
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[Any, Dict[str, Any]], Awaitable[Any]]
+
+
+# Ключ шарда: чат апдейта, для апдейтов без чата — пользователь
+def update_key(data: Dict[str, Any]) -> int:
+    chat = data.get("event_chat")
+    if chat is not None:
+        return chat.id
+    user = data.get("event_from_user")
+    return user.id if user is not None else 0
+
+
+# Раскладывает апдейты по воркерам по chat_id. У каждого воркера своя ограниченная очередь,
+# и он обрабатывает её по одному апдейту: события одного чата идут строго по порядку,
+# а долгий обработчик задерживает только чаты своего шарда.
+# Подключается внешним middleware на dp.update, после встроенных (там определяется event_chat)
+class ChatShardDispatcher(BaseMiddleware):
+    def __init__(self, workers: int = settings.UPDATE_WORKERS, queue_size: int = settings.UPDATE_QUEUE_SIZE):
+        self.workers = workers
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        # asyncio.Queue.put при освобождении места может пропустить вперёд новый апдейт; Lock пускает по очереди
+        self._put_locks = [asyncio.Lock() for _ in range(workers)]
+        self._tasks: List[asyncio.Task] = []
+
+    def shard(self, key: int) -> int:
+        return key % self.workers
+
+    def qsize(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def __call__(self, handler: Handler, event: Any, data: Dict[str, Any]) -> Any:
+        if not self._tasks:
+            return await handler(event, data)
+        i = self.shard(update_key(data))
+        # Очередь полна — ждём здесь: в polling это останавливает получение новых апдейтов
+        async with self._put_locks[i]:
+            await self._queues[i].put((handler, event, data))
+        return None
+
+    async def _worker(self, i: int) -> None:
+        queue = self._queues[i]
+        while True:
+            handler, event, data = await queue.get()
+            try:
+                await handler(event, data)
+            except Exception:
+                logger.exception("Update handling failed in worker %d", i)
+            finally:
+                queue.task_done()
+
+    # Дожидается уже принятых апдейтов (не дольше timeout) и останавливает воркеры
+    async def close(self, timeout: float = settings.SHUTDOWN_TIMEOUT) -> None:
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Update workers stopped with %d updates still queued", self.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+_parse_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_parse_pool() -> ProcessPoolExecutor:
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(max_workers=settings.PARSE_WORKERS)
+    return _parse_pool
+
+
+async def _run_in_pool(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_parse_pool(), fn, *args)
+
+
+# Разбор файла белого списка вне цикла событий: большие файлы — в пуле процессов, мелкие — на месте,
+# их пересылка в другой процесс дороже самого разбора
+async def parse_allowed_off_loop(content: bytes) -> List[str]:
+    if settings.PARSE_WORKERS <= 0 or len(content) < settings.PARSE_OFFLOAD_BYTES:
+        return parse_allowed_file_bytes(content)
+    return await _run_in_pool(parse_allowed_file_bytes, content)
+
+
+# Разбор загруженного файла: с диска — в пуле процессов, из памяти — в потоке, мелкий — на месте
+async def parse_allowed_upload(upload, name: Optional[str] = None) -> List[str]:
+    if upload.path is not None and settings.PARSE_WORKERS > 0:
+        upload.flush()
+        return await _run_in_pool(parse_allowed_path, upload.path, name)
+    upload.seek(0)
+    if upload.size < settings.PARSE_OFFLOAD_BYTES:
+        return list(iter_allowed_file(upload.file, name))
+    return await asyncio.to_thread(lambda: list(iter_allowed_file(upload.file, name)))
+
+
+def shutdown_parse_pool() -> None:
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(wait=False, cancel_futures=True)
+        _parse_pool = None
@@ -0,0 +1,99 @@
+import asyncio
+import pytest
+import src.allowlist as allowlist
+from src.allowlist import AllowlistIndex, AllowlistIndexCache, ScopedAllowlist
+
+
+def make_cache(lists, budget_bytes=10 ** 9):
+    calls = []
+
+    async def loader(scope):
+        calls.append(scope)
+        await asyncio.sleep(0)
+        return lists.get(scope, [])
+
+    cache = AllowlistIndexCache(loader, lambda idents, version: AllowlistIndex(idents, version), budget_bytes)
+    return cache, calls
+
+
+@pytest.mark.asyncio
+async def test_cache_loads_lazily_once():
+    cache, calls = make_cache({"-1": ["a"]})
+    indexes = await asyncio.gather(*(cache.get("-1") for _ in range(5)))
+    assert calls == ["-1"]
+    assert all(ix.contains_username("a") for ix in indexes)
+    assert "-2" not in cache
+
+
+@pytest.mark.asyncio
+async def test_cache_evicts_least_recently_used():
+    lists = {str(i): [f"user{i}_{n}" for n in range(50)] for i in range(3)}
+    one = AllowlistIndex(lists["0"]).nbytes
+    cache, calls = make_cache(lists, budget_bytes=int(one * 2.5))
+    await cache.get("0")
+    await cache.get("1")
+    await cache.get("0")
+    await cache.get("2")
+    assert "1" not in cache
+    assert "0" in cache and "2" in cache
+    assert cache.evictions == 1
+    assert cache.nbytes <= cache.budget_bytes
+
+    await cache.get("1")
+    assert calls == ["0", "1", "2", "1"]
+
+
+@pytest.mark.asyncio
+async def test_replace_and_invalidate_bump_version():
+    cache, calls = make_cache({"-1": ["a"]})
+    await cache.get("-1")
+    cache.replace("-1", ["b"])
+    assert cache.version("-1") == 1
+    index = await cache.get("-1")
+    assert index.contains_username("b") and not index.contains_username("a")
+    assert calls == ["-1"]
+
+    cache.invalidate()
+    assert "-1" not in cache
+    assert (await cache.get("-1")).contains_username("a")
+    assert calls == ["-1", "-1"]
+
+
+def test_scoped_allowlist_matches_any():
+    scoped = ScopedAllowlist([AllowlistIndex(["a"]), AllowlistIndex([]), AllowlistIndex(["b"])])
+    assert len(scoped) == 2
+    assert scoped.allowed_mask([None, None, 5], ["b", "c", None]) == [True, False, False]
+
+
+def test_index_normalizes_identifiers():
+    index = AllowlistIndex(["@Masha", "liza", "123", "", "  @Petya  "])
+    assert index.contains_id(123) and not index.contains_id(124)
+    assert index.contains_username("masha")
+    assert index.contains_username("@MASHA")
+    assert index.contains_username("Liza")
+    assert index.contains_username("petya")
+    assert not index.contains_username("123")
+    assert not index.contains_username(None)
+
+
+@pytest.mark.parametrize("vector", [False, True])
+def test_allowed_mask_scalar_and_vector_agree(monkeypatch, vector):
+    if vector and allowlist.np is None:
+        pytest.skip("numpy is not installed")
+    monkeypatch.setattr(allowlist, "_VECTOR_MIN", 1 if vector else 10 ** 9)
+    index = AllowlistIndex([f"@user{i}" for i in range(0, 1000, 2)] + [str(i) for i in range(0, 1000, 3)])
+    ids = list(range(1000)) + [None]
+    names = [f"User{i}" for i in range(1000)] + ["user4"]
+    mask = index.allowed_mask(ids, names)
+    assert mask == [i % 2 == 0 or i % 3 == 0 for i in range(1000)] + [True]
+
+
+def test_hash_collision_falls_back_to_check(monkeypatch):
+    # Все имена получают один хэш, различаются только контрольной суммой
+    monkeypatch.setattr(allowlist, "hash_username", lambda key: 7)
+    index = AllowlistIndex(["@a", "@b", "@c"])
+    assert index.collisions == 2
+    assert index.allowed_mask([None, None, None], ["a", "c", "d"]) == [True, True, False]
+    if allowlist.np is not None:
+        monkeypatch.setattr(allowlist, "_VECTOR_MIN", 1)
+        assert index.allowed_mask([None, None, None], ["a", "c", "d"]) == [True, True, False]
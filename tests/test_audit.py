@@ -0,0 +1,167 @@
+import asyncio
+import gzip
+import json
+from datetime import datetime, timedelta
+
+import pytest
+import pytest_asyncio
+from src.db import get_engine
+from src.models import Base
+from src.audit import AuditSink
+from src.repository import ActionLogRepository
+from src.retention import ActionLogArchiver
+
+
+@pytest_asyncio.fixture(scope="function", autouse=True)
+async def prepare_db(db_backend):
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+
+
+class SlowLogRepo:
+    def __init__(self):
+        self.batches = []
+        self.gate = asyncio.Event()
+
+    async def log_many(self, rows):
+        await self.gate.wait()
+        self.batches.append(list(rows))
+
+
+@pytest.mark.asyncio
+async def test_audit_sink_writes_batches_and_reads_recent():
+    sink = AuditSink()
+    for i in range(10):
+        await sink.log(chat_id="1", user_identifier=f"@u{i}", action="banned")
+    await sink.log(chat_id="2", user_identifier="@u0", action="ban_failed", reason="boom")
+
+    recent = await sink.recent(chat_id="1", limit=3)
+    assert len(recent) == 3
+    assert all(r["chat_id"] == "1" and r["action"] == "banned" for r in recent)
+
+    by_user = await sink.recent(user_identifier="@u0")
+    assert {r["chat_id"] for r in by_user} == {"1", "2"}
+    assert sink.qsize() == 0
+
+
+@pytest.mark.asyncio
+async def test_audit_sink_backpressure():
+    repo = SlowLogRepo()
+    sink = AuditSink(repo=repo, max_queue=2, batch_size=10)
+    await sink.log(chat_id="1", user_identifier="@a", action="banned")
+    await asyncio.sleep(0)
+    await sink.log(chat_id="1", user_identifier="@b", action="banned")
+    await sink.log(chat_id="1", user_identifier="@c", action="banned")
+
+    blocked = asyncio.create_task(sink.log(chat_id="1", user_identifier="@d", action="banned"))
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+
+    repo.gate.set()
+    await blocked
+    await sink.flush()
+    written = [row["user_identifier"] for batch in repo.batches for row in batch]
+    assert written == ["@a", "@b", "@c", "@d"]
+    assert repo.batches[0] == [repo.batches[0][0]]
+
+
+class FlakyLogRepo:
+    def __init__(self):
+        self.down = True
+        self.rows = []
+
+    async def log_many(self, rows):
+        if self.down:
+            raise RuntimeError("db down")
+        self.rows.extend(rows)
+
+
+@pytest.mark.asyncio
+async def test_audit_sink_spills_failed_batches_and_replays(tmp_path):
+    repo = FlakyLogRepo()
+    spill = tmp_path / "spill.jsonl"
+    sink = AuditSink(repo=repo, batch_size=2, spill_path=str(spill))
+    for i in range(3):
+        await sink.log(chat_id="1", user_identifier=f"@u{i}", action="banned")
+    await sink.flush()
+    # БД недоступна: события не потеряны, а лежат в файле
+    assert repo.rows == [] and sink.dropped == 0 and sink.spilled == 3
+    assert spill.exists()
+
+    repo.down = False
+    await sink.log(chat_id="1", user_identifier="@u3", action="banned")
+    await sink.flush()
+    assert sorted(r["user_identifier"] for r in repo.rows) == ["@u0", "@u1", "@u2", "@u3"]
+    assert all(isinstance(r["timestamp"], datetime) for r in repo.rows)
+    assert not spill.exists() and not (tmp_path / "spill.jsonl.replay").exists()
+
+
+@pytest.mark.asyncio
+async def test_audit_sink_close_is_bounded(tmp_path):
+    repo = SlowLogRepo()
+    spill = tmp_path / "spill.jsonl"
+    sink = AuditSink(repo=repo, batch_size=1, spill_path=str(spill))
+    for i in range(3):
+        await sink.log(chat_id="1", user_identifier=f"@u{i}", action="banned")
+    await asyncio.wait_for(sink.close(timeout=0.05), 2)
+    # Зависшая запись не держит остановку; неотправленное сохранено на диск
+    assert sink.spilled == 3
+    assert len(spill.read_text().splitlines()) == 3
+
+
+@pytest.mark.asyncio
+async def test_daily_stats_follow_log_writes():
+    repo = ActionLogRepository()
+    now = datetime.utcnow()
+    rows = [{"chat_id": "1", "user_identifier": f"@u{i}", "action": "banned", "reason": None, "timestamp": now}
+            for i in range(3)]
+    rows.append({"chat_id": "1", "user_identifier": "@x", "action": "ban_failed", "reason": "boom",
+                 "timestamp": now - timedelta(days=3)})
+    rows.append({"chat_id": "1", "user_identifier": "@y", "action": "already_left", "reason": None,
+                 "timestamp": now - timedelta(days=20)})
+    rows.append({"chat_id": "2", "user_identifier": "@z", "action": "banned", "reason": None, "timestamp": now})
+    await repo.log_many(rows)
+    await repo.log(chat_id="1", user_identifier="@w", action="banned")
+
+    stats = await repo.stats("1")
+    assert stats[1] == {"banned": 4, "already_left": 0, "ban_failed": 0}
+    assert stats[7] == {"banned": 4, "already_left": 0, "ban_failed": 1}
+    assert stats[30] == {"banned": 4, "already_left": 1, "ban_failed": 1}
+    assert (await repo.stats("2"))[1]["banned"] == 1
+    assert (await repo.stats("3"))[30] == {"banned": 0, "already_left": 0, "ban_failed": 0}
+
+
+@pytest.mark.asyncio
+async def test_archiver_moves_old_rows_to_gzip(tmp_path):
+    repo = ActionLogRepository()
+    now = datetime(2024, 5, 1, 12, 0)
+    rows = [{"chat_id": "1", "user_identifier": f"@old{i}", "action": "banned", "reason": None,
+             "timestamp": now - timedelta(days=40 + i)} for i in range(5)]
+    rows.append({"chat_id": "1", "user_identifier": "@fresh", "action": "banned", "reason": None,
+                 "timestamp": now - timedelta(days=1)})
+    await repo.log_many(rows)
+
+    archiver = ActionLogArchiver(repo=repo, retention_days=30, archive_dir=str(tmp_path), batch_size=2,
+                                 clock=lambda: now)
+    assert await archiver.run_once() == 5
+    assert [r["user_identifier"] for r in await repo.recent(chat_id="1")] == ["@fresh"]
+
+    files = list(tmp_path.iterdir())
+    assert len(files) == 1 and files[0].name.endswith(".jsonl.gz")
+    with gzip.open(files[0], "rt", encoding="utf-8") as f:
+        archived = [json.loads(line) for line in f]
+    assert sorted(r["user_identifier"] for r in archived) == [f"@old{i}" for i in range(5)]
+    # Счётчики переживают очистку журнала
+    assert (await repo.stats("1", periods=(60,), today=now.date()))[60]["banned"] == 6
+    assert await archiver.run_once() == 0
+
+
+@pytest.mark.asyncio
+async def test_archiver_stops_between_passes(tmp_path):
+    archiver = ActionLogArchiver(retention_days=30, archive_dir=str(tmp_path), interval=3600)
+    archiver.start()
+    await asyncio.sleep(0.05)
+    await asyncio.wait_for(archiver.stop(), 5)
+    assert archiver._task is None
@@ -0,0 +1,89 @@
+import asyncio
+import pytest
+from src.autoclean import AutoCleanScheduler
+
+
+class FakeMemberRepo:
+    def __init__(self, chats):
+        self.chats = dict(chats)
+
+    async def flush(self):
+        return 0
+
+    async def list_known_chats(self):
+        return list(self.chats)
+
+    async def chat_fingerprint(self, chat_id):
+        return self.chats[chat_id]
+
+
+class FakeModeration:
+    def __init__(self, chats):
+        self.member_repo = FakeMemberRepo(chats)
+        self.allowed_version = 1
+        self.cleaned = []
+        self.running = 0
+        self.max_running = 0
+
+    def allowlist_version(self, chat_id):
+        return self.allowed_version
+
+    async def clean_chat(self, chat_id):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        self.cleaned.append(str(chat_id))
+        return {"checked": 1, "to_ban": 0, "banned": 0}
+
+
+@pytest.mark.asyncio
+async def test_sweep_skips_unchanged_chats():
+    moderation = FakeModeration({"-1": (2, 10), "-2": (5, 20)})
+    scheduler = AutoCleanScheduler(moderation, interval=60, concurrency=2, force=False, spread=False)
+
+    stats = await scheduler.sweep()
+    assert stats["cleaned"] == 2
+    assert sorted(moderation.cleaned) == ["-1", "-2"]
+
+    stats = await scheduler.sweep()
+    assert stats == {"cleaned": 0, "skipped": 2, "busy": 0, "failed": 0}
+
+    moderation.member_repo.chats["-2"] = (6, 21)
+    await scheduler.sweep()
+    assert moderation.cleaned[-1] == "-2"
+
+    moderation.allowed_version += 1
+    stats = await scheduler.sweep()
+    assert stats["cleaned"] == 2
+
+
+@pytest.mark.asyncio
+async def test_sweep_force_and_bounded_parallelism():
+    chats = {str(-i): (1, i) for i in range(1, 7)}
+    moderation = FakeModeration(chats)
+    scheduler = AutoCleanScheduler(moderation, interval=60, concurrency=2, force=True, spread=False)
+    await scheduler.sweep()
+    await scheduler.sweep()
+    assert len(moderation.cleaned) == 12
+    assert moderation.max_running == 2
+
+
+@pytest.mark.asyncio
+async def test_sweep_spreads_chats_over_interval():
+    moderation = FakeModeration({"-1": (1, 1), "-2": (1, 2), "-3": (1, 3)})
+    scheduler = AutoCleanScheduler(moderation, interval=0.3, concurrency=3, force=True)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    await scheduler.sweep()
+    assert loop.time() - started >= 0.2
+
+
+@pytest.mark.asyncio
+async def test_stop_skips_remaining_chats():
+    moderation = FakeModeration({"-1": (1, 1), "-2": (1, 2), "-3": (1, 3)})
+    scheduler = AutoCleanScheduler(moderation, interval=30, concurrency=3, force=True)
+    scheduler.start()
+    await asyncio.sleep(0.05)
+    await asyncio.wait_for(scheduler.stop(), 1)
+    assert moderation.cleaned == ["-1"]
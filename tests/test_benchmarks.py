@@ -0,0 +1,46 @@
+import pytest
+from benchmarks import hot_paths, soak
+from benchmarks.fake_bot_api import LatencyHistogram
+
+
+@pytest.mark.asyncio
+async def test_suite_smoke(tmp_path):
+    results = await hot_paths.run_suite({"tiny": 300}, db_url=f"sqlite+aiosqlite:///{tmp_path}/bench.sqlite3")
+    stages = results["tiny"]
+    assert set(stages) == set(hot_paths.STAGES)
+    for r in stages.values():
+        assert r["ops"] > 0 and r["throughput"] > 0
+        assert r["p99_ms"] >= r["p50_ms"]
+
+
+def test_compare_flags_regressions():
+    baseline = {"10k": {"clean_chat": {"throughput": 1000.0, "p50_ms": 10.0, "p99_ms": 20.0}}}
+    ok = {"10k": {"clean_chat": {"throughput": 900.0, "p50_ms": 11.0, "p99_ms": 40.0}}}
+    slow = {"10k": {"clean_chat": {"throughput": 500.0, "p50_ms": 20.0, "p99_ms": 40.0}}}
+    assert hot_paths.compare(ok, baseline, threshold=0.25) == []
+    assert len(hot_paths.compare(slow, baseline, threshold=0.25)) == 2
+    assert hot_paths.compare({"1M": ok["10k"]}, baseline, threshold=0.25) == []
+
+
+def test_latency_histogram_percentiles():
+    h = LatencyHistogram()
+    for ms in range(1, 101):
+        h.add(ms / 1000)
+    assert h.count == 100
+    assert h.percentile(0.5) == pytest.approx(0.050, rel=0.03)
+    assert h.percentile(0.99) == pytest.approx(0.099, rel=0.03)
+    assert h.summary()["max_ms"] == pytest.approx(100.0)
+
+
+@pytest.mark.asyncio
+async def test_soak_joins_end_to_end(tmp_path):
+    report = await soak.run_load("joins", duration=1.0, rate=20, chats=2, allowlist_size=50,
+                                 db_url=f"sqlite+aiosqlite:///{tmp_path}/load.sqlite3",
+                                 sample_interval=0.5, drain_timeout=30)
+    assert report["drained"]
+    assert report["updates_handled"] == report["updates_pushed"] > 0
+    api = report["api"]
+    assert api["pending_bans"] == 0
+    assert api["latency"]["join_to_ban"]["count"] == api["bans"] > 0
+    assert api["calls"]["getUpdates"] > 0
+    assert report["memory"]["samples"]
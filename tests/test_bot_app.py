@@ -1,30 +1,48 @@
 import pytest
 from src.bot_app import BotApp
+from src.db import get_engine
+from src.models import Base
 
 class DummyBot:
     async def set_my_commands(self, *args, **kwargs):
         return True
 
     class session:
+        @staticmethod
+        def middleware(middleware):
+            return middleware
+
         @staticmethod
         async def close():
             return True
 
 class DummyDispatcher:
+    class update:
+        @staticmethod
+        def outer_middleware(middleware):
+            return middleware
+
     def include_router(self, *args, **kwargs):
         pass
 
-    async def start_polling(self, bot):
+    def resolve_used_update_types(self):
+        return ["message", "chat_member", "my_chat_member"]
+
+    async def start_polling(self, bot, **kwargs):
         return True
 
 async def dummy_init_db():
-    return None
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
 
 @pytest.mark.asyncio
-async def test_bot_app_start(monkeypatch):
+async def test_bot_app_start(monkeypatch, db_backend):
     monkeypatch.setattr("src.bot_app.Bot", lambda token: DummyBot())
     monkeypatch.setattr("src.bot_app.Dispatcher", lambda: DummyDispatcher())
     monkeypatch.setattr("src.bot_app.init_db", dummy_init_db)
 
     app = BotApp()
     await app.start()
+    # Остановившийся экземпляр отдаёт аренду резервному
+    assert await app.lease.repo.holder("bot") is None
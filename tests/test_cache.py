@@ -0,0 +1,45 @@
+from src.cache import PresenceCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_hit_until_ttl_or_username_change():
+    clock = Clock()
+    cache = PresenceCache(ttl=10, max_bytes=10 ** 6, clock=clock)
+    assert not cache.is_fresh(1, 42, "liza")
+    cache.put(1, 42, "liza")
+    assert cache.is_fresh("1", "42", "liza")
+    assert not cache.is_fresh(1, 42, "liza_new")
+    assert not cache.is_fresh(2, 42, "liza")
+    clock.now = 10
+    assert not cache.is_fresh(1, 42, "liza")
+    assert (cache.hits, cache.misses) == (1, 4)
+
+
+def test_memory_cap_evicts_least_recent():
+    cache = PresenceCache(ttl=10, max_bytes=10 ** 6)
+    cache.put(1, 1, "a")
+    cache.max_bytes = cache.nbytes * 3
+    cache.put(1, 2, "b")
+    cache.put(1, 3, "c")
+    assert cache.is_fresh(1, 1, "a")
+    cache.put(1, 4, "d")
+    assert len(cache) == 3
+    assert cache.evictions == 1
+    assert not cache.is_fresh(1, 2, "b")
+    assert cache.nbytes <= cache.max_bytes
+
+
+def test_invalidate():
+    cache = PresenceCache(ttl=10, max_bytes=10 ** 6)
+    cache.put_many({("1", "1"): "a", ("1", "2"): None})
+    assert cache.is_fresh(1, 2, None)
+    cache.invalidate(1, 2)
+    cache.invalidate_many([("1", "1")])
+    assert len(cache) == 0 and cache.nbytes == 0
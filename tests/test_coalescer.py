@@ -0,0 +1,60 @@
+import asyncio
+import pytest
+from src.coalescer import JoinCoalescer, JOIN_BATCH_SIZE, JOIN_TO_BAN_SECONDS
+
+
+class FakeModeration:
+    def __init__(self, allowed_ids):
+        self.allowed_ids = set(allowed_ids)
+        self.checks = []
+        self.bans = []
+
+    async def filter_unauthorized(self, members, chat_id=None):
+        members = list(members)
+        self.checks.append(members)
+        return [{"id": m["id"], "identifier": str(m["id"])} for m in members if m["id"] not in self.allowed_ids]
+
+    async def ban_users(self, chat_id, users):
+        self.bans.append((chat_id, [u["id"] for u in users]))
+        return len(users)
+
+
+@pytest.mark.asyncio
+async def test_joins_within_window_are_checked_as_one_batch():
+    moderation = FakeModeration(allowed_ids=[2])
+    coalescer = JoinCoalescer(moderation, window=0.05, max_batch=100)
+    batches_before = JOIN_BATCH_SIZE.count()
+    latencies_before = JOIN_TO_BAN_SECONDS.count()
+
+    coalescer.submit(-1, [(1, "a")])
+    coalescer.submit(-1, [(2, "b"), (3, None)])
+    coalescer.submit(-2, [(4, "d")])
+    coalescer.submit(-1, [(1, "a_renamed")])
+    assert coalescer.pending(-1) == 3
+    await asyncio.sleep(0.1)
+
+    assert len(moderation.checks) == 2
+    assert sorted(moderation.bans) == [(-2, [4]), (-1, [1, 3])]
+    assert [{"id": 1, "username": "a_renamed"}, {"id": 2, "username": "b"}, {"id": 3, "username": None}] \
+        in moderation.checks
+    assert JOIN_BATCH_SIZE.count() == batches_before + 2
+    assert JOIN_TO_BAN_SECONDS.count() == latencies_before + 3
+
+
+@pytest.mark.asyncio
+async def test_full_batch_flushes_without_waiting():
+    moderation = FakeModeration(allowed_ids=[])
+    coalescer = JoinCoalescer(moderation, window=10, max_batch=3)
+    coalescer.submit(-1, [(1, None), (2, None), (3, None)])
+    await asyncio.sleep(0.01)
+    assert moderation.bans == [(-1, [1, 2, 3])]
+    assert coalescer.pending(-1) == 0
+
+
+@pytest.mark.asyncio
+async def test_close_flushes_pending_joins():
+    moderation = FakeModeration(allowed_ids=[])
+    coalescer = JoinCoalescer(moderation, window=10, max_batch=100)
+    coalescer.submit(-1, [(7, None)])
+    await coalescer.close()
+    assert moderation.bans == [(-1, [7])]
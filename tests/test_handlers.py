@@ -1,12 +1,23 @@
 import pytest
 from types import SimpleNamespace
-from src.handlers import cmd_start, universal_logger_and_handlers
+from src.handlers import cmd_start, member_repo, router, member_state, on_chat_member, universal_logger_and_handlers
 
 class DummyBot:
+    def __init__(self, admin_of=()):
+        self.downloads = 0
+        self.admin_of = admin_of
+        self.member_checks = 0
+
+    async def get_chat_member(self, chat_id, user_id):
+        self.member_checks += 1
+        return SimpleNamespace(status="administrator" if chat_id in self.admin_of else "member")
+
     async def get_file(self, *args, **kwargs):
         return SimpleNamespace(file_path="x")
 
-    async def download_file(self, *args, **kwargs):
+    async def download_file(self, *args, destination=None, **kwargs):
+        self.downloads += 1
+        destination.write(b"@masha\n")
         return None
 
 class DummyMessage:
@@ -32,3 +43,178 @@ async def test_universal_handler_clean_private():
     msg = DummyMessage(text="/clean", chat_type="private")
     await universal_logger_and_handlers(msg)
     assert "только в группе" in msg.last_answer.lower()
+
+@pytest.mark.asyncio
+async def test_member_state():
+    assert member_state(SimpleNamespace(status="administrator")) == "member"
+    assert member_state(SimpleNamespace(status="restricted", is_member=True)) == "member"
+    assert member_state(SimpleNamespace(status="restricted", is_member=False)) == "left"
+    assert member_state(SimpleNamespace(status="kicked")) == "kicked"
+    assert member_state(SimpleNamespace(status="left")) == "left"
+
+@pytest.mark.asyncio
+async def test_chat_member_update_sets_status(monkeypatch):
+    calls = []
+
+    async def fake_set_status(**kwargs):
+        calls.append(kwargs)
+
+    monkeypatch.setattr(member_repo, "set_status", fake_set_status)
+    user = SimpleNamespace(id=42, username="liza")
+    event = SimpleNamespace(chat=SimpleNamespace(id=-100),
+                            new_chat_member=SimpleNamespace(status="left", user=user))
+    await on_chat_member(event)
+    event.new_chat_member = SimpleNamespace(status="member", user=user)
+    await on_chat_member(event)
+    assert calls == [
+        {"chat_id": "-100", "user_id": "42", "status": "left", "username": None},
+        {"chat_id": "-100", "user_id": "42", "status": "member", "username": "liza"},
+    ]
+
+class FakeModeration:
+    def __init__(self):
+        self.last = None
+
+    async def is_last_import(self, chat_id=None, file_unique_id=None, content_hash=None):
+        return file_unique_id is not None and file_unique_id == self.last
+
+    async def load_allowed_from_upload(self, upload, chat_id=None, file_unique_id=None, filename=None):
+        self.last = file_unique_id
+        return {"total": 1, "added": 1, "removed": 0, "unchanged": 0}
+
+@pytest.mark.asyncio
+async def test_repeated_document_is_not_downloaded(monkeypatch):
+    monkeypatch.setattr("src.handlers.settings.ADMIN_CHAT_ID", 1)
+    monkeypatch.setattr(router, "_moderation", FakeModeration(), raising=False)
+    msg = DummyMessage(chat_type="private")
+    msg.caption = None
+    msg.document = SimpleNamespace(file_id="f1", file_unique_id="u1", file_name="list.txt", mime_type="text/plain")
+    await universal_logger_and_handlers(msg)
+    assert "обновлен" in msg.last_answer
+    await universal_logger_and_handlers(msg)
+    assert "уже загружен" in msg.last_answer
+    assert msg.bot.downloads == 1
+
+@pytest.mark.asyncio
+async def test_private_upload_requires_admin(monkeypatch):
+    moderation = FakeModeration()
+    monkeypatch.setattr(router, "_moderation", moderation, raising=False)
+    msg = DummyMessage(chat_type="private")
+    msg.caption = None
+    msg.document = SimpleNamespace(file_id="f1", file_unique_id="u1", file_name="list.txt", mime_type="text/plain")
+    # Без ADMIN_CHAT_ID и от чужого пользователя файл в личке не принимается
+    monkeypatch.setattr("src.handlers.settings.ADMIN_CHAT_ID", None)
+    await universal_logger_and_handlers(msg)
+    assert "Только админ" in msg.last_answer
+    monkeypatch.setattr("src.handlers.settings.ADMIN_CHAT_ID", 99)
+    await universal_logger_and_handlers(msg)
+    assert "Только админ" in msg.last_answer
+    assert msg.bot.downloads == 0 and moderation.last is None
+
+    # Админ бота, но не админ чата из подписи
+    monkeypatch.setattr("src.handlers.settings.ADMIN_CHAT_ID", 1)
+    msg.caption = "-100"
+    await universal_logger_and_handlers(msg)
+    assert "Только админ" in msg.last_answer
+    msg.bot.admin_of = (-100,)
+    await universal_logger_and_handlers(msg)
+    assert "обновлен" in msg.last_answer and "чата -100" in msg.last_answer
+
+@pytest.mark.asyncio
+async def test_group_upload_requires_chat_admin(monkeypatch):
+    moderation = FakeModeration()
+    monkeypatch.setattr(router, "_moderation", moderation, raising=False)
+    monkeypatch.setattr("src.handlers.settings.ADMIN_CHAT_ID", None)
+    msg = DummyMessage(chat_type="supergroup")
+    msg.chat.id = -100
+    msg.caption = None
+    # Обычный файл в группе не трогает ни права, ни белый список
+    msg.document = SimpleNamespace(file_id="p1", file_unique_id="up1", file_name="photo.png", mime_type="image/png")
+    await universal_logger_and_handlers(msg)
+    assert not hasattr(msg, "last_answer") and msg.bot.member_checks == 0
+
+    msg.document = SimpleNamespace(file_id="f1", file_unique_id="u1", file_name="list.txt", mime_type="text/plain")
+    await universal_logger_and_handlers(msg)
+    assert "Только админ" in msg.last_answer
+    assert msg.bot.downloads == 0 and moderation.last is None
+    msg.bot.admin_of = (-100,)
+    await universal_logger_and_handlers(msg)
+    assert "обновлен" in msg.last_answer and "чата -100" in msg.last_answer
+
+@pytest.mark.asyncio
+async def test_stats_command_reads_counters(monkeypatch):
+    class FakeLog:
+        async def stats(self, chat_id, periods=(1, 7, 30)):
+            assert chat_id == "1"
+            return {n: {"banned": n, "already_left": 0, "ban_failed": 1} for n in periods}
+
+    async def fake_queue_upsert(**kwargs):
+        pass
+
+    monkeypatch.setattr(member_repo, "queue_upsert", fake_queue_upsert)
+    monkeypatch.setattr(router, "_moderation", SimpleNamespace(audit=FakeLog()), raising=False)
+    msg = DummyMessage(text="/stats", chat_type="group")
+    await universal_logger_and_handlers(msg)
+    assert "Сегодня: забанено 1" in msg.last_answer
+    assert "30 дней: забанено 30" in msg.last_answer
+
+
+@pytest.mark.asyncio
+async def test_profile_command_admin_only(monkeypatch):
+    monkeypatch.setattr("src.handlers.settings.ADMIN_CHAT_ID", 99)
+    msg = DummyMessage(text="/profile 5")
+    await universal_logger_and_handlers(msg)
+    assert "Только админ" in msg.last_answer
+
+    started = []
+
+    class FakeProfiler:
+        def clamp(self, seconds):
+            return min(seconds, 30)
+
+        def start(self, bot, chat_id, seconds):
+            started.append((chat_id, seconds))
+            return True
+
+    monkeypatch.setattr("src.handlers.settings.ADMIN_CHAT_ID", 1)
+    monkeypatch.setattr(router, "_profiler", FakeProfiler(), raising=False)
+    await universal_logger_and_handlers(msg)
+    assert started == [(1, 5.0)]
+    assert "5 с" in msg.last_answer
+    msg.text = "/profile slow"
+    await universal_logger_and_handlers(msg)
+    assert "обработчик" in msg.last_answer
+
+@pytest.mark.asyncio
+async def test_leave_inside_join_window_is_not_overwritten(db_backend, monkeypatch):
+    from sqlalchemy import select
+    from src.coalescer import JoinCoalescer
+    from src.db import AsyncSessionLocal, get_engine
+    from src.models import Base, Member
+
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+    class AllowAll:
+        async def filter_unauthorized(self, members, chat_id=None):
+            return []
+
+    joins = JoinCoalescer(AllowAll(), window=10)
+    monkeypatch.setattr(router, "_joins", joins, raising=False)
+    monkeypatch.setattr(router, "_moderation", None, raising=False)
+    join = DummyMessage(chat_type="supergroup")
+    join.chat.id = -100
+    join.new_chat_members = [SimpleNamespace(id=42, username="liza")]
+    await universal_logger_and_handlers(join)
+    leave = DummyMessage(chat_type="supergroup")
+    leave.chat.id = -100
+    leave.left_chat_member = SimpleNamespace(id=42, username="liza")
+    # Выход пришёл, пока вход ещё ждёт проверки в окне склейки
+    await universal_logger_and_handlers(leave)
+    await joins.close()
+    await member_repo.flush()
+
+    async with AsyncSessionLocal() as session:
+        status = (await session.execute(select(Member.status).where(Member.user_id == "42"))).scalar_one()
+    assert status == "left"
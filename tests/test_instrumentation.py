@@ -0,0 +1,90 @@
+import datetime
+from types import SimpleNamespace
+import pytest
+from aiogram import Dispatcher, Router
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import BanChatMember
+from aiogram.types import Chat, Message, Update, User
+from src.db import DB_STATEMENT_SECONDS, get_engine, statement_label
+from src.instrumentation import (BOT_API_ERRORS, BOT_API_SECONDS, HANDLER_SECONDS, BotApiMetricsMiddleware,
+                                 HandlerLatencyMiddleware, api_method_name)
+from src.models import Base
+from src.profiling import slow_handlers
+from src.repository import MemberRepository
+
+
+def make_update(text="hi"):
+    message = Message(message_id=1, date=datetime.datetime.now(), chat=Chat(id=-100, type="supergroup"),
+                      from_user=User(id=7, is_bot=False, first_name="T"), text=text)
+    return Update(update_id=1, message=message)
+
+
+@pytest.mark.asyncio
+async def test_handler_latency_recorded_per_handler():
+    router = Router()
+    router.message.middleware(HandlerLatencyMiddleware())
+
+    @router.message()
+    async def metrics_probe_handler(message):
+        return True
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    before = HANDLER_SECONDS.count(handler="metrics_probe_handler")
+    await dp.feed_update(bot=SimpleNamespace(id=42), update=make_update())
+    assert HANDLER_SECONDS.count(handler="metrics_probe_handler") == before + 1
+
+
+@pytest.mark.asyncio
+async def test_slow_handler_recorded_with_update_type_and_chat(monkeypatch):
+    router = Router()
+    router.message.middleware(HandlerLatencyMiddleware())
+
+    @router.message()
+    async def slow_probe_handler(message):
+        return True
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    monkeypatch.setattr(slow_handlers, "threshold", 0.0)
+    await dp.feed_update(bot=SimpleNamespace(id=42), update=make_update())
+    entry = next(e for e in slow_handlers.slowest(len(slow_handlers)) if e["handler"] == "slow_probe_handler")
+    assert entry["update_type"] == "message"
+    assert entry["chat_id"] == -100
+
+
+@pytest.mark.asyncio
+async def test_bot_api_metrics_count_latency_and_errors():
+    middleware = BotApiMetricsMiddleware()
+    method = BanChatMember(chat_id=-1, user_id=2)
+
+    async def ok(bot, m):
+        return True
+
+    async def fail(bot, m):
+        raise TelegramBadRequest(method=m, message="Bad Request: user not found")
+
+    before = BOT_API_SECONDS.count(method="ban_chat_member")
+    errors = BOT_API_ERRORS.value(method="ban_chat_member", error="TelegramBadRequest")
+    assert await middleware(ok, None, method) is True
+    with pytest.raises(TelegramBadRequest):
+        await middleware(fail, None, method)
+    assert BOT_API_SECONDS.count(method="ban_chat_member") == before + 2
+    assert BOT_API_ERRORS.value(method="ban_chat_member", error="TelegramBadRequest") == errors + 1
+    assert api_method_name(method) == "ban_chat_member"
+
+
+def test_statement_label():
+    assert statement_label("INSERT INTO members (chat_id) VALUES (?)") == "INSERT members"
+    assert statement_label("UPDATE clean_jobs SET status=?") == "UPDATE clean_jobs"
+    assert statement_label("SELECT 1") == "SELECT"
+
+
+@pytest.mark.asyncio
+async def test_db_statements_are_timed(db_backend):
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    before = DB_STATEMENT_SECONDS.count(statement="INSERT members")
+    await MemberRepository().upsert_member(chat_id="1", user_id="2", username="x")
+    assert DB_STATEMENT_SECONDS.count(statement="INSERT members") == before + 1
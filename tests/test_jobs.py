@@ -0,0 +1,197 @@
+import asyncio
+import pytest
+import pytest_asyncio
+from src.db import get_engine
+from src.models import Base
+from src.jobs import CleanJobManager, format_job
+from src.repository import CleanJobRepository
+from src.services import ModerationService
+
+
+@pytest_asyncio.fixture(scope="function", autouse=True)
+async def prepare_db(db_backend):
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+
+
+class FakeAllowedRepo:
+    def __init__(self, idents):
+        self._idents = list(idents)
+
+    async def list_identifiers(self, chat_id="*", resolved=False):
+        return list(self._idents) if chat_id == "*" else []
+
+
+class FakeMemberRepo:
+    def __init__(self, members):
+        self._members = [dict(m, id=i + 1) for i, m in enumerate(members)]
+        self.pages = []
+        self.gate = None
+
+    async def flush(self):
+        return 0
+
+    async def set_statuses(self, chat_id, updates):
+        pass
+
+    async def count_members(self, chat_id):
+        return len(self._members)
+
+    async def list_members_page(self, chat_id, after_id, limit):
+        if self.gate is not None:
+            await self.gate.wait()
+        page = [m for m in self._members if m["id"] > after_id][:limit]
+        self.pages.append(after_id)
+        return page
+
+
+class FakeLogRepo:
+    async def log(self, chat_id, user_identifier, action, reason=None):
+        pass
+
+
+class DummyBot:
+    def __init__(self):
+        self.banned = []
+        self.edits = []
+
+    async def ban_chat_member(self, chat_id, user_id):
+        self.banned.append(user_id)
+        return True
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        self.edits.append((chat_id, message_id, text))
+
+
+def make_manager(members, allowed, chunk_size=2):
+    bot = DummyBot()
+    svc = ModerationService(bot)
+    svc.allowed_repo = FakeAllowedRepo(allowed)
+    svc.member_repo = FakeMemberRepo(members)
+    svc.audit = FakeLogRepo()
+    return CleanJobManager(bot, svc, chunk_size=chunk_size, progress_interval=0), bot
+
+
+MEMBERS = [
+    {"user_id": "1", "username": "allowed"},
+    {"user_id": "2", "username": "stranger"},
+    {"user_id": "3", "username": None},
+    {"user_id": "4", "username": "friend"},
+    {"user_id": "5", "username": "other"},
+]
+
+
+@pytest.mark.asyncio
+async def test_clean_job_runs_in_checkpointed_chunks():
+    manager, bot = make_manager(MEMBERS, ["@allowed", "@friend"])
+    job, created = await manager.enqueue(-100, progress_message_id=7)
+    assert created
+    await manager.wait(job.id)
+
+    saved = await CleanJobRepository().get(job.id)
+    assert saved.status == "done"
+    assert (saved.checked, saved.to_ban, saved.banned, saved.cursor) == (5, 3, 3, 5)
+    assert sorted(bot.banned) == [2, 3, 5]
+    assert manager.member_repo.pages == [0, 2, 4, 5]
+    assert bot.edits and bot.edits[-1][1] == 7
+    assert "завершена" in bot.edits[-1][2]
+
+
+@pytest.mark.asyncio
+async def test_clean_job_resumes_from_checkpoint():
+    repo = CleanJobRepository()
+    job = await repo.create("-100", total=5)
+    await repo.update(job.id, status="running", cursor=3, checked=3)
+
+    manager, bot = make_manager(MEMBERS, ["@allowed"])
+    assert await manager.resume() == 1
+    await manager.wait(job.id)
+
+    saved = await repo.get(job.id)
+    assert saved.status == "done"
+    assert saved.checked == 5
+    assert sorted(bot.banned) == [4, 5]
+
+
+@pytest.mark.asyncio
+async def test_clean_job_cancel():
+    manager, bot = make_manager(MEMBERS, [])
+    manager.member_repo.gate = asyncio.Event()
+    job, _ = await manager.enqueue(-100)
+    await asyncio.sleep(0.01)
+
+    cancelled = await manager.cancel(-100)
+    assert cancelled.id == job.id
+    manager.member_repo.gate.set()
+    await manager.wait(job.id)
+
+    saved = await CleanJobRepository().get(job.id)
+    assert saved.status == "cancelled"
+    assert await manager.active(-100) is None
+    assert "отменена" in format_job(saved)
+
+
+@pytest.mark.asyncio
+async def test_cancel_keeps_finished_job(monkeypatch):
+    manager, _ = make_manager(MEMBERS, [])
+    job = await manager.repo.create("-100", total=5)
+    stale = await manager.repo.get(job.id)
+    assert await manager.repo.transition(job.id, "done")
+
+    # Задача завершилась после того, как /clean cancel её прочитала
+    async def get_active(chat_id):
+        return stale
+
+    monkeypatch.setattr(manager.repo, "get_active", get_active)
+    assert await manager.cancel(-100) is None
+    assert stale.status != "cancelled"
+    assert (await manager.repo.get(job.id)).status == "done"
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_keeps_concurrent_cancel():
+    repo = CleanJobRepository()
+    job = await repo.create("-100", total=5)
+    assert await repo.transition(job.id, "running")
+    # /clean cancel пришла, пока воркер обрабатывал порцию со своей копией задачи
+    await repo.update(job.id, status="cancelled")
+    job.status, job.cursor, job.checked = "running", 2, 2
+    await repo.checkpoint(job)
+    assert not await repo.transition(job.id, "done")
+
+    saved = await repo.get(job.id)
+    assert (saved.status, saved.cursor, saved.checked) == ("cancelled", 2, 2)
+    assert await repo.list_resumable() == []
+
+
+@pytest.mark.asyncio
+async def test_enqueue_returns_active_job():
+    manager, _ = make_manager(MEMBERS, [])
+    manager.member_repo.gate = asyncio.Event()
+    job, created = await manager.enqueue(-100)
+    again, created_again = await manager.enqueue(-100)
+    assert created and not created_again
+    assert again.id == job.id
+    manager.member_repo.gate.set()
+    await manager.wait(job.id)
+
+
+@pytest.mark.asyncio
+async def test_close_pauses_job_between_chunks():
+    manager, bot = make_manager(MEMBERS, [])
+    manager.member_repo.gate = asyncio.Event()
+    job, _ = await manager.enqueue(-100)
+    await asyncio.sleep(0.01)
+
+    # Остановка ждёт текущую порцию и не отменяет задачу посреди запроса
+    closing = asyncio.create_task(manager.close())
+    await asyncio.sleep(0.01)
+    manager.member_repo.gate.set()
+    await asyncio.wait_for(closing, 5)
+
+    saved = await CleanJobRepository().get(job.id)
+    assert saved.status == "running"
+    assert saved.cursor == 2
+    assert [j.id for j in await CleanJobRepository().list_resumable()] == [job.id]
@@ -0,0 +1,65 @@
+import asyncio
+from datetime import datetime, timedelta
+import pytest
+import pytest_asyncio
+from src.db import get_engine
+from src.lease import InstanceLease
+from src.models import Base
+from src.repository import InstanceLeaseRepository
+
+
+@pytest_asyncio.fixture(scope="function", autouse=True)
+async def prepare_db(db_backend):
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+
+
+@pytest.mark.asyncio
+async def test_lease_held_by_one_owner_until_expired():
+    repo = InstanceLeaseRepository()
+    now = datetime.utcnow()
+    assert await repo.acquire("bot", "a", 30, now=now)
+    assert not await repo.acquire("bot", "b", 30, now=now)
+    # Владелец продлевает свою аренду
+    assert await repo.acquire("bot", "a", 30, now=now + timedelta(seconds=20))
+    assert not await repo.acquire("bot", "b", 30, now=now + timedelta(seconds=40))
+    # Истёкшую аренду перехватывает другой экземпляр
+    assert await repo.acquire("bot", "b", 30, now=now + timedelta(seconds=60))
+    assert (await repo.holder("bot")).owner == "b"
+    await repo.release("bot", "a")
+    assert (await repo.holder("bot")).owner == "b"
+    await repo.release("bot", "b")
+    assert await repo.holder("bot") is None
+
+
+@pytest.mark.asyncio
+async def test_standby_takes_over_after_release():
+    active = InstanceLease(ttl=0.3, owner="a")
+    standby = InstanceLease(ttl=0.3, owner="b")
+    assert await active.acquire()
+    assert active.active
+
+    waiting = asyncio.create_task(standby.acquire())
+    await asyncio.sleep(0.15)
+    assert not waiting.done() and not standby.active
+    await active.release()
+    assert await asyncio.wait_for(waiting, 2)
+    assert standby.active
+    await standby.release()
+
+
+@pytest.mark.asyncio
+async def test_lost_lease_stops_instance():
+    lease = InstanceLease(ttl=0.3, owner="a")
+    assert await lease.acquire()
+    lost = asyncio.Event()
+    lease.start(on_lost=lost.set)
+    # Аренду перехватили (например, экземпляр завис дольше TTL)
+    await InstanceLeaseRepository().acquire("bot", "b", 30, now=datetime.utcnow() + timedelta(seconds=1))
+    await asyncio.wait_for(lost.wait(), 2)
+    assert not lease.active
+    await lease.release()
+    assert (await InstanceLeaseRepository().holder("bot")).owner == "b"
+    await InstanceLeaseRepository().release("bot", "b")
@@ -0,0 +1,67 @@
+import io
+import json
+import logging
+from src.logging_setup import SAMPLED, JsonFormatter, RepeatFilter, SamplingFilter, setup_logging, stop_logging
+
+
+def make_record(msg="hello %s", args=("world",), level=logging.INFO, **extra):
+    record = logging.LogRecord("test", level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter_includes_extra():
+    line = JsonFormatter().format(make_record(chat_id=-100))
+    data = json.loads(line)
+    assert data["msg"] == "hello world"
+    assert data["level"] == "INFO"
+    assert data["chat_id"] == -100
+
+
+def test_sampling_filter_only_affects_marked_records():
+    off = SamplingFilter(0.0)
+    assert off.filter(make_record())
+    assert not off.filter(make_record(**SAMPLED))
+    assert SamplingFilter(1.0).filter(make_record(**SAMPLED))
+
+
+def test_repeat_filter_suppresses_identical_errors(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("src.logging_setup.time.monotonic", lambda: now[0])
+    f = RepeatFilter(window=60)
+    assert f.filter(make_record("ban failed %s", ("a",), logging.ERROR))
+    assert not f.filter(make_record("ban failed %s", ("b",), logging.ERROR))
+    assert not f.filter(make_record("ban failed %s", ("c",), logging.ERROR))
+    assert f.filter(make_record("other %s", ("a",), logging.ERROR))
+    assert f.filter(make_record("info %s", ("a",), logging.INFO))
+    assert f.filter(make_record("info %s", ("a",), logging.INFO))
+
+    now[0] += 61
+    record = make_record("ban failed %s", ("d",), logging.ERROR)
+    assert f.filter(record)
+    assert record.suppressed == 2
+
+
+def test_setup_logging_writes_json_through_queue():
+    root, aiogram = logging.getLogger(), logging.getLogger("aiogram")
+    levels = root.level, aiogram.level
+    stream = io.StringIO()
+    setup_logging(level="INFO", aiogram_level="WARNING", fmt="json", sample_rate=0.0, repeat_window=60,
+                  stream=stream)
+    try:
+        log = logging.getLogger("src.test_probe")
+        log.info("kept %d", 1)
+        log.info("sampled out", extra=SAMPLED)
+        log.debug("below level")
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            log.exception("failed")
+        assert aiogram.level == logging.WARNING
+    finally:
+        stop_logging()
+        root.setLevel(levels[0])
+        aiogram.setLevel(levels[1])
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [line["msg"] for line in lines] == ["kept 1", "failed"]
+    assert "ValueError: boom" in lines[1]["exc"]
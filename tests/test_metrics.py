@@ -0,0 +1,80 @@
+import aiohttp
+import pytest
+from src.metrics import MetricsRegistry, RateMeter, render_prometheus, start_metrics_server
+
+
+def test_counter_with_labels():
+    registry = MetricsRegistry()
+    counter = registry.counter("requests_total", "Requests")
+    counter.inc(method="ban")
+    counter.inc(2, method="ban")
+    counter.inc(method="send")
+    assert counter.value(method="ban") == 3
+    assert counter.value(method="send") == 1
+    assert registry.counter("requests_total", "Requests") is counter
+
+
+def test_histogram_observe():
+    registry = MetricsRegistry()
+    hist = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    hist.observe(0.05)
+    hist.observe(0.5)
+    hist.observe(5)
+    assert hist.count() == 3
+    assert hist.sum() == pytest.approx(5.55)
+
+
+def test_registry_rejects_kind_mismatch():
+    registry = MetricsRegistry()
+    registry.counter("x", "x")
+    with pytest.raises(ValueError):
+        registry.histogram("x", "x")
+
+
+def test_gauge_values_and_callbacks():
+    registry = MetricsRegistry()
+    gauge = registry.gauge("queue_depth", "Queue")
+    gauge.set(3, queue="a")
+    gauge.inc(queue="a")
+    gauge.set_function(lambda: 7, queue="b")
+    assert gauge.value(queue="a") == 4
+    assert gauge.value(queue="b") == 7
+
+
+def test_rate_meter():
+    meter = RateMeter(window=10)
+    meter.mark(5)
+    meter.mark()
+    assert meter.rate() == pytest.approx(0.6)
+
+
+def test_render_prometheus_text():
+    registry = MetricsRegistry()
+    registry.counter("bans_total", "Bans").inc(2, chat='-1"x')
+    hist = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    hist.observe(0.05, handler="h")
+    hist.observe(0.5, handler="h")
+    registry.gauge("broken", "Broken").set_function(lambda: 1 / 0)
+    text = render_prometheus(registry)
+    assert "# TYPE bans_total counter" in text
+    assert 'bans_total{chat="-1\\"x"} 2' in text
+    assert 'latency_seconds_bucket{handler="h",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{handler="h",le="1"} 2' in text
+    assert 'latency_seconds_bucket{handler="h",le="+Inf"} 2' in text
+    assert 'latency_seconds_count{handler="h"} 2' in text
+    assert "# TYPE broken gauge" in text
+
+
+@pytest.mark.asyncio
+async def test_metrics_server_serves_registry():
+    registry = MetricsRegistry()
+    registry.counter("probe_total", "Probe").inc()
+    runner = await start_metrics_server("127.0.0.1", 0, registry)
+    try:
+        host, port = runner.addresses[0][:2]
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://{host}:{port}/metrics") as resp:
+                assert resp.status == 200
+                assert "probe_total 1" in await resp.text()
+    finally:
+        await runner.cleanup()
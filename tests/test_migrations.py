@@ -0,0 +1,134 @@
+import pytest
+import pytest_asyncio
+from sqlalchemy import inspect, text
+from src.db import get_engine, init_db
+from src.models import Base
+from src.migrations import run_migrations
+
+
+@pytest_asyncio.fixture(scope="function", autouse=True)
+async def legacy_members_table(db_backend):
+    engine = get_engine()
+    pk = "SERIAL PRIMARY KEY" if engine.dialect.name == "postgresql" else "INTEGER PRIMARY KEY AUTOINCREMENT"
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        # Схема members до появления уникального ключа (chat_id, user_id)
+        await conn.execute(text(
+            f"CREATE TABLE members (id {pk}, chat_id VARCHAR, "
+            "user_id VARCHAR, username VARCHAR, last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+        ))
+        await conn.execute(text(
+            "INSERT INTO members (chat_id, user_id, username) VALUES "
+            "('1', '42', 'old'), ('1', '42', 'new'), ('1', '43', 'masha'), ('2', '42', 'liza')"
+        ))
+        # allowed_users до появления списков по чатам
+        await conn.execute(text(
+            f"CREATE TABLE allowed_users (id {pk}, user_identifier VARCHAR, "
+            "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+        ))
+        await conn.execute(text(
+            "CREATE UNIQUE INDEX ix_allowed_users_user_identifier ON allowed_users (user_identifier)"
+        ))
+        await conn.execute(text("INSERT INTO allowed_users (user_identifier) VALUES ('@masha'), ('123')"))
+    yield
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+
+@pytest.mark.asyncio
+async def test_members_migration_dedupes_and_adds_unique_key():
+    async with get_engine().begin() as conn:
+        await run_migrations(conn)
+        rows = (await conn.execute(text(
+            "SELECT chat_id, user_id, username FROM members ORDER BY chat_id, user_id"
+        ))).all()
+        indexes = await conn.run_sync(lambda c: inspect(c).get_indexes("members"))
+    assert [tuple(r) for r in rows] == [("1", "42", "new"), ("1", "43", "masha"), ("2", "42", "liza")]
+    assert any(ix["name"] == "uq_members_chat_user" and ix["unique"] for ix in indexes)
+
+
+@pytest.mark.asyncio
+async def test_allowed_users_migration_scopes_existing_rows():
+    async with get_engine().begin() as conn:
+        await run_migrations(conn)
+        rows = (await conn.execute(text(
+            "SELECT chat_id, user_identifier FROM allowed_users ORDER BY user_identifier"
+        ))).all()
+        # Тот же идентификатор можно добавить в список другого чата
+        await conn.execute(text("INSERT INTO allowed_users (chat_id, user_identifier) VALUES ('-100', '@masha')"))
+        indexes = await conn.run_sync(lambda c: inspect(c).get_indexes("allowed_users"))
+    assert [tuple(r) for r in rows] == [("*", "123"), ("*", "@masha")]
+    assert any(ix["name"] == "uq_allowed_users_scope_ident" and ix["unique"] for ix in indexes)
+
+
+@pytest.mark.asyncio
+async def test_members_migration_adds_status():
+    async with get_engine().begin() as conn:
+        await run_migrations(conn)
+        statuses = (await conn.execute(text("SELECT DISTINCT status FROM members"))).scalars().all()
+        changed = (await conn.execute(text("SELECT DISTINCT changed_at FROM members"))).scalars().all()
+    assert statuses == ["member"]
+    assert changed == [None]
+
+
+@pytest.mark.asyncio
+async def test_normalized_keys_backfilled():
+    async with get_engine().begin() as conn:
+        await conn.execute(text("INSERT INTO allowed_users (user_identifier) VALUES ('@Liza'), ('@777')"))
+        await run_migrations(conn)
+        allowed = (await conn.execute(text(
+            "SELECT user_identifier, user_id_key, username_key FROM allowed_users ORDER BY user_identifier"
+        ))).all()
+        members = (await conn.execute(text(
+            "SELECT DISTINCT username_key FROM members WHERE user_id = '42' ORDER BY username_key"
+        ))).scalars().all()
+    assert [tuple(r) for r in allowed] == [
+        ("123", "123", None), ("@777", "777", "777"), ("@Liza", None, "liza"), ("@masha", None, "masha"),
+    ]
+    assert members == ["liza", "new"]
+
+
+@pytest.mark.asyncio
+async def test_identities_backfilled_from_members():
+    await init_db()
+    async with get_engine().begin() as conn:
+        idents = (await conn.execute(text("SELECT user_id, username_key FROM identities ORDER BY user_id"))).all()
+        resolved = (await conn.execute(text(
+            "SELECT user_identifier, resolved_user_id FROM allowed_users ORDER BY user_identifier"
+        ))).all()
+    assert [tuple(r) for r in idents] == [("42", "liza"), ("43", "masha")]
+    assert [tuple(r) for r in resolved] == [("123", None), ("@masha", "43")]
+
+
+@pytest.mark.asyncio
+async def test_init_db_is_idempotent():
+    await init_db()
+    await init_db()
+    async with get_engine().begin() as conn:
+        count = (await conn.execute(text("SELECT COUNT(*) FROM members"))).scalar()
+    assert count == 3
+
+
+@pytest.mark.asyncio
+async def test_action_log_indexes_and_stats_backfilled():
+    engine = get_engine()
+    pk = "SERIAL PRIMARY KEY" if engine.dialect.name == "postgresql" else "INTEGER PRIMARY KEY AUTOINCREMENT"
+    async with engine.begin() as conn:
+        # Журнал без индексов и без таблицы счётчиков
+        await conn.execute(text(
+            f"CREATE TABLE action_logs (id {pk}, chat_id VARCHAR, user_identifier VARCHAR, "
+            "action VARCHAR, timestamp TIMESTAMP, reason VARCHAR)"
+        ))
+        await conn.execute(text(
+            "INSERT INTO action_logs (chat_id, user_identifier, action, timestamp) VALUES "
+            "('1', '@a', 'banned', '2024-05-01 10:00:00'), ('1', '@b', 'banned', '2024-05-01 11:00:00'), "
+            "('1', '@c', 'ban_failed', '2024-05-02 09:00:00'), ('2', '@a', 'already_left', '2024-05-01 10:00:00')"
+        ))
+    await init_db()
+    async with engine.begin() as conn:
+        indexes = await conn.run_sync(lambda c: {ix["name"] for ix in inspect(c).get_indexes("action_logs")})
+        rows = (await conn.execute(text(
+            "SELECT chat_id, banned, already_left, ban_failed FROM chat_daily_stats ORDER BY chat_id, day"
+        ))).all()
+    assert {"ix_action_logs_chat_ts", "ix_action_logs_ident_ts", "ix_action_logs_ts"} <= indexes
+    assert [tuple(r) for r in rows] == [("1", 2, 0, 0), ("1", 0, 0, 1), ("2", 0, 1, 0)]
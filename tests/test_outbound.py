@@ -0,0 +1,156 @@
+import asyncio
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import BanChatMember, SendMessage
+from src.outbound import Lane, OutboundScheduler, OutboundMiddleware, TokenBucket, _is_group_chat, lane_for_method
+
+
+def test_token_bucket_reserve():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+
+
+def test_lane_for_method():
+    assert lane_for_method(BanChatMember(chat_id=1, user_id=2)) == Lane.BAN
+    assert lane_for_method(SendMessage(chat_id=1, text="hi")) == Lane.CHATTER
+
+
+def test_group_chat_detection():
+    assert _is_group_chat(-100123)
+    assert _is_group_chat("-100123")
+    assert _is_group_chat("@channel")
+    assert not _is_group_chat(42)
+    assert not _is_group_chat(None)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_priority_lanes():
+    scheduler = OutboundScheduler(concurrency=1, global_rate=1000)
+    order = []
+    gate = asyncio.Event()
+
+    async def blocker():
+        await gate.wait()
+
+    def call(name):
+        async def _call():
+            order.append(name)
+        return _call
+
+    first = asyncio.create_task(scheduler.submit(blocker))
+    await asyncio.sleep(0)
+    tasks = [
+        asyncio.create_task(scheduler.submit(call("chatter"), lane=Lane.CHATTER)),
+        asyncio.create_task(scheduler.submit(call("notice"), lane=Lane.NOTICE)),
+        asyncio.create_task(scheduler.submit(call("ban"), lane=Lane.BAN)),
+    ]
+    await asyncio.sleep(0.01)
+    gate.set()
+    await asyncio.gather(first, *tasks)
+    await scheduler.close()
+    assert order == ["ban", "notice", "chatter"]
+
+
+@pytest.mark.asyncio
+async def test_scheduler_retries_after_flood_control():
+    scheduler = OutboundScheduler(concurrency=2, global_rate=1000)
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise TelegramRetryAfter(method=SendMessage(chat_id=1, text="x"), message="flood", retry_after=0)
+        return "ok"
+
+    assert await scheduler.submit(flaky, chat_id=1) == "ok"
+    assert len(attempts) == 2
+    await scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_propagates_errors():
+    scheduler = OutboundScheduler(concurrency=1, global_rate=1000)
+
+    async def broken():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        await scheduler.submit(broken)
+    await scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_middleware_routes_requests_through_scheduler():
+    scheduler = OutboundScheduler(concurrency=1, global_rate=1000)
+    middleware = OutboundMiddleware(scheduler)
+    seen = []
+
+    async def make_request(bot, method):
+        seen.append(type(method).__name__)
+        return "response"
+
+    res = await middleware(make_request, None, SendMessage(chat_id=1, text="hi"))
+    assert res == "response"
+    assert seen == ["SendMessage"]
+    await scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_private_replies_skip_group_bucket():
+    scheduler = OutboundScheduler(concurrency=1, global_rate=1000, chat_rate_per_minute=1)
+
+    async def ok():
+        return "ok"
+
+    # В личный чат лимит группы не действует: пятое сообщение подряд уходит без ожидания
+    results = await asyncio.wait_for(asyncio.gather(*(scheduler.submit(ok, chat_id=5) for _ in range(5))), 1)
+    assert results == ["ok"] * 5
+    for _ in range(3):
+        await scheduler.submit(ok, chat_id=-100)
+    group = asyncio.create_task(scheduler.submit(ok, chat_id=-100))
+    await asyncio.sleep(0.05)
+    assert not group.done()
+    group.cancel()
+    await scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_retry_after_pauses_only_that_chat():
+    scheduler = OutboundScheduler(concurrency=1, global_rate=1000)
+    calls = []
+
+    async def flooded():
+        calls.append("flooded")
+        if calls.count("flooded") == 1:
+            raise TelegramRetryAfter(method=SendMessage(chat_id=-1, text="x"), message="flood", retry_after=1)
+        return "flooded"
+
+    async def other():
+        calls.append("other")
+        return "other"
+
+    paused = asyncio.create_task(scheduler.submit(flooded, chat_id=-1, method="sendMessage"))
+    await asyncio.sleep(0.01)
+    # Пока чат -1 ждёт, единственный воркер свободен для других чатов и методов
+    assert await asyncio.wait_for(scheduler.submit(other, chat_id=-2, method="sendMessage"), 0.5) == "other"
+    assert await asyncio.wait_for(scheduler.submit(other, chat_id=-1, method="banChatMember"), 0.5) == "other"
+    assert not paused.done()
+    assert await asyncio.wait_for(paused, 2) == "flooded"
+    assert calls == ["flooded", "other", "other", "flooded"]
+    await scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_close_cancels_paused_requests():
+    scheduler = OutboundScheduler(concurrency=1, global_rate=1000)
+
+    async def flooded():
+        raise TelegramRetryAfter(method=SendMessage(chat_id=-1, text="x"), message="flood", retry_after=30)
+
+    paused = asyncio.create_task(scheduler.submit(flooded, chat_id=-1))
+    await asyncio.sleep(0.01)
+    await scheduler.close()
+    with pytest.raises(asyncio.CancelledError):
+        await paused
@@ -0,0 +1,60 @@
+import asyncio
+import marshal
+import pytest
+from src.profiling import LoopProfiler, SlowHandlerLog, configure_slow_callbacks, format_slow_handlers
+
+
+class DummyBot:
+    def __init__(self):
+        self.documents = []
+
+    async def send_document(self, chat_id, document, caption=None):
+        self.documents.append((chat_id, document.filename, document.data))
+
+
+def test_slow_handler_log_keeps_recent_slow_calls():
+    log = SlowHandlerLog(threshold=0.1, size=3)
+    log.record(0.05, "fast")
+    for i, seconds in enumerate((0.3, 0.2, 0.5, 0.4)):
+        log.record(seconds, f"h{i}", update_type="message", chat_id=-100)
+    assert len(log) == 3
+    assert [e["handler"] for e in log.slowest()] == ["h2", "h3", "h1"]
+    text = format_slow_handlers(log.slowest(1))
+    assert "500 мс — h2 (message, чат -100" in text
+    assert format_slow_handlers([]) == "Медленных обработчиков не было."
+
+
+@pytest.mark.asyncio
+async def test_profiler_captures_loop_work_and_sends_files(tmp_path):
+    async def busy_task():
+        for _ in range(20):
+            sum(range(10_000))
+            await asyncio.sleep(0)
+
+    profiler = LoopProfiler(max_seconds=1, top=20, out_dir=str(tmp_path), slow=SlowHandlerLog())
+    bot = DummyBot()
+    assert profiler.clamp(30) == 1.0
+    assert profiler.start(bot, 7, 0.2)
+    assert not profiler.start(bot, 7, 0.2)
+    await asyncio.gather(busy_task(), *profiler._tasks)
+
+    assert [d[:2] for d in bot.documents][0][0] == 7
+    report = bot.documents[0][2].decode()
+    assert "busy_task" in report
+    assert "busy_task" in str(marshal.loads(bot.documents[1][2]))
+    assert sorted(p.suffix for p in tmp_path.iterdir()) == [".prof", ".txt"]
+    assert profiler.start(bot, 7, 0.1)
+    await profiler.close()
+
+
+@pytest.mark.asyncio
+async def test_configure_slow_callbacks():
+    loop = asyncio.get_running_loop()
+    debug, duration = loop.get_debug(), loop.slow_callback_duration
+    try:
+        assert not configure_slow_callbacks(loop, 0)
+        assert configure_slow_callbacks(loop, 250)
+        assert loop.get_debug() and loop.slow_callback_duration == 0.25
+    finally:
+        loop.set_debug(debug)
+        loop.slow_callback_duration = duration
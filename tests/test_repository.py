@@ -1,13 +1,15 @@
+import asyncio
 import pytest
 import pytest_asyncio
 from sqlalchemy import select
-from src.db import AsyncSessionLocal, engine
+from src.db import AsyncSessionLocal, get_engine
 from src.models import Base, ActionLog
-from src.repository import AllowedUserRepository, MemberRepository, ActionLogRepository
+from src.cache import PresenceCache
+from src.repository import AllowedUserRepository, MemberRepository, ActionLogRepository, MemberWriteBuffer
 
 @pytest_asyncio.fixture(scope="function", autouse=True)
-async def prepare_db():
-    async with engine.begin() as conn:
+async def prepare_db(db_backend):
+    async with get_engine().begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
         await conn.run_sync(Base.metadata.create_all)
     yield
@@ -28,6 +30,26 @@ async def test_allowed_repo_overwrite():
     identifiers = await repo.list_identifiers()
     assert identifiers == ["@liza"]
 
+@pytest.mark.asyncio
+async def test_allowed_repo_sync_applies_delta():
+    repo = AllowedUserRepository()
+    await repo.sync_users(["@masha", "@liza", "123"])
+    res = await repo.sync_users(["@masha", "123", "456", "456"])
+    assert res == {"total": 3, "added": 1, "removed": 1, "unchanged": 2}
+    assert sorted(await repo.list_identifiers()) == ["123", "456", "@masha"]
+
+@pytest.mark.asyncio
+async def test_allowed_repo_scopes_are_independent():
+    repo = AllowedUserRepository()
+    await repo.sync_users(["@masha", "123"])
+    res = await repo.sync_users(["@masha", "@local"], chat_id="-100")
+    assert res["added"] == 2
+    assert sorted(await repo.list_identifiers()) == ["123", "@masha"]
+    assert sorted(await repo.list_identifiers("-100")) == ["@local", "@masha"]
+    await repo.sync_users([], chat_id="-100")
+    assert await repo.list_identifiers("-100") == []
+    assert sorted(await repo.list_identifiers()) == ["123", "@masha"]
+
 @pytest.mark.asyncio
 async def test_member_repo_upsert_and_list():
     repo = MemberRepository()
@@ -45,6 +67,13 @@ async def test_member_repo_upsert_updates_username():
     members = await repo.list_members_by_chat("1")
     assert members[0]["username"] == "liza"
 
+@pytest.mark.asyncio
+async def test_member_repo_concurrent_upserts_keep_one_row():
+    repo = MemberRepository()
+    await asyncio.gather(*(repo.upsert_member(chat_id="1", user_id="42", username=f"u{i}") for i in range(5)))
+    members = await repo.list_members_by_chat("1")
+    assert len(members) == 1
+
 @pytest.mark.asyncio
 async def test_member_repo_remove():
     repo = MemberRepository()
@@ -53,6 +82,131 @@ async def test_member_repo_remove():
     members = await repo.list_members_by_chat("1")
     assert len(members) == 0
 
+@pytest.mark.asyncio
+async def test_member_status_hides_left_and_kicked():
+    repo = MemberRepository()
+    for uid, name in (("42", "liza"), ("43", "masha"), ("44", "olya")):
+        await repo.upsert_member(chat_id="1", user_id=uid, username=name)
+    await repo.set_status(chat_id="1", user_id="42", status="left")
+    await repo.set_statuses(chat_id="1", updates=[("43", "kicked")])
+    assert await repo.list_members_by_chat("1") == [{"user_id": "44", "username": "olya"}]
+    assert await repo.count_members("1") == 1
+    assert [m["user_id"] for m in await repo.list_members_page("1", after_id=0, limit=10)] == ["44"]
+
+    # Вернулся в чат — снова учитывается, имя сохранилось
+    await repo.set_status(chat_id="1", user_id="42", status="member")
+    members = sorted(await repo.list_members_by_chat("1"), key=lambda m: m["user_id"])
+    assert members == [{"user_id": "42", "username": "liza"}, {"user_id": "44", "username": "olya"}]
+
+@pytest.mark.asyncio
+async def test_member_left_not_overridden_by_buffered_write():
+    repo = MemberRepository(buffer=MemberWriteBuffer(max_size=100, flush_interval=60))
+    await repo.queue_upsert(chat_id="1", user_id="42", username="liza")
+    await repo.set_status(chat_id="1", user_id="42", status="left")
+    await repo.buffer.flush()
+    assert await repo.list_members_by_chat("1") == []
+
+@pytest.mark.asyncio
+async def test_member_repo_mark_chat_left():
+    repo = MemberRepository(buffer=MemberWriteBuffer(max_size=100, flush_interval=60))
+    await repo.upsert_member(chat_id="1", user_id="42", username="liza")
+    await repo.upsert_member(chat_id="2", user_id="43", username="masha")
+    await repo.queue_upsert(chat_id="1", user_id="44", username="olya")
+    assert await repo.mark_chat_left("1") == 1
+    await repo.buffer.flush()
+    assert await repo.list_members_by_chat("1") == []
+    assert await repo.list_known_chats() == ["2"]
+
+async def _candidates(repo, chat_id, scopes, chunk_size=2):
+    chunks = [rows async for rows in repo.stream_candidates(chat_id, scopes, chunk_size=chunk_size)]
+    assert all(len(rows) <= chunk_size for rows in chunks)
+    return [row for rows in chunks for row in rows]
+
+@pytest.mark.asyncio
+async def test_stream_candidates_anti_join():
+    await AllowedUserRepository().sync_users(["@Masha", "43", "@100"], chat_id="*")
+    await AllowedUserRepository().sync_users(["@olya"], chat_id="1")
+    repo = MemberRepository()
+    await repo.upsert_members("1", [("41", "MASHA"), ("42", "liza"), ("43", None), ("44", "olya"),
+                                    ("100", "x"), ("45", None), ("46", "kolya")])
+    await repo.set_status(chat_id="1", user_id="46", status="left")
+
+    assert await _candidates(repo, "1", ["*"]) == [("42", "liza"), ("44", "olya"), ("45", None)]
+    assert await _candidates(repo, "1", ["1", "*"]) == [("42", "liza"), ("45", None)]
+    assert await _candidates(repo, "2", ["*"]) == []
+
+@pytest.mark.asyncio
+async def test_stream_candidates_releases_connection_between_chunks():
+    repo = MemberRepository()
+    await repo.upsert_members("1", [(str(i), f"user{i}") for i in range(1, 7)])
+    pool = get_engine().sync_engine.pool
+    seen = []
+    async for rows in repo.stream_candidates("1", ["*"], chunk_size=2):
+        # Порция отдаётся, когда её сессия уже закрыта
+        assert pool.checkedout() == 0
+        seen.extend(user_id for user_id, _ in rows)
+        if len(seen) == 2:
+            # Добавленные в список по ходу очистки в следующие порции не попадают
+            await AllowedUserRepository().sync_users(["@user4"], chat_id="*")
+            await repo.set_status(chat_id="1", user_id="5", status="left")
+    assert seen == ["1", "2", "3", "6"]
+
+@pytest.mark.asyncio
+async def test_identity_resolution_survives_rename():
+    allowed = AllowedUserRepository()
+    members = MemberRepository()
+    await members.upsert_member(chat_id="1", user_id="41", username="Masha")
+    await allowed.sync_users(["@masha", "@liza"], chat_id="*")
+    assert await allowed.resolve_usernames("*") == 1
+    assert sorted(await allowed.list_identifiers("*", resolved=True)) == ["41", "@liza"]
+    assert await allowed.resolved_identifiers("*") == {"@masha": "41"}
+
+    # Сменила имя — по-прежнему своя, пока имя никто не занял
+    await members.upsert_members("1", [("41", "maria")])
+    assert await _candidates(members, "1", ["*"]) == []
+    assert await allowed.resolve_usernames("*") == 0
+
+@pytest.mark.asyncio
+async def test_stale_binding_moves_to_current_name_holder():
+    allowed = AllowedUserRepository()
+    members = MemberRepository()
+    # Боб когда-то назывался alice, потом незаметно для бота сменил имя
+    await members.upsert_member(chat_id="1", user_id="7", username="alice")
+    await allowed.sync_users(["@alice"], chat_id="*")
+    assert await allowed.resolve_usernames("*") == 1
+    assert await allowed.resolved_identifiers("*") == {"@alice": "7"}
+
+    # Имя заняла настоящая Алиса: как только бот её видит, запись привязывается к ней
+    await members.upsert_member(chat_id="1", user_id="8", username="Alice")
+    assert await allowed.resolved_identifiers("*") == {"@alice": "8"}
+    assert await _candidates(members, "1", ["*"]) == [("7", "alice")]
+    # Повторная загрузка того же списка привязку не откатывает
+    assert await allowed.resolve_usernames("*") == 0
+
+@pytest.mark.asyncio
+async def test_member_flush_resolves_new_names():
+    allowed = AllowedUserRepository()
+    await allowed.sync_users(["@liza"], chat_id="-100")
+    resolved = []
+    buffer = MemberWriteBuffer(max_size=100, flush_interval=60)
+    buffer.on_resolved = resolved.extend
+    repo = MemberRepository(buffer=buffer)
+    await repo.queue_upsert(chat_id="1", user_id="42", username="Liza")
+    await repo.queue_upsert(chat_id="2", user_id="42", username="Liza")
+    await buffer.flush()
+    assert resolved == ["-100"]
+    assert await allowed.list_identifiers("-100", resolved=True) == ["42"]
+    # Повторная запись того же имени ничего не привязывает заново
+    await repo.upsert_member(chat_id="1", user_id="42", username="Liza")
+    assert resolved == ["-100"]
+
+@pytest.mark.asyncio
+async def test_allowed_repo_has_scope():
+    repo = AllowedUserRepository()
+    await repo.sync_users(["@masha"], chat_id="-100")
+    assert await repo.has_scope("-100")
+    assert not await repo.has_scope("-200")
+
 @pytest.mark.asyncio
 async def test_member_repo_list_known_chats():
     repo = MemberRepository()
@@ -62,6 +216,115 @@ async def test_member_repo_list_known_chats():
     assert "1" in chats
     assert "2" in chats
 
+@pytest.mark.asyncio
+async def test_chat_fingerprint_tracks_renames():
+    repo = MemberRepository()
+    await repo.upsert_members("1", [("41", "masha"), ("42", "liza")])
+    before = await repo.chat_fingerprint("1")
+    # Повторная запись того же имени (обновление last_seen) отпечаток не меняет
+    await repo.upsert_member(chat_id="1", user_id="42", username="Liza")
+    assert await repo.chat_fingerprint("1") == before
+    # Смена имени меняет, хотя число участников и max(id) те же
+    await repo.upsert_member(chat_id="1", user_id="42", username="stranger")
+    after = await repo.chat_fingerprint("1")
+    assert after[:2] == before[:2] and after != before
+
+@pytest.mark.asyncio
+async def test_member_buffer_read_your_writes():
+    repo = MemberRepository(buffer=MemberWriteBuffer(max_size=100, flush_interval=60))
+    await repo.queue_upsert(chat_id="1", user_id="42", username="liza")
+    await repo.queue_upsert(chat_id="1", user_id="42", username="liza_new")
+    members = await repo.list_members_by_chat("1")
+    assert members == [{"user_id": "42", "username": "liza_new"}]
+    assert "1" in await repo.list_known_chats()
+
+    assert await repo.buffer.flush() == 1
+    assert len(repo.buffer) == 0
+    members = await repo.list_members_by_chat("1")
+    assert members == [{"user_id": "42", "username": "liza_new"}]
+
+@pytest.mark.asyncio
+async def test_member_buffer_flushes_on_size():
+    repo = MemberRepository(buffer=MemberWriteBuffer(max_size=2, flush_interval=60))
+    await repo.upsert_member(chat_id="1", user_id="42", username="old")
+    await repo.queue_upsert(chat_id="1", user_id="42", username="liza")
+    await repo.queue_upsert(chat_id="1", user_id="43", username="masha")
+    assert len(repo.buffer) == 0
+    plain = MemberRepository(buffer=MemberWriteBuffer())
+    members = sorted(await plain.list_members_by_chat("1"), key=lambda m: m["user_id"])
+    assert members == [{"user_id": "42", "username": "liza"}, {"user_id": "43", "username": "masha"}]
+
+@pytest.mark.asyncio
+async def test_member_buffer_remove_discards_pending():
+    repo = MemberRepository(buffer=MemberWriteBuffer(max_size=100, flush_interval=60))
+    await repo.queue_upsert(chat_id="1", user_id="42", username="liza")
+    await repo.remove_member(chat_id="1", user_id="42")
+    await repo.buffer.flush()
+    assert await repo.list_members_by_chat("1") == []
+
+@pytest.mark.asyncio
+async def test_member_remove_waits_for_inflight_flush(monkeypatch):
+    cache = PresenceCache(ttl=600, max_bytes=10 ** 6)
+    repo = MemberRepository(buffer=MemberWriteBuffer(max_size=100, flush_interval=60, cache=cache))
+    from src.repository import _write_members
+    started, release = asyncio.Event(), asyncio.Event()
+
+    # upsert уже отправлен, но ещё не закоммичен
+    async def slow_write(batch):
+        issued = dict(batch)
+        started.set()
+        await release.wait()
+        return await _write_members(issued)
+
+    monkeypatch.setattr("src.repository._write_members", slow_write)
+    await repo.queue_upsert(chat_id="1", user_id="42", username="liza")
+    flushing = asyncio.create_task(repo.flush())
+    await started.wait()
+    # Удаление приходит, пока upsert сброса ещё не закоммичен
+    removing = asyncio.create_task(repo.remove_member(chat_id="1", user_id="42"))
+    await asyncio.sleep(0.01)
+    release.set()
+    await asyncio.gather(flushing, removing)
+
+    assert await repo.list_members_by_chat("1") == []
+    assert not cache.is_fresh("1", "42", "liza")
+
+@pytest.mark.asyncio
+async def test_presence_cache_skips_repeated_writes():
+    cache = PresenceCache(ttl=600, max_bytes=10 ** 6)
+    repo = MemberRepository(buffer=MemberWriteBuffer(max_size=100, flush_interval=60, cache=cache))
+    await repo.queue_upsert(chat_id="1", user_id="42", username="liza")
+    assert await repo.flush() == 1
+    for _ in range(5):
+        await repo.queue_upsert(chat_id="1", user_id="42", username="liza")
+    assert len(repo.buffer) == 0
+    assert cache.hits == 5
+
+    await repo.queue_upsert(chat_id="1", user_id="42", username="liza_new")
+    assert len(repo.buffer) == 1
+    await repo.flush()
+
+    # После удаления участник снова должен попасть в БД
+    await repo.remove_member(chat_id="1", user_id="42")
+    await repo.queue_upsert(chat_id="1", user_id="42", username="liza_new")
+    await repo.flush()
+    assert await repo.list_members_by_chat("1") == [{"user_id": "42", "username": "liza_new"}]
+
+@pytest.mark.asyncio
+async def test_presence_cache_not_filled_by_failed_flush(monkeypatch):
+    cache = PresenceCache(ttl=600, max_bytes=10 ** 6)
+    repo = MemberRepository(buffer=MemberWriteBuffer(max_size=100, flush_interval=60, cache=cache))
+
+    async def broken(batch):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr("src.repository._write_members", broken)
+    await repo.queue_upsert(chat_id="1", user_id="42", username="liza")
+    with pytest.raises(RuntimeError):
+        await repo.flush()
+    assert len(cache) == 0
+    assert len(repo.buffer) == 1
+
 @pytest.mark.asyncio
 async def test_action_log_repo():
     repo = ActionLogRepository()
@@ -1,22 +1,48 @@
+import gzip
+import os
+
 import pytest
 from aiogram.exceptions import TelegramBadRequest
+from src.db import get_engine
+from src.ingest import UploadSpool
+from src.models import Base
 from src.services import ModerationService
+from src.workers import shutdown_parse_pool
 
 class FakeAllowedRepo:
-    def __init__(self, idents):
-        self._idents = list(idents)
+    def __init__(self, idents, scopes=None):
+        self._scopes = {"*": list(idents)}
+        self._scopes.update(scopes or {})
+        self.list_calls = 0
+
+    @property
+    def _idents(self):
+        return self._scopes["*"]
+
+    async def list_identifiers(self, chat_id="*", resolved=False):
+        self.list_calls += 1
+        return list(self._scopes.get(chat_id, []))
 
-    async def list_identifiers(self):
-        return list(self._idents)
+    async def resolve_usernames(self, chat_id="*"):
+        return 0
 
-    async def set_users(self, identifiers):
-        self._idents = list(identifiers)
+    async def resolved_identifiers(self, chat_id="*"):
+        return {}
+
+    async def sync_users(self, identifiers, chat_id="*"):
+        old = set(self._scopes.get(chat_id, []))
+        new = list(dict.fromkeys(identifiers))
+        self._scopes[chat_id] = new
+        added = len(set(new) - old)
+        return {"total": len(new), "added": added, "removed": len(old - set(new)),
+                "unchanged": len(new) - added}
 
 
 class FakeMemberRepo:
     def __init__(self, members=None):
         self._members = members or []
         self.removed = []
+        self.statuses = []
 
     async def list_members_by_chat(self, chat_id: str):
         return list(self._members)
@@ -27,6 +53,22 @@ class FakeMemberRepo:
             m for m in self._members if str(m.get("user_id")) != str(user_id)
         ]
 
+    async def set_statuses(self, chat_id: str, updates):
+        self.statuses.extend((chat_id, user_id, status) for user_id, status in updates)
+
+
+class FakeImportRepo:
+    def __init__(self):
+        self.records = []
+
+    async def last(self, chat_id):
+        rows = [r for r in self.records if r["chat_id"] == chat_id]
+        return rows[-1] if rows else None
+
+    async def record(self, chat_id, content_hash, total, file_unique_id=None):
+        self.records.append({"chat_id": chat_id, "content_hash": content_hash, "total": total,
+                             "file_unique_id": file_unique_id})
+
 
 class FakeLogRepo:
     def __init__(self):
@@ -59,14 +101,14 @@ async def test_filter_unauthorized_by_username_and_id():
 
 
 @pytest.mark.asyncio
-async def test_clean_chat_candidates_and_ban_called():
+async def test_clean_chat_candidates_and_ban_called(db_backend):
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
     bot = DummyBot()
     svc = ModerationService(bot)
-    svc.allowed_repo = FakeAllowedRepo(["@allowed"])
-    svc.member_repo = FakeMemberRepo([
-        {"user_id": "1", "username": "allowed"},
-        {"user_id": "2", "username": "stranger"},
-    ])
+    await svc.load_allowed_from_bytes(b"@Allowed\n")
+    await svc.member_repo.upsert_members("999", [("1", "allowed"), ("2", "stranger")])
     called = {}
 
     async def fake_ban(chat_id, users):
@@ -80,8 +122,7 @@ async def test_clean_chat_candidates_and_ban_called():
     assert res["to_ban"] == 1
     assert res["banned"] == 1
     assert called.get('chat_id') == "999"
-    assert isinstance(called.get('users'), list)
-    assert str(called['users'][0]['id']) == "2"
+    assert called['users'] == [{"id": 2, "identifier": "@stranger"}]
 
 
 @pytest.mark.asyncio
@@ -100,7 +141,7 @@ async def test_ban_users_with_failures():
     bot = FakeBotFail(fail_ids=["2"])
     svc = ModerationService(bot)
     svc.member_repo = FakeMemberRepo()
-    svc.log_repo = FakeLogRepo()
+    svc.audit = FakeLogRepo()
 
     users = [
         {"id": "1", "identifier": "@Masha"},
@@ -110,6 +151,153 @@ async def test_ban_users_with_failures():
     banned_count = await svc.ban_users(chat_id="999", users=users)
     assert banned_count == 1
 
-    actions = [r["action"] for r in svc.log_repo.records]
+    actions = [r["action"] for r in svc.audit.records]
     assert "banned" in actions
     assert "already_left" in actions or "ban_failed" in actions
+    assert ("999", "1", "kicked") in svc.member_repo.statuses
+
+
+@pytest.mark.asyncio
+async def test_allowed_index_loaded_once():
+    svc = ModerationService(DummyBot())
+    repo = FakeAllowedRepo(["@gooduser"])
+    svc.allowed_repo = repo
+    for _ in range(3):
+        res = await svc.filter_unauthorized([{"id": 1, "username": "gooduser"}, {"id": 2, "username": "x"}])
+        assert [item["id"] for item in res] == [2]
+    assert repo.list_calls == 1
+
+    svc.invalidate_allowed_index()
+    await svc.filter_unauthorized([{"id": 1, "username": "gooduser"}])
+    assert repo.list_calls == 2
+
+
+@pytest.mark.asyncio
+async def test_load_allowed_swaps_index_without_reload():
+    svc = ModerationService(DummyBot())
+    repo = FakeAllowedRepo(["@old"])
+    svc.allowed_repo = repo
+    svc.import_repo = FakeImportRepo()
+    await svc.filter_unauthorized([{"id": 1, "username": "old"}])
+    version = svc.allowed_version
+
+    res = await svc.load_allowed_from_bytes(b"@new\n77\n")
+    assert res == {"total": 2, "added": 2, "removed": 1, "unchanged": 0}
+    assert svc.allowed_version == version + 1
+
+    res = await svc.filter_unauthorized([
+        {"id": 1, "username": "old"},
+        {"id": 2, "username": "new"},
+        {"id": 77, "username": None},
+    ])
+    assert [item["id"] for item in res] == [1]
+    assert repo.list_calls == 1
+
+
+@pytest.mark.asyncio
+async def test_load_unchanged_allowlist_keeps_index_version():
+    svc = ModerationService(DummyBot())
+    svc.allowed_repo = FakeAllowedRepo(["@same"])
+    await svc.filter_unauthorized([{"id": 1, "username": "same"}])
+    version = svc.allowed_version
+    res = await svc.load_allowed_from_bytes(b"@same\n")
+    assert res["unchanged"] == 1
+    assert svc.allowed_version == version
+
+
+@pytest.mark.asyncio
+async def test_per_chat_allowlist_with_global_fallback(monkeypatch):
+    svc = ModerationService(DummyBot())
+    svc.allowed_repo = FakeAllowedRepo(["@boss"], scopes={"-100": ["@local"]})
+    members = [{"id": 1, "username": "boss"}, {"id": 2, "username": "local"}, {"id": 3, "username": "x"}]
+
+    res = await svc.filter_unauthorized(members, chat_id=-100)
+    assert [item["id"] for item in res] == [3]
+    # В чате без своего списка действует только общий
+    res = await svc.filter_unauthorized(members, chat_id=-200)
+    assert [item["id"] for item in res] == [2, 3]
+
+    monkeypatch.setattr("src.services.settings.ALLOWLIST_GLOBAL_FALLBACK", False)
+    res = await svc.filter_unauthorized(members, chat_id=-100)
+    assert [item["id"] for item in res] == [1, 3]
+    res = await svc.filter_unauthorized(members, chat_id=-200)
+    assert [item["id"] for item in res] == [2, 3]
+
+
+@pytest.mark.asyncio
+async def test_chat_upload_changes_only_that_chat():
+    svc = ModerationService(DummyBot())
+    svc.allowed_repo = FakeAllowedRepo(["@boss"])
+    svc.import_repo = FakeImportRepo()
+    before_a, before_b = svc.allowlist_version(-1), svc.allowlist_version(-2)
+
+    await svc.load_allowed_from_bytes(b"@newbie\n", chat_id=-1)
+    assert svc.allowlist_version(-1) != before_a
+    assert svc.allowlist_version(-2) == before_b
+    assert await svc.get_allowed_identifiers() == ["@boss"]
+    res = await svc.filter_unauthorized([{"id": 5, "username": "newbie"}], chat_id=-1)
+    assert res == []
+    res = await svc.filter_unauthorized([{"id": 5, "username": "newbie"}], chat_id=-2)
+    assert [item["id"] for item in res] == [5]
+
+
+def make_upload(content: bytes, max_size: int = 1 << 20) -> UploadSpool:
+    upload = UploadSpool(max_size=max_size)
+    for i in range(0, len(content), 7):
+        upload.write(content[i:i + 7])
+    return upload
+
+
+@pytest.mark.asyncio
+async def test_upload_import_skips_repeated_file():
+    svc = ModerationService(DummyBot())
+    svc.allowed_repo = FakeAllowedRepo([])
+    svc.import_repo = FakeImportRepo()
+
+    with make_upload(b"@masha\n123\n") as upload:
+        res = await svc.load_allowed_from_upload(upload, chat_id=-1, file_unique_id="AQAD1")
+    assert res["added"] == 2
+    assert svc.import_repo.records[-1]["file_unique_id"] == "AQAD1"
+
+    assert await svc.is_last_import(-1, file_unique_id="AQAD1")
+    assert not await svc.is_last_import(-2, file_unique_id="AQAD1")
+    # Тот же текст другим файлом узнаётся по хэшу
+    with make_upload(b"@masha\n123\n") as upload:
+        res = await svc.load_allowed_from_upload(upload, chat_id=-1, file_unique_id="AQAD2")
+    assert res == {"skipped": True}
+    assert len(svc.import_repo.records) == 1
+
+    with make_upload(b"@liza\n") as upload:
+        res = await svc.load_allowed_from_upload(upload, chat_id=-1, file_unique_id="AQAD3")
+    assert res["added"] == 1 and res["removed"] == 2
+
+
+@pytest.mark.asyncio
+async def test_upload_import_parses_spilled_file():
+    svc = ModerationService(DummyBot())
+    svc.allowed_repo = FakeAllowedRepo([])
+    svc.import_repo = FakeImportRepo()
+    content = gzip.compress(b"id,username\n" + b"1,@a\n2,@b\n" * 50)
+    try:
+        with make_upload(content, max_size=16) as upload:
+            assert upload.path is not None
+            res = await svc.load_allowed_from_upload(upload, filename="list.csv.gz")
+            path = upload.path
+    finally:
+        shutdown_parse_pool()
+    assert res["total"] == 2
+    assert await svc.get_allowed_identifiers() == ["@a", "@b"]
+    assert not os.path.exists(path)
+
+
+@pytest.mark.asyncio
+async def test_upload_resolves_known_usernames(db_backend):
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    svc = ModerationService(DummyBot())
+    await svc.member_repo.upsert_member(chat_id="-1", user_id="41", username="masha")
+    await svc.load_allowed_from_bytes(b"@masha\n")
+    # После смены имени участник проверяется по id
+    res = await svc.filter_unauthorized([{"id": 41, "username": "maria"}, {"id": 99, "username": "masha"}])
+    assert [item["id"] for item in res] == [99]
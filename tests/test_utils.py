@@ -1,3 +1,7 @@
+import gzip
+import io
+import zipfile
+
 from src.utils import parse_allowed_file_bytes
 
 def test_parse_simple_list():
@@ -30,3 +34,19 @@ def test_parse_mixed_content():
     """
     res = parse_allowed_file_bytes(content)
     assert res == ["@Masha123", "12345", "Bob_the_builder"]
+
+def test_parse_gzip_and_zip():
+    plain = b"@Masha123\nhttps://t.me/Bob\n"
+    assert parse_allowed_file_bytes(gzip.compress(plain)) == ["@Masha123", "Bob"]
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("list.txt", plain)
+    assert parse_allowed_file_bytes(buf.getvalue()) == ["@Masha123", "Bob"]
+
+def test_parse_csv_identifier_column():
+    content = "\ufeffName;Username;Phone\nМаша;@masha;+7\nБоб;;+1\nЛиза;https://t.me/liza;\n".encode()
+    assert parse_allowed_file_bytes(content) == ["@masha", "liza"]
+
+def test_parse_csv_without_header_takes_first_column():
+    content = b"@masha,Masha\n12345,Bob\n"
+    assert parse_allowed_file_bytes(content, name="list.csv") == ["@masha", "12345"]
@@ -0,0 +1,73 @@
+import asyncio
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import Bot, Dispatcher, Router, types
+from src.config import settings
+from src.webhook import ConcurrencyLimitMiddleware, build_webhook_app
+
+UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": -100, "type": "supergroup", "title": "t"},
+        "from": {"id": 5, "is_bot": False, "first_name": "u"},
+        "text": "hi",
+    },
+}
+
+
+def make_app(monkeypatch, seen):
+    monkeypatch.setattr(settings, "WEBHOOK_SECRET", "s3cret")
+    router = Router()
+
+    @router.message()
+    async def on_message(message: types.Message):
+        seen.append(message.text)
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    bot = Bot(token="123456:TEST")
+    return build_webhook_app(bot, dp, health=lambda: {"status": "ok"})
+
+
+@pytest.mark.asyncio
+async def test_webhook_validates_secret_and_feeds_updates(monkeypatch):
+    seen = []
+    client = TestClient(TestServer(make_app(monkeypatch, seen)))
+    await client.start_server()
+    try:
+        resp = await client.post(settings.WEBHOOK_PATH, json=UPDATE)
+        assert resp.status == 401
+
+        resp = await client.post(settings.WEBHOOK_PATH, json=UPDATE,
+                                 headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+        assert resp.status == 200
+        for _ in range(50):
+            if seen:
+                break
+            await asyncio.sleep(0.01)
+        assert seen == ["hi"]
+
+        resp = await client.get(settings.HEALTH_PATH)
+        assert resp.status == 200
+        assert (await resp.json())["status"] == "ok"
+    finally:
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit_middleware():
+    limiter = ConcurrencyLimitMiddleware(2)
+    peak = 0
+
+    async def handler(event, data):
+        nonlocal peak
+        peak = max(peak, limiter.in_flight)
+        await asyncio.sleep(0.01)
+        return event
+
+    results = await asyncio.gather(*(limiter(handler, i, {}) for i in range(6)))
+    assert results == list(range(6))
+    assert peak == 2
+    assert limiter.in_flight == 0
@@ -0,0 +1,114 @@
+import asyncio
+import random
+from types import SimpleNamespace
+
+import pytest
+from aiogram import Bot, Dispatcher, Router, types
+
+from src.config import settings
+from src.utils import parse_allowed_file_bytes
+from src.workers import ChatShardDispatcher, parse_allowed_off_loop, shutdown_parse_pool, update_key
+
+
+def chat_data(chat_id):
+    return {"event_chat": SimpleNamespace(id=chat_id)}
+
+
+@pytest.mark.asyncio
+async def test_shard_dispatcher_keeps_order_within_chat():
+    dispatcher = ChatShardDispatcher(workers=3, queue_size=4)
+    dispatcher.start()
+    seen = {}
+
+    async def handler(event, data):
+        await asyncio.sleep(random.random() / 1000)
+        seen.setdefault(data["event_chat"].id, []).append(event)
+
+    for i in range(60):
+        await dispatcher(handler, i, chat_data(-100 - i % 5))
+    await dispatcher.close()
+    assert {chat: events for chat, events in seen.items()} == {
+        -100 - k: list(range(k, 60, 5)) for k in range(5)
+    }
+
+
+@pytest.mark.asyncio
+async def test_shard_dispatcher_applies_backpressure():
+    dispatcher = ChatShardDispatcher(workers=1, queue_size=1)
+    dispatcher.start()
+    gate = asyncio.Event()
+
+    async def handler(event, data):
+        await gate.wait()
+
+    await dispatcher(handler, 1, chat_data(1))
+    await asyncio.sleep(0)
+    await dispatcher(handler, 2, chat_data(1))
+    # Первый апдейт у воркера, второй в очереди, третий ждёт места
+    third = asyncio.create_task(dispatcher(handler, 3, chat_data(1)))
+    await asyncio.sleep(0.01)
+    assert not third.done()
+    gate.set()
+    await third
+    await dispatcher.close()
+    assert dispatcher.qsize() == 0
+
+
+@pytest.mark.asyncio
+async def test_shard_dispatcher_slow_chat_does_not_block_other_shard():
+    dispatcher = ChatShardDispatcher(workers=2, queue_size=10)
+    dispatcher.start()
+    gate = asyncio.Event()
+    done = asyncio.Event()
+
+    async def slow(event, data):
+        await gate.wait()
+
+    async def fast(event, data):
+        done.set()
+
+    await dispatcher(slow, 1, chat_data(0))
+    await dispatcher(fast, 2, chat_data(1))
+    await asyncio.wait_for(done.wait(), 1)
+    gate.set()
+    await dispatcher.close()
+
+
+@pytest.mark.asyncio
+async def test_shard_dispatcher_with_aiogram_dispatcher():
+    router = Router()
+    seen = []
+
+    @router.message()
+    async def on_message(message: types.Message):
+        seen.append(message.text)
+
+    shards = ChatShardDispatcher(workers=2, queue_size=10)
+    dp = Dispatcher()
+    dp.update.outer_middleware(shards)
+    dp.include_router(router)
+    shards.start()
+    bot = Bot(token="123456:TEST")
+    for i in range(5):
+        update = types.Update.model_validate({"update_id": i, "message": {
+            "message_id": i, "date": 0, "chat": {"id": -100, "type": "supergroup"},
+            "from": {"id": 5, "is_bot": False, "first_name": "u"}, "text": str(i)}})
+        await dp.feed_update(bot, update)
+    await shards.close()
+    await bot.session.close()
+    assert seen == ["0", "1", "2", "3", "4"]
+
+
+def test_update_key_falls_back_to_user():
+    assert update_key({"event_chat": None, "event_from_user": SimpleNamespace(id=7)}) == 7
+    assert update_key({}) == 0
+
+
+@pytest.mark.asyncio
+async def test_parse_off_loop_matches_inline(monkeypatch):
+    content = "\n".join(["@masha", "https://t.me/liza/", "", "123"] * 100).encode()
+    monkeypatch.setattr(settings, "PARSE_OFFLOAD_BYTES", 0)
+    try:
+        assert await parse_allowed_off_loop(content) == parse_allowed_file_bytes(content)
+    finally:
+        shutdown_parse_pool()